@@ -1,18 +1,21 @@
 import os
 import sys
 import json
+import time
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
 
 # Добавляем родительскую директорию в путь
 sys.path.append(str(Path(__file__).parent.parent))
 
-from agents.sql_agent import SQLAgent
-from agents.rag_agent import RAGAgent
+from agents.resources import get_intent_router, get_llm_gateway, get_rag_agent, get_sql_agent, load_prompt
+from database.session_store import HISTORY, TOOL_ROWS_KEPT, SessionStore, session_limits, trim_history
+from tools.approximate import execute_approximate, get_refinement, is_approximate_enabled, submit_exact
+from tools.result_store import get_result_store
 from tools.sql_executor import execute_safe_sql
 from tools.visualizer import create_visualization
+from utils.cancellation import DeadlineExceeded, TurnCancelled, TurnContext, check_deadline, turn_scope
 from utils.logger import setup_logger
 
 load_dotenv()
@@ -20,31 +23,67 @@ load_dotenv()
 # Настройка логирования
 logger = setup_logger('conversational_agent', 'logs/conversational_agent.log')
 
+# classic      - generate_sql -> SQLAgent -> финальный ответ (минимум 3 запроса к LLM)
+# single_round - основная модель сама пишет SQL и спецификацию графика в одном вызове run_analysis
+EXECUTION_MODES = ("classic", "single_round")
+
+TABLE_PREVIEW_ROWS = 20
+
 
 class ConversationalAgent:
-    def __init__(self):
+    def __init__(
+        self,
+        history: Optional[List[Dict[str, Any]]] = None,
+        session_id: Optional[str] = None,
+        store: Optional[SessionStore] = None
+    ):
         self.model = os.getenv("CONVERSATIONAL_MODEL", "gpt-4o")
         self.temperature = float(os.getenv("CONVERSATIONAL_TEMPERATURE", "0.5"))
 
-        # Загружаем промпт (базовый шаблон)
-        prompt_path = Path(__file__).parent / "prompts" / "basic_ai.txt"
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            self.system_prompt_template = f.read()
-
-        # Инициализируем OpenAI клиента
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        # Инициализируем агентов
-        self.sql_agent = SQLAgent()
-        self.rag_agent = RAGAgent()
+        self.execution_mode = os.getenv("CHAT_EXECUTION_MODE", "classic")
+        if self.execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"Неизвестный CHAT_EXECUTION_MODE: {self.execution_mode}. Доступные: {', '.join(EXECUTION_MODES)}")
+        self.max_tool_steps = int(os.getenv("MAX_TOOL_STEPS", "5"))
+        # Бюджет времени на ход: его остаток получают вызовы LLM, SQL и поиск по базе знаний
+        self.turn_timeout = float(os.getenv("TURN_TIMEOUT_SECONDS", "120"))
+        self._turn: Optional[TurnContext] = None
+        # Приблизительные ответы по выборке; точный запрос досчитывается в фоне
+        self.approximate = is_approximate_enabled()
+        self._turn_approximate = False
+        self._turn_refinements: List[Dict[str, Any]] = []
+        # Точные запросы прошлых ходов, результат которых еще не попал в историю
+        self._pending_refinements: List[str] = []
+        self._turn_tables: List[Dict[str, Any]] = []
+        self.result_store = get_result_store()
 
-        # История диалога
-        self.conversation_history = []
+        # Загружаем промпт (базовый шаблон)
+        if self.execution_mode == "single_round":
+            self.system_prompt_template = load_prompt("planner_ai.txt").replace("{{schema}}", load_prompt("sql_picker_ai.txt"))
+        else:
+            self.system_prompt_template = load_prompt("basic_ai.txt")
+
+        # Шлюз к OpenAI и вспомогательные агенты общие для всех сессий процесса
+        self.llm = get_llm_gateway()
+        self.sql_agent = get_sql_agent()
+        self.rag_agent = get_rag_agent()
+        self.intent_router = get_intent_router()
+
+        # История диалога: при возобновлении сессии из хранилища подгружаются только последние ходы
+        self.session_id = session_id
+        self.store = store if session_id else None
+        self.limits = session_limits()
+        self.turn = 0
+        if history is None and self.store is not None:
+            history = self.store.load_recent(session_id, HISTORY, self.limits["resume_turns"])
+            self.turn = self.store.last_turn(session_id)
+        self.conversation_history = history if history is not None else []
+        self._on_event = None
 
         # Определяем инструменты
         self.tools = self._define_tools()
 
     def _format_system_prompt(self) -> str:
+        history_text = ""
         if self.conversation_history:
             formatted_history = []
             for msg in self.conversation_history:
@@ -61,6 +100,9 @@ class ConversationalAgent:
         return self.system_prompt_template.replace("{{messages}}", history_text)
 
     def _define_tools(self) -> List[Dict]:
+        if self.execution_mode == "single_round":
+            return [self._run_analysis_tool(), self._search_knowledge_tool()]
+
         return [
             {
                 "type": "function",
@@ -130,24 +172,68 @@ class ConversationalAgent:
                     }
                 }
             },
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_knowledge",
-                    "description": "Ищет релевантную информацию в базе знаний используя векторный поиск (RAG). Используй когда нужна общая информация о продуктах, регионах, категориях или аптеках.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "Запрос для поиска в базе знаний"
-                            }
+            self._search_knowledge_tool()
+        ]
+
+    def _search_knowledge_tool(self) -> Dict:
+        return {
+            "type": "function",
+            "function": {
+                "name": "search_knowledge",
+                "description": "Ищет релевантную информацию в базе знаний используя векторный поиск (RAG). Используй когда нужна общая информация о продуктах, регионах, категориях или аптеках.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "Запрос для поиска в базе знаний"
+                        }
+                    },
+                    "required": ["query"]
+                }
+            }
+        }
+
+    def _run_analysis_tool(self) -> Dict:
+        return {
+            "type": "function",
+            "function": {
+                "name": "run_analysis",
+                "description": "Выполняет SELECT запрос к таблице sales и при необходимости строит график по результату",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "sql": {
+                            "type": "string",
+                            "description": "SELECT запрос к таблице sales"
                         },
-                        "required": ["query"]
-                    }
+                        "chart": {
+                            "type": "object",
+                            "description": "Спецификация графика; не передавай, если график не нужен",
+                            "properties": {
+                                "chart_type": {
+                                    "type": "string",
+                                    "enum": ["bar", "line", "pie", "scatter"]
+                                },
+                                "title": {"type": "string"},
+                                "x_column": {"type": "string"},
+                                "y_column": {"type": "string"}
+                            },
+                            "required": ["chart_type", "title", "x_column", "y_column"]
+                        },
+                        "narrate": {
+                            "type": "boolean",
+                            "description": "Нужна ли развернутая интерпретация результата"
+                        },
+                        "summary": {
+                            "type": "string",
+                            "description": "Короткая подпись к результату, если интерпретация не нужна"
+                        }
+                    },
+                    "required": ["sql", "narrate"]
                 }
             }
-        ]
+        }
 
     def _execute_tool(self, tool_name: str, tool_args: Dict) -> Any:
         logger.info(f"Вызов инструмента: {tool_name}, аргументы: {tool_args}")
@@ -160,9 +246,11 @@ class ConversationalAgent:
 
             elif tool_name == "execute_sql":
                 logger.info(f"Выполнение SQL: {tool_args['sql_query']}")
-                results = execute_safe_sql(tool_args["sql_query"])
+                results, refinement = self._run_query(tool_args["sql_query"])
                 logger.info(f"Получено {len(results)} строк результата")
-                return {"data": results, "row_count": len(results), "status": "success"}
+                return self._with_refinement(
+                    {"data": results, "row_count": len(results), "status": "success"}, refinement
+                )
 
             elif tool_name == "create_visualization":
                 # Парсим данные из JSON строки
@@ -179,6 +267,23 @@ class ConversationalAgent:
                 logger.info("Визуализация создана успешно")
                 return {"figure": fig, "status": "success"}
 
+            elif tool_name == "run_analysis":
+                logger.info(f"Выполнение SQL: {tool_args['sql']}")
+                chart = tool_args.get("chart")
+                results, refinement = self._run_query(tool_args["sql"], render=self._exact_renderer(chart))
+                logger.info(f"Получено {len(results)} строк результата")
+                result = self._with_refinement(
+                    {"sql": tool_args["sql"], "data": results, "row_count": len(results), "status": "success"}, refinement
+                )
+
+                if chart and len(results) > 0:
+                    try:
+                        result["figure"] = create_visualization(data=results, **chart)
+                    except Exception as e:
+                        logger.warning(f"Не удалось построить график: {str(e)}")
+                        result["chart_error"] = str(e)
+                return result
+
             elif tool_name == "search_knowledge":
                 logger.info(f"Поиск в базе знаний: {tool_args['query']}")
                 context = self.rag_agent.search_knowledge(tool_args["query"])
@@ -193,45 +298,355 @@ class ConversationalAgent:
             logger.error(f"Ошибка выполнения инструмента {tool_name}: {str(e)}", exc_info=True)
             return {"error": str(e), "status": "error"}
 
-    def chat(self, user_message: str) -> Dict[str, Any]:
+    def _run_query(self, sql: str, params=None, render=None) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        if self._turn_approximate:
+            try:
+                approx = execute_approximate(sql, params)
+            except Exception as e:
+                logger.warning(f"Приблизительный запрос не выполнен, считаем точно: {str(e)}")
+                approx = None
+
+            if approx is not None:
+                refinement = {
+                    "id": submit_exact(sql, params, render),
+                    "relative_error": approx["relative_error"]
+                }
+                self._turn_refinements.append(refinement)
+                # В таблицу результата идут точные строки: они посчитаются при первом открытии страницы
+                self._register_table(sql, params, None, len(approx["data"]))
+                return approx["data"], refinement
+
+        rows = execute_safe_sql(sql, params)
+        self._register_table(sql, params, rows, len(rows))
+        return rows, None
+
+    def _register_table(self, sql: str, params, rows: Optional[List[Dict[str, Any]]], row_count: int):
+        if row_count == 0:
+            return
+        result_id = self.result_store.register(sql, params, rows, session_id=self.session_id)
+        if result_id is not None and all(table["result_id"] != result_id for table in self._turn_tables):
+            self._turn_tables.append({"result_id": result_id, "row_count": row_count})
+
+    @staticmethod
+    def _with_refinement(result: Dict[str, Any], refinement: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if refinement is None:
+            return result
+
+        error = refinement["relative_error"]
+        bound = f"погрешность до ±{error * 100:.1f}% (95%)" if error is not None else "погрешность не оценена"
+        result["approximate"] = True
+        result["relative_error"] = error
+        result["note"] = f"Приблизительные данные по выборке, {bound}. Укажи это в ответе; точные цифры пользователь получит следом."
+        result["refinement"] = refinement
+        return result
+
+    @staticmethod
+    def _exact_renderer(chart: Optional[Dict[str, Any]] = None, answer: Optional[Callable[[List[Dict]], str]] = None):
+        def render(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+            rendered = {}
+            if chart and len(rows) > 0:
+                try:
+                    rendered["figure"] = create_visualization(data=rows, **chart)
+                except Exception as e:
+                    logger.warning(f"Не удалось построить точный график: {str(e)}")
+            if answer is not None:
+                rendered["response"] = answer(rows)
+            return rendered
+        return render
+
+    @staticmethod
+    def _approximate_note(refinements: List[Dict[str, Any]]) -> str:
+        errors = [r["relative_error"] for r in refinements if r["relative_error"] is not None]
+        bound = f", погрешность до ±{max(errors) * 100:.1f}%" if errors and len(errors) == len(refinements) else ""
+        return f"_Приблизительный ответ по выборке{bound}. Точные цифры досчитываются._"
+
+    def _emit(self, event_type: str, **payload):
+        if self._on_event is not None:
+            try:
+                self._on_event({"type": event_type, **payload})
+            except Exception as e:
+                logger.warning(f"Ошибка обработчика событий: {str(e)}")
+
+    def chat(
+        self,
+        user_message: str,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+        approximate: Optional[bool] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
         logger.info(f"Получено сообщение от пользователя: {user_message}")
+        self._on_event = on_event
+        self._turn_approximate = self.approximate if approximate is None else approximate
+        self._turn_refinements = []
+        self._turn_tables = []
+        self._sync_history()
+        self._fold_refinements()
 
         # Добавляем сообщение в историю
+        turn_start = len(self.conversation_history)
+        self.turn += 1
         self.conversation_history.append({"role": "user", "content": user_message})
 
+        self._turn = TurnContext(timeout or self.turn_timeout)
         try:
-            result = self._chat_openai()
-            logger.info(f"Ответ сгенерирован успешно, визуализаций: {len(result.get('figures', []))}")
-            return result
+            with turn_scope(self._turn):
+                result = self._chat_fast_path(user_message)
+                if result is None:
+                    result = self._chat_openai()
+                    logger.info(f"Ответ сгенерирован успешно, визуализаций: {len(result.get('figures', []))}")
+            self._pending_refinements.extend(r["id"] for r in self._turn_refinements)
+
+        except TurnCancelled as e:
+            logger.warning(f"Ход прерван: {str(e)}")
+            del self.conversation_history[turn_start + 1:]
+            if isinstance(e, DeadlineExceeded):
+                message = f"{str(e)}. Попробуйте уточнить или сузить вопрос."
+            else:
+                message = "Ход остановлен."
+            result = {"response": message, "figures": [], "cancelled": True}
 
         except Exception as e:
             logger.error(f"Ошибка при обработке сообщения: {str(e)}", exc_info=True)
-            return {
+            # Недоигранные вызовы инструментов в истории сломали бы следующий запрос к модели
+            del self.conversation_history[turn_start + 1:]
+            result = {
                 "response": f"Произошла ошибка: {str(e)}",
                 "figures": []
             }
 
-    def _chat_openai(self) -> Dict[str, Any]:
-        logger.info(f"Отправка запроса в OpenAI, модель: {self.model}")
+        finally:
+            self._turn.close()
 
-        formatted_prompt = self._format_system_prompt()
-        messages = [{"role": "system", "content": formatted_prompt}] + self.conversation_history
-
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            tools=self.tools,
-            tool_choice="auto",
-            temperature=self.temperature
+        result["tables"] = list(self._turn_tables)
+        result["approximate"] = bool(self._turn_refinements)
+        result["refinements"] = [
+            {k: v for k, v in r.items() if k in ("id", "relative_error", "figure_index")}
+            for r in self._turn_refinements
+        ]
+
+        self._save_turn(turn_start)
+        return result
+
+    def _sync_history(self):
+        # Сессию мог вести другой процесс сервиса (смена воркера при перезапуске или масштабировании):
+        # если в хранилище есть ходы новее наших, история в памяти устарела и перечитывается
+        if self.store is None:
+            return
+        try:
+            last_turn = self.store.last_turn(self.session_id)
+            if last_turn == self.turn:
+                return
+            logger.warning(f"Сессия {self.session_id}: история в памяти отстала (ход {self.turn}, в хранилище {last_turn}), перечитываем")
+            self.conversation_history = self.store.load_recent(self.session_id, HISTORY, self.limits["resume_turns"])
+            self.turn = last_turn
+        except Exception as e:
+            logger.error(f"Не удалось сверить историю сессии {self.session_id}: {str(e)}", exc_info=True)
+
+    def _fold_refinements(self):
+        # Точные результаты прошлых ходов дописываются в историю перед новым вопросом: так модель
+        # не опирается на цифры по выборке, а история меняется только в потоке хода
+        pending, notes, failed = [], [], 0
+        for refinement_id in self._pending_refinements:
+            exact = get_refinement(refinement_id)
+            if exact["status"] == "pending":
+                pending.append(refinement_id)
+            elif exact["status"] == "done":
+                notes.append(exact.get("response") or json.dumps(
+                    exact.get("data", [])[:TOOL_ROWS_KEPT], ensure_ascii=False, default=str
+                ))
+            else:
+                # Точный запрос упал или его результат уже вытеснен: цифры по выборке так и не подтверждены
+                failed += 1
+                logger.warning(
+                    f"Сессия {self.session_id}: точный результат {refinement_id} не получен "
+                    f"({exact['status']}: {exact.get('error', 'нет в памяти процесса')})"
+                )
+        self._pending_refinements = pending
+        if not notes and not failed:
+            return
+
+        content = []
+        if notes:
+            content.append("Точные результаты вместо приблизительных из предыдущих ответов:\n" + "\n".join(notes))
+        if failed:
+            content.append(
+                f"Точный пересчет части приблизительных цифр выше не удался (запросов: {failed}): они получены "
+                "по выборке и не подтверждены. Если пользователь на них опирается, предупреди об этом или пересчитай точно."
+            )
+        message = {"role": "system", "content": "\n".join(content)}
+        self.conversation_history.append(message)
+        if self.store is not None:
+            try:
+                self.store.append(self.session_id, HISTORY, self.turn, [message])
+            except Exception as e:
+                logger.error(f"Не удалось сохранить точные результаты сессии {self.session_id}: {str(e)}", exc_info=True)
+
+    def cancel(self):
+        # Вызывается из другого потока (кнопка «Остановить», разрыв соединения с клиентом)
+        turn = self._turn
+        if turn is not None:
+            logger.info(f"Остановка хода сессии {self.session_id}")
+            turn.cancel()
+
+    def _save_turn(self, turn_start: int):
+        if self.store is not None:
+            try:
+                self.store.append(self.session_id, HISTORY, self.turn, self.conversation_history[turn_start:])
+            except Exception as e:
+                logger.error(f"Не удалось сохранить ход сессии {self.session_id}: {str(e)}", exc_info=True)
+
+        # Потолок памяти на сессию: в процессе держим только последние ходы
+        self.conversation_history = trim_history(
+            self.conversation_history, self.limits["max_turns"], self.limits["max_bytes"]
         )
 
-        assistant_message = response.choices[0].message
-        tool_calls = assistant_message.tool_calls
+    def _chat_fast_path(self, user_message: str) -> Optional[Dict[str, Any]]:
+        if self.intent_router is None:
+            return None
+
+        match = self.intent_router.route(user_message)
+        if match is None:
+            return None
 
-        logger.info(f"Получен ответ от AI, tool_calls: {len(tool_calls) if tool_calls else 0}")
+        started = time.perf_counter()
+        chart = {"title": match["title"], **match["chart"]}
+        render = self._exact_renderer(chart, lambda exact_rows: self.intent_router.format_answer(match, exact_rows))
+        try:
+            rows, refinement = self._run_query(match["sql"], match["params"], render=render)
+        except Exception as e:
+            logger.warning(f"Быстрый путь не сработал, переходим к LLM: {str(e)}")
+            return None
 
         figures = []
-        if tool_calls:
+        if len(rows) > 1:
+            try:
+                figures.append(create_visualization(data=rows, **chart))
+                if refinement is not None:
+                    refinement["figure_index"] = 0
+            except Exception as e:
+                logger.warning(f"Не удалось построить график быстрого пути: {str(e)}")
+
+        final_message = self.intent_router.format_answer(match, rows)
+        if refinement is not None:
+            final_message += "\n\n" + self._approximate_note([refinement])
+        self.conversation_history.append({"role": "assistant", "content": final_message})
+
+        logger.info(f"Ответ по быстрому пути ({match['intent']}): {len(rows)} строк, "
+                    f"{(time.perf_counter() - started) * 1000:.0f} мс")
+
+        return {
+            "response": final_message,
+            "figures": figures,
+            "metrics": {
+                "mode": "fast_path",
+                "llm_calls": 0,
+                "tool_calls": 0,
+                "latency_ms": round((time.perf_counter() - started) * 1000)
+            }
+        }
+
+    def _complete(self, with_tools: bool = True):
+        formatted_prompt = self._format_system_prompt()
+        params = {
+            "model": self.model,
+            "messages": [{"role": "system", "content": formatted_prompt}] + self.conversation_history,
+            "temperature": self.temperature
+        }
+        if with_tools:
+            params["tools"] = self.tools
+            params["tool_choice"] = "auto"
+
+        self._turn_llm_calls += 1
+        response = self.llm.chat_completion(**params)
+        if response.usage is not None:
+            self._turn_tokens += response.usage.total_tokens
+        return response.choices[0].message
+
+    def _run_tool_call(self, tool_call) -> Dict[str, Any]:
+        tool_name = tool_call.function.name
+        tool_args = json.loads(tool_call.function.arguments)
+
+        self._emit("tool_start", tool=tool_name)
+        result = self._execute_tool(tool_name, tool_args)
+
+        if tool_name == "generate_sql":
+            self._turn_llm_calls += 1
+
+        if tool_name == "generate_sql" and "sql" in result and result["status"] == "success":
+            logger.info("Автоматически выполняем сгенерированный sql...")
+            sql_query = result["sql"]
+
+            try:
+                exec_result, refinement = self._run_query(sql_query)
+                logger.info(f"sql выполнен успешно, получено {len(exec_result)} строк")
+
+                result["executed"] = True
+                result["data"] = exec_result
+                result["row_count"] = len(exec_result)
+                self._with_refinement(result, refinement)
+            except Exception as e:
+                logger.error(f"Ошибка выполнения sql: {str(e)}")
+                result["executed"] = False
+                result["error"] = str(e)
+
+        self._emit("tool_end", tool=tool_name, status=result["status"], row_count=result.get("row_count"))
+
+        # Сам объект графика модели не нужен, достаточно отметки
+        payload = {k: v for k, v in result.items() if k not in ("figure", "refinement")}
+        if "figure" in result:
+            payload["figure_created"] = True
+
+        self.conversation_history.append({
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "name": tool_name,
+            "content": json.dumps(payload, ensure_ascii=False, default=str)
+        })
+
+        return result
+
+    def _templated_answer(self, summary: Optional[str], results: List[Dict[str, Any]]) -> str:
+        lines = [summary] if summary else []
+
+        for result in results:
+            rows = result.get("data", [])
+            if not rows:
+                lines.append("Запрос не вернул данных.")
+                continue
+
+            columns = list(rows[0].keys())
+            lines.append("")
+            lines.append("| " + " | ".join(columns) + " |")
+            lines.append("|" + "---|" * len(columns))
+            for row in rows[:TABLE_PREVIEW_ROWS]:
+                lines.append("| " + " | ".join(str(row[c]) for c in columns) + " |")
+            if len(rows) > TABLE_PREVIEW_ROWS:
+                lines.append(f"\nПоказано {TABLE_PREVIEW_ROWS} из {len(rows)} строк.")
+
+        return "\n".join(lines).strip()
+
+    def _chat_openai(self) -> Dict[str, Any]:
+        logger.info(f"Отправка запроса в OpenAI, модель: {self.model}, режим: {self.execution_mode}")
+
+        started = time.perf_counter()
+        self._turn_llm_calls = 0
+        self._turn_tokens = 0
+        tool_calls_total = 0
+        figures = []
+        final_message = None
+
+        # Ограниченный цикл: модель может запрашивать инструменты повторно (например, исправить SQL)
+        for step in range(self.max_tool_steps):
+            check_deadline()
+            assistant_message = self._complete()
+            tool_calls = assistant_message.tool_calls
+
+            logger.info(f"Шаг {step + 1}: получен ответ от AI, tool_calls: {len(tool_calls) if tool_calls else 0}")
+
+            if not tool_calls:
+                final_message = assistant_message.content
+                break
+
             # Конвертируем assistant_message в словарь для истории
             self.conversation_history.append({
                 "role": "assistant",
@@ -248,55 +663,52 @@ class ConversationalAgent:
                 ]
             })
 
+            step_results = []
             for tool_call in tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
-
-                result = self._execute_tool(tool_name, tool_args)
-
-                if tool_name == "generate_sql" and "sql" in result and result["status"] == "success":
-                    logger.info("Автоматически выполняем сгенерированный sql...")
-                    sql_query = result["sql"]
-
-                    try:
-                        exec_result = execute_safe_sql(sql_query)
-                        logger.info(f"sql выполнен успешно, получено {len(exec_result)} строк")
-
-                        result["executed"] = True
-                        result["data"] = exec_result
-                        result["row_count"] = len(exec_result)
-                    except Exception as e:
-                        logger.error(f"Ошибка выполнения sql: {str(e)}")
-                        result["executed"] = False
-                        result["error"] = str(e)
+                result = self._run_tool_call(tool_call)
+                tool_calls_total += 1
+                step_results.append((tool_call, result))
 
                 if "figure" in result:
+                    if "refinement" in result:
+                        result["refinement"]["figure_index"] = len(figures)
                     figures.append(result["figure"])
 
-                self.conversation_history.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "name": tool_name,
-                    "content": json.dumps(result, ensure_ascii=False, default=str)
-                })
-
-            updated_prompt = self._format_system_prompt()
-            final_response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "system", "content": updated_prompt}] + self.conversation_history,
-                temperature=self.temperature
-            )
-
-            final_message = final_response.choices[0].message.content
+            # Простой табличный ответ: финальная генерация текста не нужна
+            if all(
+                tc.function.name == "run_analysis"
+                and result["status"] == "success"
+                and not json.loads(tc.function.arguments).get("narrate", True)
+                for tc, result in step_results
+            ):
+                summary = json.loads(step_results[0][0].function.arguments).get("summary") or assistant_message.content
+                final_message = self._templated_answer(summary, [result for _, result in step_results])
+                if self._turn_refinements:
+                    final_message += "\n\n" + self._approximate_note(self._turn_refinements)
+                break
         else:
-            final_message = assistant_message.content
+            logger.warning(f"Достигнут лимит шагов инструментов ({self.max_tool_steps}), финальный ответ без инструментов")
+            final_message = self._complete(with_tools=False).content
 
         self.conversation_history.append({"role": "assistant", "content": final_message})
 
+        metrics = {
+            "mode": self.execution_mode,
+            "llm_calls": self._turn_llm_calls,
+            "tool_calls": tool_calls_total,
+            "tokens": self._turn_tokens,
+            "latency_ms": round((time.perf_counter() - started) * 1000)
+        }
+        logger.info(f"Метрики хода: {metrics}")
+
         return {
             "response": final_message,
-            "figures": figures
+            "figures": figures,
+            "metrics": metrics
         }
 
     def clear_history(self):
         self.conversation_history = []
+        self.turn = 0
+        if self.store is not None:
+            self.store.clear(self.session_id)
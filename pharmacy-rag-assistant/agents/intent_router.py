@@ -0,0 +1,458 @@
+import os
+import re
+import sys
+import time
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import execute_query
+from utils.logger import setup_logger
+
+logger = setup_logger('intent_router', 'logs/intent_router.log')
+
+
+# Быстрый путь без LLM: частые формы вопросов распознаются регулярками и
+# подставляются в заранее проверенные параметризованные SQL шаблоны.
+
+DEFAULT_CATEGORIES = [
+    "Антибиотики", "Витамины", "Обезболивающие",
+    "Жаропонижающие", "Противовирусные", "Антигистаминные"
+]
+
+DIMENSIONS = {
+    "product": (r"препарат|продукт|лекарств|медикамент|товар", "препаратов"),
+    "category": (r"категори", "категорий"),
+    "pharmacy": (r"аптек", "аптек"),
+    "region": (r"регион|город", "регионов"),
+}
+
+METRICS = {
+    "revenue": ("total_revenue", "выручке"),
+    "profit": ("total_profit", "прибыли"),
+    "units": ("total_units", "количеству проданных единиц"),
+}
+
+MONTHS = [
+    r"январ", r"феврал", r"март", r"апрел", r"ма[йяе]", r"июн",
+    r"июл", r"август", r"сентябр", r"октябр", r"ноябр", r"декабр"
+]
+MONTH_LABELS = [
+    "январь", "февраль", "март", "апрель", "май", "июнь",
+    "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"
+]
+QUARTER_WORDS = {"перв": 1, "втор": 2, "трет": 3, "четв": 4}
+
+# Условия, которые шаблоны не умеют выражать: такие вопросы уходят в LLM
+UNSUPPORTED = re.compile(
+    r"кроме|исключ|\bбез\b|только|\bгде\b|\bесли\b|почему|средн|дол[яиюе]\b|процент|"
+    r"маржин|рентабельн|прогноз|корреляц|№|\bи\s+(?:регион|категори|аптек)"
+)
+
+TOP_TEMPLATE = """
+SELECT
+    {dimension},
+    ROUND(SUM(revenue), 2) AS total_revenue,
+    ROUND(SUM(profit), 2) AS total_profit,
+    SUM(units_sold) AS total_units
+FROM sales
+{where}
+GROUP BY {dimension}
+ORDER BY {order_by} DESC
+LIMIT %(limit)s
+"""
+
+REGION_TEMPLATE = """
+SELECT
+    region,
+    ROUND(SUM(revenue), 2) AS total_revenue,
+    ROUND(SUM(profit), 2) AS total_profit,
+    SUM(units_sold) AS total_units,
+    COUNT(DISTINCT pharmacy) AS pharmacy_count
+FROM sales
+{where}
+GROUP BY region
+ORDER BY total_revenue DESC
+"""
+
+TREND_TEMPLATE = """
+SELECT
+    DATE_TRUNC('month', date)::date AS month,
+    ROUND(SUM(revenue), 2) AS monthly_revenue,
+    ROUND(SUM(profit), 2) AS monthly_profit,
+    SUM(units_sold) AS monthly_units
+FROM sales
+{where}
+GROUP BY DATE_TRUNC('month', date)
+ORDER BY month
+"""
+
+COMPARE_TEMPLATE = """
+SELECT
+    CASE WHEN date >= %(a_from)s AND date < %(a_to)s THEN %(a_label)s ELSE %(b_label)s END AS period,
+    ROUND(SUM(revenue), 2) AS total_revenue,
+    ROUND(SUM(profit), 2) AS total_profit,
+    SUM(units_sold) AS total_units
+FROM sales
+WHERE ((date >= %(a_from)s AND date < %(a_to)s) OR (date >= %(b_from)s AND date < %(b_to)s)){extra}
+GROUP BY 1
+ORDER BY MIN(date)
+"""
+
+
+def _add_months(day: date, months: int) -> date:
+    total = day.year * 12 + day.month - 1 + months
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def _period_label(start: date, months: int) -> str:
+    if months == 1:
+        return f"{MONTH_LABELS[start.month - 1]} {start.year}"
+    if months == 3 and start.month % 3 == 1:
+        return f"{(start.month - 1) // 3 + 1} квартал {start.year}"
+    if months == 12 and start.month == 1:
+        return f"{start.year} год"
+    end = _add_months(start, months - 1)
+    return f"{start:%Y-%m} — {end:%Y-%m}"
+
+
+def _stem(word: str) -> str:
+    word = word.lower()
+    return word[:-1] if len(word) > 4 else word
+
+
+def format_money(value) -> str:
+    return f"{float(value or 0):,.2f}".replace(",", " ") + " тг"
+
+
+class IntentRouter:
+
+    def __init__(self, cache_ttl: float = 300.0):
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._reference: Optional[Tuple[date, List[str], List[str]]] = None
+        self._loaded_at = 0.0
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    # --- справочники -----------------------------------------------------
+
+    def refresh(self) -> Tuple[date, List[str], List[str]]:
+        # Синхронная загрузка справочников: вызывается из прогрева и из фонового потока,
+        # запросы к sales идут без блокировки, под ней только замена готового значения
+        try:
+            max_date = execute_query("SELECT MAX(date) AS max_date FROM sales")[0]["max_date"]
+            regions = [r["region"] for r in execute_query("SELECT DISTINCT region FROM sales")]
+            categories = [r["category"] for r in execute_query("SELECT DISTINCT category FROM sales")]
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить справочники для роутера: {str(e)}")
+            with self._lock:
+                # Последнее удачное значение продолжает обслуживать запросы
+                self._loaded_at = time.monotonic()
+                return self._reference or self._fallback()
+
+        # Относительные периоды ("последний квартал") считаются от конца имеющихся данных
+        reference_day = (max_date + timedelta(days=1)) if max_date else date.today()
+        with self._lock:
+            self._reference = (reference_day, regions, categories or DEFAULT_CATEGORIES)
+            self._loaded_at = time.monotonic()
+            return self._reference
+
+    @staticmethod
+    def _fallback() -> Tuple[date, List[str], List[str]]:
+        return date.today(), [], DEFAULT_CATEGORIES
+
+    def _load_reference(self) -> Tuple[date, List[str], List[str]]:
+        # На пути запроса в базу не ходим: отдаем последнее известное значение,
+        # а устаревшие справочники обновляет фоновый поток
+        with self._lock:
+            reference = self._reference
+            stale = reference is None or time.monotonic() - self._loaded_at >= self.cache_ttl
+            if stale and (self._refresh_thread is None or not self._refresh_thread.is_alive()):
+                self._refresh_thread = threading.Thread(target=self.refresh, name="router-reference", daemon=True)
+                self._refresh_thread.start()
+        return reference or self._fallback()
+
+    @staticmethod
+    def _find_value(text: str, values: List[str]) -> Optional[str]:
+        # Совпадение по границам слова с допуском на окончание: "Витамины" находится в "витаминов",
+        # но короткое название не находится внутри другого слова
+        for value in values:
+            stem = re.escape(_stem(value).replace("ё", "е"))
+            if re.search(rf"(?<!\w){stem}\w{{0,3}}(?!\w)", text):
+                return value
+        return None
+
+    # --- периоды ---------------------------------------------------------
+
+    def _parse_periods(self, text: str, today: date) -> List[Dict[str, Any]]:
+        periods = []
+        month_start = date(today.year, today.month, 1)
+        quarter_start = date(today.year, 3 * ((today.month - 1) // 3) + 1, 1)
+
+        def add(start, end, label, pos):
+            periods.append({"from": start, "to": end, "label": label, "pos": pos})
+
+        for m in re.finditer(r"(?:последни[ехй]|за)\s+(\d{1,2})\s+(месяц|год|лет)", text):
+            n = int(m.group(1))
+            months = n if m.group(2) == "месяц" else 12 * n
+            label = f"последние {n} мес." if m.group(2) == "месяц" else f"последние {n} г."
+            add(_add_months(month_start, -months), month_start, label, m.start())
+
+        for m in re.finditer(r"(?:последн|прошл)\w*\s+(месяц|квартал|год)", text):
+            unit = m.group(1)
+            if unit == "месяц":
+                start = _add_months(month_start, -1)
+                add(start, month_start, f"{MONTH_LABELS[start.month - 1]} {start.year}", m.start())
+            elif unit == "квартал":
+                start = _add_months(quarter_start, -3)
+                add(start, quarter_start, f"{(start.month - 1) // 3 + 1} квартал {start.year}", m.start())
+            elif text[m.start():m.start() + 5] == "прошл":
+                add(date(today.year - 1, 1, 1), date(today.year, 1, 1), f"{today.year - 1} год", m.start())
+            else:
+                add(_add_months(month_start, -12), month_start, "последние 12 мес.", m.start())
+
+        for m in re.finditer(r"(?:(\d)|(перв|втор|трет|четв)\w*)[\s-]*(?:й\s+)?квартал\w*\s+(\d{4})", text):
+            q = int(m.group(1)) if m.group(1) else QUARTER_WORDS[m.group(2)]
+            year = int(m.group(3))
+            if 1 <= q <= 4:
+                start = date(year, 3 * (q - 1) + 1, 1)
+                add(start, _add_months(start, 3), f"{q} квартал {year}", m.start())
+
+        for i, pattern in enumerate(MONTHS):
+            for m in re.finditer(rf"\b{pattern}\w*\s+(\d{{4}})", text):
+                start = date(int(m.group(1)), i + 1, 1)
+                add(start, _add_months(start, 1), f"{MONTH_LABELS[i]} {start.year}", m.start())
+
+        if not periods:
+            for m in re.finditer(r"\b(20\d{2})\b", text):
+                year = int(m.group(1))
+                add(date(year, 1, 1), date(year + 1, 1, 1), f"{year} год", m.start())
+
+        periods.sort(key=lambda p: p["pos"])
+
+        # "последний месяц с предыдущим" / "2024 по сравнению с предыдущим годом"
+        if len(periods) == 1 and re.search(r"предыдущ|с\s+прошл", text):
+            first = periods[0]
+            months = (first["to"].year - first["from"].year) * 12 + first["to"].month - first["from"].month
+            start = _add_months(first["from"], -months)
+            periods.append({"from": start, "to": first["from"], "label": _period_label(start, months), "pos": len(text)})
+
+        return periods
+
+    # --- распознавание ---------------------------------------------------
+
+    def route(self, question: str) -> Optional[Dict[str, Any]]:
+        text = question.lower().replace("ё", "е")
+
+        if UNSUPPORTED.search(text):
+            return None
+
+        today, regions, categories = self._load_reference()
+        periods = self._parse_periods(text, today)
+        category = self._find_value(text, categories)
+        region = self._find_value(text, regions)
+
+        match = (
+            self._match_compare(text, periods, category, region)
+            or self._match_trend(text, periods, category, region)
+            or self._match_top(text, periods, category, region)
+            or self._match_by_region(text, periods, category)
+        )
+
+        if match:
+            logger.info(f"Быстрый путь: интент {match['intent']}, параметры: {match['params']}")
+        return match
+
+    @staticmethod
+    def _metric(text: str) -> str:
+        if re.search(r"прибыл", text):
+            return "profit"
+        if re.search(r"единиц|штук|количеств|упаков", text):
+            return "units"
+        return "revenue"
+
+    @staticmethod
+    def _where(period: Optional[Dict], category: Optional[str], region: Optional[str]) -> Tuple[str, Dict]:
+        conditions, params = [], {}
+        if period:
+            conditions.append("date >= %(date_from)s AND date < %(date_to)s")
+            params.update({"date_from": period["from"], "date_to": period["to"]})
+        if category:
+            conditions.append("category = %(category)s")
+            params["category"] = category
+        if region:
+            conditions.append("region = %(region)s")
+            params["region"] = region
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        return where, params
+
+    @staticmethod
+    def _suffix(period, category=None, region=None) -> str:
+        parts = []
+        if category:
+            parts.append(f"в категории «{category}»")
+        if region:
+            parts.append(f"в регионе {region}")
+        parts.append(f"за {period['label']}" if period else "за весь период")
+        return " " + " ".join(parts)
+
+    def _match_top(self, text, periods, category, region):
+        top = re.search(r"топ[\s-]*(\d+)?|сам\w+\s+(?:продаваем|прибыльн|популярн|доходн)|лидер", text)
+        if not top or len(periods) > 1:
+            return None
+
+        # Топ внутри каждого региона/категории/месяца шаблон не покрывает
+        if re.search(r"по\s+(?:регион|категори|аптек|месяц|город)|в\s+каждо", text):
+            return None
+
+        dimension = None
+        for name, (pattern, _) in DIMENSIONS.items():
+            found = re.search(pattern, text)
+            if found and (dimension is None or found.start() < dimension[1]):
+                dimension = (name, found.start())
+        if dimension is None:
+            return None
+        dimension = dimension[0]
+        if dimension == "category":
+            category = None
+        if dimension == "region":
+            region = None
+
+        limit = int(top.group(1)) if top.group(1) else 10
+        limit = max(1, min(limit, 100))
+        metric = self._metric(text)
+        if "прибыльн" in text:
+            metric = "profit"
+        order_by, metric_label = METRICS[metric]
+
+        period = periods[0] if periods else None
+        where, params = self._where(period, category, region)
+        params["limit"] = limit
+
+        return {
+            "intent": "top_n",
+            "sql": TOP_TEMPLATE.format(dimension=dimension, where=where, order_by=order_by),
+            "params": params,
+            "dimension": dimension,
+            "metric": order_by,
+            "title": f"Топ-{limit} {DIMENSIONS[dimension][1]} по {metric_label}{self._suffix(period, category, region)}",
+            "chart": {"chart_type": "bar", "x_column": dimension, "y_column": order_by},
+        }
+
+    def _match_by_region(self, text, periods, category):
+        if not re.search(r"по\s+регион|регионам|в\s+разрезе\s+регион", text):
+            return None
+        if not re.search(r"выручк|продаж|прибыл|оборот", text) or len(periods) > 1:
+            return None
+        if re.search(r"по\s+месяц|помесячн|динамик|тренд|менял|изменени", text):
+            return None
+
+        period = periods[0] if periods else None
+        where, params = self._where(period, category, None)
+        metric = "total_profit" if self._metric(text) == "profit" else "total_revenue"
+
+        return {
+            "intent": "revenue_by_region",
+            "sql": REGION_TEMPLATE.format(where=where),
+            "params": params,
+            "dimension": "region",
+            "metric": metric,
+            "title": f"{'Прибыль' if metric == 'total_profit' else 'Выручка'} по регионам{self._suffix(period, category)}",
+            "chart": {"chart_type": "bar", "x_column": "region", "y_column": metric},
+        }
+
+    def _match_trend(self, text, periods, category, region):
+        if not re.search(r"по\s+месяц|помесячн|динамик|тренд|ежемесячн", text):
+            return None
+        if not category or len(periods) > 1:
+            return None
+        if re.search(r"по\s+(?:регион|аптек|продукт|препарат)", text):
+            return None
+
+        period = periods[0] if periods else None
+        where, params = self._where(period, category, region)
+        metric = {"profit": "monthly_profit", "units": "monthly_units"}.get(self._metric(text), "monthly_revenue")
+
+        return {
+            "intent": "category_monthly_trend",
+            "sql": TREND_TEMPLATE.format(where=where),
+            "params": params,
+            "dimension": "month",
+            "metric": metric,
+            "title": f"Продажи по месяцам{self._suffix(period, category, region)}",
+            "chart": {"chart_type": "line", "x_column": "month", "y_column": metric},
+        }
+
+    def _match_compare(self, text, periods, category, region):
+        if not re.search(r"сравн|против|\bvs\b|по\s+сравнению", text) or len(periods) != 2:
+            return None
+        if re.search(r"по\s+(?:регион|категори|аптек|продукт|препарат|месяц)", text):
+            return None
+
+        a, b = sorted(periods[:2], key=lambda p: p["from"])
+        if a["label"] == b["label"]:
+            return None
+
+        extra_where, params = self._where(None, category, region)
+        extra = (" AND " + extra_where[len("WHERE "):]) if extra_where else ""
+        params.update({
+            "a_from": a["from"], "a_to": a["to"], "a_label": a["label"],
+            "b_from": b["from"], "b_to": b["to"], "b_label": b["label"],
+        })
+
+        return {
+            "intent": "compare_periods",
+            "sql": COMPARE_TEMPLATE.format(extra=extra),
+            "params": params,
+            "dimension": "period",
+            "metric": "total_revenue",
+            "title": f"Сравнение периодов: {a['label']} и {b['label']}"
+                     + (f" ({category})" if category else "") + (f", {region}" if region else ""),
+            "chart": {"chart_type": "bar", "x_column": "period", "y_column": "total_revenue"},
+        }
+
+    # --- ответ -----------------------------------------------------------
+
+    def format_answer(self, match: Dict[str, Any], rows: List[Dict[str, Any]]) -> str:
+        if not rows:
+            return f"{match['title']}: данных за указанный период нет."
+
+        intent = match["intent"]
+        metric = match["metric"]
+        lines = [f"**{match['title']}**", ""]
+
+        if intent == "compare_periods":
+            first, last = rows[0], rows[-1]
+            for row in rows:
+                lines.append(f"- {row['period']}: выручка {format_money(row['total_revenue'])}, "
+                             f"прибыль {format_money(row['total_profit'])}, продано {row['total_units']} ед.")
+            if len(rows) == 2 and first["total_revenue"]:
+                change = (float(last["total_revenue"]) - float(first["total_revenue"])) / float(first["total_revenue"]) * 100
+                lines.append("")
+                lines.append(f"Изменение выручки: {change:+.2f}%")
+
+        elif intent == "category_monthly_trend":
+            for row in rows:
+                value = row[metric]
+                shown = f"{value} ед." if metric == "monthly_units" else format_money(value)
+                lines.append(f"- {row['month']:%Y-%m}: {shown}")
+            if len(rows) >= 2 and rows[0][metric]:
+                change = (float(rows[-1][metric]) - float(rows[0][metric])) / float(rows[0][metric]) * 100
+                lines.append("")
+                lines.append(f"Изменение с {rows[0]['month']:%Y-%m} по {rows[-1]['month']:%Y-%m}: {change:+.2f}%")
+
+        else:
+            dimension = match["dimension"]
+            for i, row in enumerate(rows, 1):
+                value = row[metric]
+                shown = f"{value} ед." if metric == "total_units" else format_money(value)
+                lines.append(f"{i}. {row[dimension]} — {shown}")
+
+        return "\n".join(lines)
+
+
+def is_intent_router_enabled() -> bool:
+    return os.getenv("INTENT_ROUTER_ENABLED", "true").lower() in ("1", "true", "yes")
@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, OpenAI, RateLimitError
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from utils.cancellation import remaining_time, wait_future
+from utils.logger import setup_logger
+
+logger = setup_logger('llm_gateway', 'logs/llm_gateway.log')
+
+# Единая точка выхода к OpenAI для всех агентов и скриптов:
+# - token bucket на модель (запросы и токены в минуту)
+# - повтор с экспоненциальной задержкой и джиттером, Retry-After от сервера в приоритете
+# - одинаковые одновременные запросы уходят один раз (singleflight), остальные ждут его результат
+# - задержка и расход токенов по каждому вызову
+# - HTTP запрос ограничен остатком дедлайна хода, а остановка хода сразу прекращает ожидание ответа
+
+DEFAULT_RPM = int(os.getenv("LLM_RPM", "500"))
+DEFAULT_TPM = int(os.getenv("LLM_TPM", "30000"))
+# Резерв токенов под ответ, пока фактический usage неизвестен
+COMPLETION_RESERVE = int(os.getenv("LLM_COMPLETION_RESERVE", "500"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    # LLM_LIMITS="gpt-4o=500:30000,text-embedding-3-small=3000:1000000"
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (int(rpm), int(tpm or DEFAULT_TPM))
+    return limits
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float) -> float:
+        # Запрос больше емкости все равно пропускаем, когда ведро полное, иначе он ждал бы вечно
+        amount = min(amount, self.capacity)
+        started = time.monotonic()
+        with self.condition:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return time.monotonic() - started
+                self.condition.wait((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        # Поправка после ответа: возвращаем лишний резерв или списываем недостачу (может уйти в минус)
+        with self.condition:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+            self.condition.notify_all()
+
+
+class ModelLimiter:
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def acquire(self, estimated_tokens: int) -> float:
+        return self.requests.acquire(1) + self.tokens.acquire(estimated_tokens)
+
+
+def _estimate_tokens(kind: str, params: Dict[str, Any]) -> int:
+    # Грубая оценка ~4 символа на токен; точное значение приходит в usage
+    if kind == "embedding":
+        text = params["input"] if isinstance(params["input"], str) else " ".join(params["input"])
+        return max(1, len(text) // 4)
+
+    prompt = json.dumps(params.get("messages", []), ensure_ascii=False, default=str)
+    if params.get("tools"):
+        prompt += json.dumps(params["tools"], ensure_ascii=False)
+    return len(prompt) // 4 + int(params.get("max_tokens") or COMPLETION_RESERVE)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+class _Flight:
+    # Общий запрос singleflight. Его дедлайн - самый поздний из дедлайнов ожидающих ходов:
+    # запрос живет, пока его ждет хоть кто-то, а каждый ход перестает ждать по своему дедлайну
+    def __init__(self, deadline: Optional[float]):
+        self.deadline = deadline
+        self.future: Optional[Future] = None
+
+    def extend(self, deadline: Optional[float]):
+        # None - ход без дедлайна: общий запрос больше не ограничен по времени
+        if self.deadline is not None:
+            self.deadline = None if deadline is None else max(self.deadline, deadline)
+
+
+class LLMGateway:
+    def __init__(self, client: Optional[OpenAI] = None):
+        # Повторы делает шлюз, поэтому встроенные повторы SDK отключены
+        self.client = client or OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        self.limits = _parse_limits(os.getenv("LLM_LIMITS", ""))
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._inflight: Dict[str, _Flight] = {}
+        # Запросы выполняются в отдельных потоках, чтобы ожидающий ход можно было прервать
+        self._pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def _limiter(self, model: str) -> ModelLimiter:
+        with self._lock:
+            if model not in self._limiters:
+                rpm, tpm = self.limits.get(model, (DEFAULT_RPM, DEFAULT_TPM))
+                self._limiters[model] = ModelLimiter(rpm, tpm)
+            return self._limiters[model]
+
+    def chat_completion(self, **params):
+        return self._call("chat", params, self.client.chat.completions.create)
+
+    def embedding(self, **params):
+        return self._call("embedding", params, self.client.embeddings.create)
+
+    def _call(self, kind: str, params: Dict[str, Any], send: Callable):
+        key = hashlib.sha256(
+            json.dumps([kind, params], sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
+
+        # Общий запрос не привязан к ходу, который его начал: остановка одного хода
+        # не обрывает ответ для остальных ожидающих, а присоединившийся ход продлевает его дедлайн
+        remaining = remaining_time()
+        deadline = time.monotonic() + remaining if remaining is not None else None
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            coalesced = flight is not None
+            if coalesced:
+                flight.extend(deadline)
+            else:
+                flight = _Flight(deadline)
+                flight.future = self._pool.submit(self._send_with_retries, kind, params, send, flight)
+                self._inflight[key] = flight
+
+        if coalesced:
+            self._record(params["model"], coalesced=1)
+        else:
+            # Вне блокировки: у завершившегося future колбэк вызывается сразу в этом потоке
+            flight.future.add_done_callback(lambda _: self._forget(key, flight))
+        # Каждый ход ждет сам: его отмена или дедлайн прекращают только его ожидание
+        return wait_future(flight.future)
+
+    def _forget(self, key: str, flight: _Flight):
+        with self._lock:
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+
+    def _send_with_retries(self, kind: str, params: Dict[str, Any], send: Callable, flight: Optional[_Flight] = None):
+        model = params["model"]
+        limiter = self._limiter(model)
+        estimated = _estimate_tokens(kind, params)
+
+        for attempt in range(MAX_RETRIES + 1):
+            throttled = limiter.acquire(estimated)
+            started = time.perf_counter()
+            # Дедлайн перечитывается на каждой попытке: его мог продлить присоединившийся ход.
+            # Таймаут уже отправленной попытки не продлить, но оборванная им попытка повторится с новым
+            deadline = flight.deadline if flight is not None else None
+            try:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"Дедлайн хода истек до отправки запроса к {model}")
+                    response = send(**params, timeout=remaining)
+                else:
+                    response = send(**params)
+            except Exception as e:
+                if not _is_retryable(e) or attempt == MAX_RETRIES:
+                    self._record(model, errors=1)
+                    logger.error(f"{kind} {model}: ошибка после {attempt + 1} попыток: {str(e)}")
+                    raise
+
+                # Full jitter, но не раньше, чем просит сервер
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                deadline = flight.deadline if flight is not None else None
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    self._record(model, errors=1)
+                    logger.error(f"{kind} {model}: повтор не успеет до дедлайна хода: {str(e)}")
+                    raise
+                self._record(model, retries=1)
+                logger.warning(f"{kind} {model}: {type(e).__name__}, повтор {attempt + 1} через {delay:.2f} с")
+                time.sleep(delay)
+                continue
+
+            latency_ms = (time.perf_counter() - started) * 1000
+            usage = getattr(response, "usage", None)
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            if usage is not None:
+                limiter.tokens.adjust(prompt_tokens + completion_tokens - estimated)
+
+            self._record(
+                model, calls=1, latency_ms=latency_ms, throttled_ms=throttled * 1000,
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+            )
+            logger.info(f"{kind} {model}: {latency_ms:.0f} мс, ожидание лимита {throttled * 1000:.0f} мс, "
+                        f"токены {prompt_tokens}+{completion_tokens}, попытка {attempt + 1}")
+            return response
+
+    def _record(self, model: str, **values: float):
+        with self._lock:
+            stats = self._stats.setdefault(model, {
+                "calls": 0, "errors": 0, "retries": 0, "coalesced": 0, "latency_ms": 0.0,
+                "throttled_ms": 0.0, "prompt_tokens": 0, "completion_tokens": 0
+            })
+            for name, value in values.items():
+                stats[name] += value
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            snapshot = {model: dict(stats) for model, stats in self._stats.items()}
+        for stats in snapshot.values():
+            stats["avg_latency_ms"] = round(stats["latency_ms"] / stats["calls"]) if stats["calls"] else 0
+        return snapshot
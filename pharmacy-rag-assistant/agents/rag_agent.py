@@ -1,24 +1,38 @@
 import os
 import sys
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
 
 sys.path.append(str(Path(__file__).parent.parent))
-from database.connection import get_connection
+from agents.resources import get_llm_gateway
+from database.connection import pooled_connection
+from database.embeddings import EMBEDDING_MODEL, get_embedding_storage, to_vector_literal
+from tools.vector_index import get_vector_index, is_vector_index_enabled
+from utils.cancellation import cancellable, check_deadline
 from utils.logger import setup_logger
 
 load_dotenv()
 
 logger = setup_logger('rag_agent', 'logs/rag_agent.log')
 
+# Эмбеддинги запросов кэшируются на процесс: агент один на все сессии (agents/resources.py)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+
 
 class RAGAgent:
 
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        logger.info("RAG Agent инициализирован")
+        self.llm = get_llm_gateway()
+        self.storage = get_embedding_storage()
+        self.binary_rerank_factor = int(os.getenv("BINARY_RERANK_FACTOR", "10"))
+        self.vector_index = get_vector_index() if is_vector_index_enabled() else None
+        self._embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._embeddings_lock = threading.Lock()
+        logger.info(f"RAG Agent инициализирован, хранение: {self.storage}, "
+                    f"in-memory индекс: {'вкл' if self.vector_index else 'выкл'}")
 
     def search_knowledge(self, query: str, top_k: int = 3) -> str:
         logger.info(f"Поиск знаний для запроса: {query}")
@@ -26,24 +40,10 @@ class RAGAgent:
         try:
             query_embedding = self._create_embedding(query)
 
-            emb_str = '[' + ','.join(map(str, query_embedding)) + ']'
-
-            conn = get_connection()
-            cur = conn.cursor()
-
-            cur.execute("""
-                SELECT
-                    content,
-                    content_type,
-                    1 - (embedding <=> %s::vector) as similarity
-                FROM knowledge_base
-                ORDER BY embedding <=> %s::vector
-                LIMIT %s
-            """, (emb_str, emb_str, top_k))
-
-            results = cur.fetchall()
-            cur.close()
-            conn.close()
+            if self.vector_index is not None:
+                results = self._search_in_memory(query_embedding, top_k)
+            else:
+                results = self._search_postgres(query_embedding, top_k)
 
             if not results:
                 return "Релевантная информация не найдена."
@@ -64,9 +64,84 @@ class RAGAgent:
             logger.error(f"Ошибка поиска: {str(e)}", exc_info=True)
             return "Ошибка при поиске информации."
 
+    def _search_in_memory(self, query_embedding: List[float], top_k: int) -> List[Tuple[str, str, float]]:
+        check_deadline()
+        try:
+            return self.vector_index.search(query_embedding, top_k)
+        except Exception as e:
+            logger.warning(f"In-memory индекс недоступен, поиск через Postgres: {str(e)}")
+            return self._search_postgres(query_embedding, top_k)
+
+    def _search_postgres(self, query_embedding: List[float], top_k: int) -> List[Tuple[str, str, float]]:
+        emb_str = to_vector_literal(query_embedding)
+
+        with pooled_connection() as conn, cancellable(conn.cancel), conn.cursor() as cur:
+            if self.storage == "vector":
+                cur.execute("""
+                    SELECT
+                        content,
+                        content_type,
+                        1 - (embedding <=> %s::vector) as similarity
+                    FROM knowledge_base
+                    ORDER BY embedding <=> %s::vector
+                    LIMIT %s
+                """, (emb_str, emb_str, top_k))
+
+            elif self.storage == "halfvec":
+                cur.execute("""
+                    SELECT
+                        content,
+                        content_type,
+                        1 - (embedding_half <=> %s::halfvec) as similarity
+                    FROM knowledge_base
+                    ORDER BY embedding_half <=> %s::halfvec
+                    LIMIT %s
+                """, (emb_str, emb_str, top_k))
+
+            else:
+                # Отбор кандидатов по расстоянию Хэмминга, затем точное переранжирование по halfvec
+                cur.execute("""
+                    SELECT
+                        content,
+                        content_type,
+                        1 - (embedding_half <=> %s::halfvec) as similarity
+                    FROM (
+                        SELECT content, content_type, embedding_half
+                        FROM knowledge_base
+                        ORDER BY binary_quantize(embedding_half)::bit(1536) <~> binary_quantize(%s::halfvec)
+                        LIMIT %s
+                    ) candidates
+                    ORDER BY embedding_half <=> %s::halfvec
+                    LIMIT %s
+                """, (emb_str, emb_str, top_k * self.binary_rerank_factor, emb_str, top_k))
+
+            results = cur.fetchall()
+
+        return results
+
     def _create_embedding(self, text: str) -> List[float]:
-        response = self.client.embeddings.create(
-            model="text-embedding-3-small",
+        key = text.strip()
+        with self._embeddings_lock:
+            if key in self._embeddings:
+                self._embeddings.move_to_end(key)
+                return self._embeddings[key]
+
+        response = self.llm.embedding(
+            model=EMBEDDING_MODEL,
             input=text
         )
-        return response.data[0].embedding
+        embedding = response.data[0].embedding
+
+        with self._embeddings_lock:
+            self._embeddings[key] = embedding
+            while len(self._embeddings) > EMBEDDING_CACHE_SIZE:
+                self._embeddings.popitem(last=False)
+        return embedding
+
+    def prime_embeddings(self, queries: Iterable[str]) -> int:
+        # Прогрев: частые запросы сразу попадают в кэш, заодно открывается соединение к OpenAI
+        primed = 0
+        for query in queries:
+            self._create_embedding(query)
+            primed += 1
+        return primed
@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+from functools import lru_cache, wraps
+from pathlib import Path
+from dotenv import load_dotenv
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+load_dotenv()
+
+# Общие для процесса ресурсы агентов: шлюз к OpenAI, промпты и вспомогательные агенты.
+# Создаются один раз, а на каждую сессию приходится только история диалога.
+
+PROMPTS_DIR = Path(__file__).parent / "prompts"
+
+
+def process_singleton(factory):
+    # lru_cache под блокировкой: фоновый прогрев (agents/warmup.py) и первый запрос
+    # могут обратиться к ресурсу одновременно, а создаться он должен один раз
+    cached = lru_cache(maxsize=1)(factory)
+    lock = threading.Lock()
+
+    @wraps(factory)
+    def get():
+        with lock:
+            return cached()
+
+    get.cache_clear = cached.cache_clear
+    return get
+
+
+@lru_cache(maxsize=None)
+def load_prompt(name: str) -> str:
+    with open(PROMPTS_DIR / name, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+@process_singleton
+def get_llm_gateway():
+    # Один шлюз на процесс: лимиты запросов и токенов общие для всех агентов и сессий
+    from agents.llm_gateway import LLMGateway
+    return LLMGateway()
+
+
+@process_singleton
+def get_sql_agent():
+    from agents.sql_agent import SQLAgent
+    return SQLAgent()
+
+
+@process_singleton
+def get_rag_agent():
+    from agents.rag_agent import RAGAgent
+    return RAGAgent()
+
+
+@process_singleton
+def get_intent_router():
+    from agents.intent_router import IntentRouter, is_intent_router_enabled
+    return IntentRouter() if is_intent_router_enabled() else None
@@ -2,9 +2,9 @@ import os
 import sys
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
 
 sys.path.append(str(Path(__file__).parent.parent))
+from agents.resources import get_llm_gateway, load_prompt
 from utils.logger import setup_logger
 
 load_dotenv()
@@ -17,18 +17,15 @@ class SQLAgent:
         self.model = os.getenv("SQL_MODEL", "gpt-4o")
         self.temperature = float(os.getenv("SQL_TEMPERATURE", "0.0"))
 
-        prompt_path = Path(__file__).parent / "prompts" / "sql_picker_ai.txt"
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            self.system_prompt = f.read()
-
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.system_prompt = load_prompt("sql_picker_ai.txt")
+        self.llm = get_llm_gateway()
 
     def generate_sql(self, query_description: str) -> str:
         logger.info(f"Генерация sql для запроса: {query_description}")
         logger.info(f"Использование OpenAI модели: {self.model}")
 
         try:
-            response = self.client.chat.completions.create(
+            response = self.llm.chat_completion(
                 model=self.model,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from agents.resources import get_intent_router, get_llm_gateway, get_rag_agent, get_sql_agent, load_prompt
+from utils.logger import setup_logger
+
+logger = setup_logger('warmup', 'logs/warmup.log')
+
+# Прогрев процесса при старте UI или сервиса, чтобы первый вопрос пользователя не платил за
+# импорт openai/plotly/duckdb, создание клиентов, соединения с Postgres и загрузку векторного индекса.
+# Каждый шаг независим: ошибка одного (нет снимка, недоступен OpenAI) не мешает остальным.
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+# Частые формулировки для поиска по базе знаний, через ";"
+WARMUP_QUERIES = [
+    query.strip() for query in os.getenv("WARMUP_QUERIES", "продажи по регионам;самые продаваемые препараты").split(";")
+    if query.strip()
+]
+PROMPTS = ("basic_ai.txt", "planner_ai.txt", "sql_picker_ai.txt")
+
+_thread: Optional[threading.Thread] = None
+_timings: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def _warm_agents():
+    for name in PROMPTS:
+        load_prompt(name)
+    get_llm_gateway()
+    get_sql_agent()
+    get_rag_agent()
+    router = get_intent_router()
+    if router is not None:
+        # Справочники роутера грузятся здесь, а не на первом вопросе
+        router.refresh()
+
+
+def _warm_database():
+    from database.connection import get_pool
+
+    # Сразу открываем DB_POOL_MIN соединений и проверяем каждое
+    pool = get_pool()
+    connections = [pool.getconn() for _ in range(max(1, pool.minconn))]
+    try:
+        for conn in connections:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+    finally:
+        for conn in connections:
+            pool.putconn(conn)
+
+
+def _warm_vector_index():
+    from tools.vector_index import get_vector_index, is_vector_index_enabled
+
+    if is_vector_index_enabled():
+        get_vector_index().refresh()
+
+
+def _warm_duckdb():
+    from tools.analytics_engine import is_duckdb_enabled, snapshot_is_fresh
+
+    # Открывает снимок в DuckDB и сразу сверяет его с Postgres
+    if is_duckdb_enabled():
+        snapshot_is_fresh()
+
+
+def _warm_plotly():
+    import plotly.express  # noqa: F401
+    import plotly.io  # noqa: F401
+
+
+def _warm_embeddings():
+    get_rag_agent().prime_embeddings(WARMUP_QUERIES)
+
+
+STEPS: List[tuple] = [
+    ("agents", _warm_agents),
+    ("database", _warm_database),
+    ("vector_index", _warm_vector_index),
+    ("duckdb", _warm_duckdb),
+    ("plotly", _warm_plotly),
+    ("embeddings", _warm_embeddings),
+]
+
+
+def warm_up(steps: Optional[List[tuple]] = None) -> Dict[str, float]:
+    timings = {}
+    started = time.perf_counter()
+    for name, step in steps or STEPS:
+        step_started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"Прогрев {name} не удался: {str(e)}")
+            continue
+        timings[name] = round((time.perf_counter() - step_started) * 1000, 1)
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Прогрев завершен: {timings}")
+    with _lock:
+        _timings.update(timings)
+    return timings
+
+
+def start_background_warmup() -> Optional[threading.Thread]:
+    # Идемпотентно: повторные вызовы (новые сессии Streamlit, перезапуск скрипта) не запускают прогрев заново
+    global _thread
+
+    if not WARMUP_ENABLED:
+        return None
+
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=warm_up, name="warmup", daemon=True)
+            _thread.start()
+    return _thread
+
+
+def warmup_status() -> Dict[str, object]:
+    with _lock:
+        running = _thread is not None and _thread.is_alive()
+        return {"enabled": WARMUP_ENABLED, "running": running, "timings": dict(_timings)}
@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import uuid
+import asyncio
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from agents.conversational_agent import ConversationalAgent
+from agents.resources import get_intent_router, get_llm_gateway, get_rag_agent, get_sql_agent
+from agents.warmup import start_background_warmup, warmup_status
+from database.session_store import TRANSCRIPT, get_session_store, session_limits
+from tools.approximate import get_refinement, persist_refinements
+from tools.export import EXPORT_FORMATS, MEDIA_TYPES, iter_export
+from tools.result_store import get_result_store
+from tools.visualizer import figure_to_dict
+from utils.logger import setup_logger
+
+logger = setup_logger('api_server', 'logs/api_server.log')
+
+# Сколько ходов агента одновременно выполняет один процесс сервиса
+MAX_CONCURRENCY = int(os.getenv("AGENT_MAX_CONCURRENCY", "8"))
+# Сколько сессий держать поднятыми в памяти; остальные подгружаются из хранилища по требованию
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "256"))
+# Потоки для коротких вызовов вне хода (страницы результатов, история, очистка сессий),
+# чтобы они не ждали в очереди за длинными ходами агента
+IO_WORKERS = int(os.getenv("API_IO_WORKERS", "4"))
+EXPIRE_INTERVAL_SECONDS = 3600
+
+app = FastAPI(title="Pharmacy Analytics Agent API")
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="agent")
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="api-io")
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+class ChatRequest(BaseModel):
+    message: str
+    # None - режим по умолчанию из APPROX_MODE
+    approximate: Optional[bool] = None
+    # None - TURN_TIMEOUT_SECONDS
+    timeout_seconds: Optional[float] = None
+
+
+# На сессию хранится только история: клиенты, промпты и пулы общие для процесса
+class Session:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.store = get_session_store()
+        self.agent = ConversationalAgent(session_id=session_id, store=self.store)
+        # Без постоянного хранилища (SESSION_STORE=memory) транскрипт для UI живет здесь
+        self.transcript: List[Dict[str, Any]] = []
+        self.lock = asyncio.Lock()
+
+    def record(self, messages: List[Dict[str, Any]]):
+        if self.store is not None:
+            self.store.append(self.session_id, TRANSCRIPT, self.agent.turn, messages)
+        else:
+            self.transcript.extend(messages)
+            self.transcript = self.transcript[-2 * session_limits()["max_turns"]:]
+
+    def replace_answer(self, turn: int, message: Dict[str, Any]):
+        # Без хранилища транскрипт держит тот же словарь сообщения, он уже обновлен на месте
+        if self.store is not None:
+            self.store.replace_last(self.session_id, TRANSCRIPT, turn, message)
+
+    def load_transcript(self, max_turns: int) -> List[Dict[str, Any]]:
+        if self.store is not None:
+            return self.store.load_recent(self.session_id, TRANSCRIPT, max_turns)
+        return self.transcript[-2 * max_turns:]
+
+
+_sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+
+async def _get_session(session_id: str) -> Session:
+    session = _sessions.get(session_id)
+    if session is None:
+        # Агент при создании читает историю из хранилища сессий: это блокирующий I/O, поэтому не в цикле событий
+        created = await asyncio.get_running_loop().run_in_executor(_io_executor, Session, session_id)
+        # Пока сессия строилась, ее мог поднять параллельный запрос: оставляем одну, чтобы блокировка была общей
+        session = _sessions.get(session_id)
+        if session is None:
+            session = _sessions[session_id] = created
+
+        # Вытесняем давно не использованные сессии, которые сейчас не заняты ходом
+        for stale_id in list(_sessions.keys()):
+            if len(_sessions) <= SESSION_CACHE_SIZE:
+                break
+            if stale_id != session_id and not _sessions[stale_id].lock.locked():
+                del _sessions[stale_id]
+
+    _sessions.move_to_end(session_id)
+    return session
+
+
+def _serialize_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "response": result["response"],
+        "figures": [figure_to_dict(fig) for fig in result.get("figures", [])],
+        "metrics": result.get("metrics", {}),
+        "tables": result.get("tables", []),
+        "cancelled": result.get("cancelled", False),
+        "approximate": result.get("approximate", False),
+        "refinements": result.get("refinements", [])
+    }
+
+
+async def _run_turn(
+    session: Session,
+    message: str,
+    on_event=None,
+    approximate: Optional[bool] = None,
+    timeout: Optional[float] = None
+) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    async with session.lock, _semaphore:
+        future = loop.run_in_executor(
+            _executor, partial(session.agent.chat, message, on_event, approximate=approximate, timeout=timeout)
+        )
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Клиент ушел: прерываем SQL и ожидание LLM, иначе поток пула работал бы впустую.
+            # Блокировку сессии держим, пока поток агента не вышел: иначе следующий ход
+            # менял бы ту же историю одновременно с ним
+            session.agent.cancel()
+            await asyncio.wait({future})
+            raise
+
+        payload = _serialize_result(result)
+        turn = session.agent.turn
+        answer = {"role": "assistant", "content": payload["response"], "figures": list(payload["figures"]), "tables": payload["tables"]}
+        await loop.run_in_executor(_executor, session.record, [{"role": "user", "content": message}, answer])
+        # Точные результаты уточняют сохраненный ответ по мере готовности, независимо от того, ждет ли их клиент
+        persist_refinements(payload["refinements"], answer, partial(session.replace_answer, turn))
+    return payload
+
+
+async def _expire_sessions():
+    loop = asyncio.get_running_loop()
+    idle_seconds = session_limits()["idle_seconds"]
+    while True:
+        await asyncio.sleep(EXPIRE_INTERVAL_SECONDS)
+        store = get_session_store()
+        if store is not None:
+            try:
+                await loop.run_in_executor(_io_executor, store.expire_idle, idle_seconds)
+            except Exception as e:
+                logger.error(f"Ошибка очистки сессий: {str(e)}", exc_info=True)
+
+
+@app.on_event("startup")
+async def startup():
+    # Общие ресурсы создаются при старте, а не на первом запросе пользователя
+    get_sql_agent()
+    get_rag_agent()
+    get_intent_router()
+    get_session_store()
+    # Соединения с Postgres, векторный индекс, DuckDB, plotly и кэш эмбеддингов - в фоне
+    start_background_warmup()
+    asyncio.create_task(_expire_sessions())
+    logger.info(f"API сервис запущен, параллельных ходов: {MAX_CONCURRENCY}")
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "sessions": len(_sessions), "llm": get_llm_gateway().metrics(), "warmup": warmup_status()}
+
+
+@app.post("/sessions")
+def create_session():
+    session_id = uuid.uuid4().hex
+    return {"session_id": session_id}
+
+
+@app.post("/sessions/{session_id}/chat")
+async def chat(session_id: str, request: ChatRequest):
+    logger.info(f"Сессия {session_id}: новое сообщение")
+    return await _run_turn(
+        await _get_session(session_id), request.message, approximate=request.approximate, timeout=request.timeout_seconds
+    )
+
+
+@app.post("/sessions/{session_id}/chat/stream")
+async def chat_stream(session_id: str, request: ChatRequest):
+    session = await _get_session(session_id)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def on_event(event: Dict[str, Any]):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    async def run():
+        try:
+            payload = await _run_turn(session, request.message, on_event, request.approximate, request.timeout_seconds)
+            await queue.put({"type": "result", **payload})
+        except Exception as e:
+            logger.error(f"Ошибка хода в сессии {session_id}: {str(e)}", exc_info=True)
+            await queue.put({"type": "error", "error": str(e)})
+
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event = await queue.get()
+                yield f"data: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+                if event["type"] in ("result", "error"):
+                    break
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/sessions/{session_id}/cancel")
+def cancel_turn(session_id: str):
+    session = _sessions.get(session_id)
+    if session is not None:
+        session.agent.cancel()
+    return {"status": "cancelled" if session is not None else "not_found"}
+
+
+@app.get("/refinements/{refinement_id}")
+def refinement(refinement_id: str):
+    # Точный результат для приблизительного ответа: клиент опрашивает, пока status == pending
+    result = get_refinement(refinement_id)
+    if result.get("figure") is not None:
+        result["figure"] = figure_to_dict(result["figure"])
+    return result
+
+
+RESULT_NOT_FOUND = "Результат больше не хранится, повторите вопрос"
+
+
+@app.get("/results/{result_id}")
+async def result_page(
+    result_id: str, offset: int = 0, limit: int = 50, sort: str = "", desc: bool = False, q: str = "",
+    x_session_id: Optional[str] = Header(None)
+):
+    # Страница сохраненного результата: сортировка и фильтр на сервере, без повторного вызова LLM.
+    # Чужой результат неотличим от удаленного
+    loop = asyncio.get_running_loop()
+    store = get_result_store()
+    if not await loop.run_in_executor(_io_executor, store.owns, result_id, x_session_id):
+        raise HTTPException(status_code=404, detail=RESULT_NOT_FOUND)
+    try:
+        return await loop.run_in_executor(
+            _io_executor, partial(store.page, result_id, offset, limit, sort or None, desc, q or None)
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail=RESULT_NOT_FOUND)
+
+
+@app.get("/results/{result_id}/export")
+def export_result(result_id: str, format: str = "csv", session_id: str = ""):
+    # Полный результат заново из Postgres потоком: ни сервис, ни клиент не держат его целиком в памяти.
+    # Ссылку открывает браузер, поэтому сессия передается параметром, а не заголовком
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Формат выгрузки: {', '.join(EXPORT_FORMATS)}")
+    store = get_result_store()
+    try:
+        if not store.owns(result_id, session_id):
+            raise KeyError(result_id)
+        query = store.query(result_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=RESULT_NOT_FOUND)
+
+    return StreamingResponse(
+        iter_export(query["sql"], query["params"], format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="result_{result_id[:8]}.{format}"'}
+    )
+
+
+@app.get("/sessions/{session_id}/history")
+async def history(session_id: str, turns: int = 0):
+    loop = asyncio.get_running_loop()
+    max_turns = turns or session_limits()["resume_turns"]
+    session = _sessions.get(session_id)
+    store = get_session_store()
+    if session is not None:
+        messages = await loop.run_in_executor(_io_executor, session.load_transcript, max_turns)
+    elif store is not None:
+        # Для чтения транскрипта агент не нужен: сессию поднимет первый ход
+        messages = await loop.run_in_executor(_io_executor, store.load_recent, session_id, TRANSCRIPT, max_turns)
+    else:
+        messages = []
+    return {"messages": messages}
+
+
+@app.delete("/sessions/{session_id}")
+async def clear_session(session_id: str):
+    session = _sessions.get(session_id)
+    if session is not None:
+        async with session.lock:
+            session.agent.clear_history()
+            session.transcript = []
+        _sessions.pop(session_id, None)
+    else:
+        # Сессия не поднята в памяти: удаляем сразу из хранилища, не загружая историю и не создавая агента
+        store = get_session_store()
+        if store is not None:
+            await asyncio.get_running_loop().run_in_executor(_io_executor, store.clear, session_id)
+    return {"status": "cleared"}
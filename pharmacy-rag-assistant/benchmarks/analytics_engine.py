@@ -0,0 +1,164 @@
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+import duckdb
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import get_connection
+
+# DuckDB поверх Parquet против Postgres на синтетических sales из 10M-100M строк.
+# Данные генерирует сам DuckDB, в Postgres они попадают через COPY в отдельную таблицу sales_bench.
+
+REGIONS = ["Алматы", "Астана", "Шымкент", "Павлодар", "Костанай", "Актобе", "Караганда", "Атырау"]
+CATEGORIES = ["Антибиотики", "Витамины", "Обезболивающие", "Жаропонижающие", "Противовирусные", "Антигистаминные"]
+
+QUERIES = {
+    "топ-10 препаратов за год": """
+        SELECT product, ROUND(SUM(revenue), 2) AS total_revenue, SUM(units_sold) AS total_units
+        FROM {table}
+        WHERE date >= '2024-01-01' AND date < '2025-01-01'
+        GROUP BY product
+        ORDER BY total_revenue DESC
+        LIMIT 10
+    """,
+    "выручка по регионам": """
+        SELECT region, ROUND(SUM(revenue), 2) AS total_revenue, COUNT(DISTINCT pharmacy) AS pharmacy_count
+        FROM {table}
+        GROUP BY region
+        ORDER BY total_revenue DESC
+    """,
+    "динамика категории по месяцам": """
+        SELECT DATE_TRUNC('month', date) AS month, ROUND(SUM(revenue), 2) AS monthly_revenue
+        FROM {table}
+        WHERE category = 'Витамины'
+        GROUP BY DATE_TRUNC('month', date)
+        ORDER BY month
+    """,
+    "сравнение двух лет": """
+        SELECT
+            ROUND(SUM(revenue) FILTER (WHERE date >= '2023-01-01' AND date < '2024-01-01'), 2) AS revenue_2023,
+            ROUND(SUM(revenue) FILTER (WHERE date >= '2024-01-01' AND date < '2025-01-01'), 2) AS revenue_2024
+        FROM {table}
+    """,
+    "регион x категория": """
+        SELECT region, category, ROUND(SUM(profit), 2) AS total_profit
+        FROM {table}
+        GROUP BY region, category
+        ORDER BY total_profit DESC
+    """,
+}
+
+
+def generate_parquet(path: Path, rows: int):
+    regions = "[" + ", ".join(f"'{r}'" for r in REGIONS) + "]"
+    categories = "[" + ", ".join(f"'{c}'" for c in CATEGORIES) + "]"
+
+    print(f"Генерация {rows:,} строк в {path}...")
+    started = time.perf_counter()
+    duckdb.sql(f"""
+        COPY (
+            SELECT
+                i::INTEGER AS id,
+                DATE '2022-01-01' + (i % 1096)::INTEGER AS date,
+                {regions}[1 + (hash(i) % {len(REGIONS)})::INTEGER] AS region,
+                'Аптека №' || (1 + hash(i * 7) % 200)::VARCHAR AS pharmacy,
+                {categories}[1 + (hash(i * 13) % {len(CATEGORIES)})::INTEGER] AS category,
+                'Препарат ' || (1 + hash(i * 31) % 150)::VARCHAR AS product,
+                units::INTEGER AS units_sold,
+                price::DECIMAL(10, 2) AS price,
+                (price * 0.6)::DECIMAL(10, 2) AS cost_price,
+                (units * price)::DECIMAL(10, 2) AS revenue,
+                (units * price * 0.4)::DECIMAL(10, 2) AS profit,
+                TIMESTAMP '2025-01-01' AS created_at
+            FROM (
+                SELECT range AS i, 1 + (hash(range * 3) % 20) AS units, 100 + (hash(range * 5) % 5000) / 1.0 AS price
+                FROM range({rows})
+            )
+            ORDER BY date
+        ) TO '{path}' (FORMAT PARQUET, COMPRESSION ZSTD)
+    """)
+    print(f"Готово за {time.perf_counter() - started:.1f} с, {path.stat().st_size / 2**20:.0f} МБ")
+
+
+def load_postgres(path: Path):
+    csv_path = path.with_suffix(".csv")
+    duckdb.sql(f"COPY (SELECT * FROM read_parquet('{path}')) TO '{csv_path}' (HEADER false)")
+
+    conn = get_connection()
+    cur = conn.cursor()
+    print("Загрузка в Postgres (sales_bench)...")
+    started = time.perf_counter()
+    cur.execute("DROP TABLE IF EXISTS sales_bench")
+    cur.execute("CREATE TABLE sales_bench (LIKE sales INCLUDING DEFAULTS)")
+    with open(csv_path, "r", encoding="utf-8") as f:
+        cur.copy_expert("COPY sales_bench FROM STDIN WITH (FORMAT csv)", f)
+    cur.execute("CREATE INDEX ON sales_bench(date)")
+    cur.execute("CREATE INDEX ON sales_bench(category)")
+    conn.commit()
+    cur.execute("ANALYZE sales_bench")
+    conn.commit()
+    cur.close()
+    conn.close()
+    csv_path.unlink()
+    print(f"Готово за {time.perf_counter() - started:.1f} с")
+
+
+def time_query(run, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк DuckDB/Parquet против Postgres")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--path", default="data/snapshots/sales_bench.parquet")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-postgres", action="store_true")
+    parser.add_argument("--reuse", action="store_true", help="не генерировать данные заново")
+    args = parser.parse_args()
+
+    path = Path(args.path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not (args.reuse and path.exists()):
+        generate_parquet(path, args.rows)
+        if not args.skip_postgres:
+            load_postgres(path)
+
+    db = duckdb.connect()
+    db.execute(f"CREATE VIEW sales_bench AS SELECT * FROM read_parquet('{path}')")
+
+    if not args.skip_postgres:
+        conn = get_connection()
+        cur = conn.cursor()
+
+    print(f"\n{'запрос':<32}{'DuckDB, мс':>12}{'Postgres, мс':>15}{'ускорение':>12}")
+    for name, sql in QUERIES.items():
+        query = sql.format(table="sales_bench")
+        duck_ms = time_query(lambda: db.execute(query).fetchall(), args.repeat)
+
+        if args.skip_postgres:
+            print(f"{name:<32}{duck_ms:>12.0f}")
+            continue
+
+        def run_pg():
+            cur.execute(query)
+            cur.fetchall()
+
+        pg_ms = time_query(run_pg, args.repeat)
+        print(f"{name:<32}{duck_ms:>12.0f}{pg_ms:>15.0f}{pg_ms / duck_ms:>11.1f}x")
+
+    if not args.skip_postgres:
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
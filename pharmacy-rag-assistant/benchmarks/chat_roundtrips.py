@@ -0,0 +1,65 @@
+import os
+import sys
+import argparse
+import statistics
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+# Сравнение режимов исполнения ConversationalAgent: число запросов к LLM и задержка на ход.
+# Требует OPENAI_API_KEY и заполненную базу.
+
+DEFAULT_QUESTIONS = [
+    "Покажи топ-10 препаратов по продажам за 2024 год",
+    "Построй график продаж витаминов по месяцам",
+    "Сравни выручку по регионам за 2024 год",
+    "Какая средняя выручка на аптеку в Алматы?",
+    "Как менялась доля антибиотиков в выручке по кварталам?",
+]
+
+
+def run_mode(mode: str, questions, fast_path: bool):
+    os.environ["CHAT_EXECUTION_MODE"] = mode
+    os.environ["INTENT_ROUTER_ENABLED"] = "true" if fast_path else "false"
+
+    from agents.conversational_agent import ConversationalAgent
+    from agents.resources import get_intent_router
+    get_intent_router.cache_clear()
+
+    rows = []
+    for question in questions:
+        agent = ConversationalAgent()
+        result = agent.chat(question)
+        metrics = result.get("metrics", {})
+        rows.append((question, metrics.get("mode", mode), metrics.get("llm_calls"), metrics.get("latency_ms")))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Число запросов к LLM и задержка на ход по режимам")
+    parser.add_argument("--modes", nargs="+", default=["classic", "single_round"])
+    parser.add_argument("--fast-path", action="store_true", help="включить быстрый путь без LLM")
+    parser.add_argument("questions", nargs="*")
+    args = parser.parse_args()
+
+    questions = args.questions or DEFAULT_QUESTIONS
+
+    summary = {}
+    for mode in args.modes:
+        print(f"\n=== {mode} ===")
+        rows = run_mode(mode, questions, args.fast_path)
+        for question, actual_mode, llm_calls, latency in rows:
+            print(f"{actual_mode:<13}{llm_calls!s:>4} LLM  {latency!s:>7} мс  {question}")
+        summary[mode] = rows
+
+    print("\n=== итог ===")
+    for mode, rows in summary.items():
+        calls = [r[2] for r in rows if r[2] is not None]
+        latencies = [r[3] for r in rows if r[3] is not None]
+        if calls and latencies:
+            print(f"{mode:<13} LLM запросов на ход: {statistics.mean(calls):.1f}, "
+                  f"задержка p50: {statistics.median(latencies):.0f} мс, max: {max(latencies)} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path.append(str(ROOT))
+
+# Холодный старт: время импорта модулей и время до первого ответа в свежем процессе,
+# без прогрева и с прогревом (agents/warmup.py). Каждое измерение - отдельный процесс python,
+# иначе кэш импортов и синглтоны от предыдущего прогона исказят результат.
+# Импорты меряются без базы и OpenAI; первый ответ требует OPENAI_API_KEY и заполненную базу.
+
+IMPORT_MODULES = [
+    "agents.conversational_agent",
+    "api.server",
+    "ui.api_client",
+    "tools.visualizer",
+    "tools.sql_executor",
+]
+DEFAULT_QUESTION = "Покажи топ-10 препаратов по продажам за 2024 год"
+
+
+def child_import(module: str) -> dict:
+    started = time.perf_counter()
+    __import__(module)
+    return {"import_ms": (time.perf_counter() - started) * 1000}
+
+
+def child_answer(question: str, warm: bool) -> dict:
+    timings = {}
+    started = time.perf_counter()
+    from agents.conversational_agent import ConversationalAgent
+    timings["import_ms"] = (time.perf_counter() - started) * 1000
+
+    if warm:
+        from agents.warmup import warm_up
+        step = time.perf_counter()
+        timings["warmup_steps"] = warm_up()
+        timings["warmup_ms"] = (time.perf_counter() - step) * 1000
+
+    # Время до первого ответа считается с момента, когда пользователь открыл сессию
+    step = time.perf_counter()
+    agent = ConversationalAgent()
+    timings["agent_init_ms"] = (time.perf_counter() - step) * 1000
+    agent.chat(question)
+    timings["first_answer_ms"] = (time.perf_counter() - step) * 1000
+
+    step = time.perf_counter()
+    ConversationalAgent().chat(question)
+    timings["second_answer_ms"] = (time.perf_counter() - step) * 1000
+    return timings
+
+
+def run_child(*args: str) -> dict:
+    env = dict(os.environ, WARMUP_ENABLED="false")
+    output = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), "--child", *args],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def heaviest_imports(module: str, top: int) -> list:
+    # -X importtime пишет в stderr накопленное время каждого модуля, мкс
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line.split(":", 1)[1].split("|"))
+        if "." not in name.strip():
+            rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def median(values) -> str:
+    return f"{statistics.median(values):.0f}" if values else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта и время до первого ответа в свежем процессе")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--question", default=DEFAULT_QUESTION)
+    parser.add_argument("--skip-answer", action="store_true", help="только импорты, без базы и OpenAI")
+    parser.add_argument("--top-imports", type=int, default=10, help="самые тяжелые пакеты при импорте агента")
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, value = args.child[0], args.child[1]
+        if kind == "import":
+            result = child_import(value)
+        else:
+            result = child_answer(value, warm=kind == "warm")
+        print(json.dumps(result, default=str))
+        return
+
+    print(f"=== импорт (медиана из {args.runs}, мс) ===")
+    for module in IMPORT_MODULES:
+        try:
+            times = [run_child("import", module)["import_ms"] for _ in range(args.runs)]
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<32} ошибка: {e.stderr.strip().splitlines()[-1] if e.stderr else e}")
+            continue
+        print(f"{module:<32}{median(times):>8}")
+
+    print(f"\n=== самые тяжелые пакеты в agents.conversational_agent (мс) ===")
+    for cumulative, name in heaviest_imports("agents.conversational_agent", args.top_imports):
+        print(f"{name:<32}{cumulative:>8.0f}")
+
+    if args.skip_answer:
+        return
+
+    print(f"\n=== до первого ответа (медиана из {args.runs}, мс): {args.question} ===")
+    fields = ["import_ms", "warmup_ms", "agent_init_ms", "first_answer_ms", "second_answer_ms"]
+    print(f"{'':<10}" + "".join(f"{field:>18}" for field in fields))
+    for kind in ("cold", "warm"):
+        runs = [run_child(kind, args.question) for _ in range(args.runs)]
+        print(f"{kind:<10}" + "".join(f"{median([r[f] for r in runs if f in r]):>18}" for f in fields))
+        if kind == "warm":
+            steps = runs[-1].get("warmup_steps", {})
+            print(f"{'':<10}шаги прогрева: " + ", ".join(f"{name} {ms:.0f}" for name, ms in steps.items()))
+
+
+if __name__ == "__main__":
+    main()
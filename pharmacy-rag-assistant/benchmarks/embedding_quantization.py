@@ -0,0 +1,146 @@
+import sys
+import io
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import get_connection
+from database.embeddings import EMBEDDING_DIM, to_vector_literal
+
+# Сравнение vector / halfvec / binary (+ переранжирование) по размеру индекса и recall@k.
+# Точный ответ считается в NumPy по float32, поэтому recall меряет именно потери от квантования и HNSW.
+
+VARIANTS = {
+    "vector": {
+        "column": "embedding vector({dim})",
+        "index": "USING hnsw (embedding vector_cosine_ops)",
+        "query": """
+            SELECT id FROM {table}
+            ORDER BY embedding <=> %(q)s::vector
+            LIMIT %(k)s
+        """,
+    },
+    "halfvec": {
+        "column": "embedding halfvec({dim})",
+        "index": "USING hnsw (embedding halfvec_cosine_ops)",
+        "query": """
+            SELECT id FROM {table}
+            ORDER BY embedding <=> %(q)s::halfvec
+            LIMIT %(k)s
+        """,
+    },
+    "binary": {
+        "column": "embedding halfvec({dim})",
+        "index": "USING hnsw ((binary_quantize(embedding)::bit({dim})) bit_hamming_ops)",
+        "query": """
+            SELECT id FROM (
+                SELECT id, embedding FROM {table}
+                ORDER BY binary_quantize(embedding)::bit({dim}) <~> binary_quantize(%(q)s::halfvec)
+                LIMIT %(candidates)s
+            ) candidates
+            ORDER BY embedding <=> %(q)s::halfvec
+            LIMIT %(k)s
+        """,
+    },
+}
+
+
+def load_vectors(cur, rows: int, source: str) -> np.ndarray:
+    if source == "knowledge_base":
+        cur.execute("SELECT embedding FROM knowledge_base WHERE embedding IS NOT NULL ORDER BY id LIMIT %s", (rows,))
+        vectors = [np.array(r[0].strip("[]").split(","), dtype=np.float32) for r in cur.fetchall()]
+        if not vectors:
+            raise RuntimeError("knowledge_base пуста, используйте --source synthetic")
+        return np.vstack(vectors)
+
+    rng = np.random.default_rng(42)
+    # Кластеры ближе к реальным эмбеддингам текстов, чем равномерный шум
+    centers = rng.normal(size=(max(rows // 50, 1), EMBEDDING_DIM)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), rows)] + 0.3 * rng.normal(size=(rows, EMBEDDING_DIM)).astype(np.float32)
+    return vectors
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def build_table(cur, name: str, variant: dict, vectors: np.ndarray):
+    table = f"bench_embeddings_{name}"
+    cur.execute(f"DROP TABLE IF EXISTS {table}")
+    cur.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, {variant['column'].format(dim=EMBEDDING_DIM)})")
+
+    buffer = io.StringIO()
+    for i, vec in enumerate(vectors):
+        buffer.write(f"{i}\t{to_vector_literal(vec.tolist())}\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} (id, embedding) FROM STDIN", buffer)
+
+    started = time.perf_counter()
+    cur.execute(f"CREATE INDEX {table}_idx ON {table} {variant['index'].format(dim=EMBEDDING_DIM)}")
+    build_seconds = time.perf_counter() - started
+
+    cur.execute("SELECT pg_table_size(%s), pg_relation_size(%s)", (table, f"{table}_idx"))
+    table_bytes, index_bytes = cur.fetchone()
+    return table, build_seconds, table_bytes, index_bytes
+
+
+def run_benchmark(rows: int, queries: int, k: int, rerank_factor: int, source: str, keep: bool):
+    conn = get_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    vectors = load_vectors(cur, rows, source)
+    rows = len(vectors)
+    rng = np.random.default_rng(7)
+    query_vectors = vectors[rng.integers(0, rows, queries)] + 0.05 * rng.normal(size=(queries, EMBEDDING_DIM)).astype(np.float32)
+
+    truth = np.argsort(-(normalize(query_vectors) @ normalize(vectors).T), axis=1)[:, :k]
+
+    print(f"Векторов: {rows}, запросов: {queries}, k={k}, кандидатов для binary: {k * rerank_factor}\n")
+    print(f"{'формат':<10}{'таблица, МБ':>14}{'индекс, МБ':>13}{'байт/вектор':>14}{'сборка, с':>12}{'p50, мс':>10}{'recall@k':>11}")
+
+    for name, variant in VARIANTS.items():
+        table, build_seconds, table_bytes, index_bytes = build_table(cur, name, variant, vectors)
+        cur.execute("SET hnsw.ef_search = %s", (max(40, k * rerank_factor),))
+
+        hits = 0
+        latencies = []
+        for qi, query in enumerate(query_vectors):
+            params = {"q": to_vector_literal(query.tolist()), "k": k, "candidates": k * rerank_factor}
+            started = time.perf_counter()
+            cur.execute(variant["query"].format(table=table, dim=EMBEDDING_DIM), params)
+            found = [r[0] for r in cur.fetchall()]
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(set(found) & set(truth[qi].tolist()))
+
+        recall = hits / (queries * k)
+        print(f"{name:<10}{table_bytes / 2**20:>14.2f}{index_bytes / 2**20:>13.2f}"
+              f"{(table_bytes + index_bytes) / rows:>14.0f}{build_seconds:>12.2f}"
+              f"{np.median(latencies):>10.2f}{recall:>11.3f}")
+
+        if not keep:
+            cur.execute(f"DROP TABLE {table}")
+
+    # Для сравнения: сколько займет in-memory индекс (tools/vector_index.py)
+    print(f"\nIn-memory NumPy индекс: float32 {rows * EMBEDDING_DIM * 4 / 2**20:.2f} МБ, "
+          f"float16 {rows * EMBEDDING_DIM * 2 / 2**20:.2f} МБ")
+
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк квантованного хранения эмбеддингов в pgvector")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=10)
+    parser.add_argument("--source", choices=["synthetic", "knowledge_base"], default="synthetic")
+    parser.add_argument("--keep", action="store_true", help="не удалять таблицы бенчмарка")
+    args = parser.parse_args()
+
+    run_benchmark(args.rows, args.queries, args.k, args.rerank_factor, args.source, args.keep)
@@ -1,175 +1,287 @@
 import sys
-import os
 from pathlib import Path
 import json
+import argparse
 
 sys.path.append(str(Path(__file__).parent.parent))
 
-from openai import OpenAI
+from agents.resources import get_llm_gateway
 from database.connection import get_connection
+from database.embeddings import (
+    EMBEDDING_MODEL, STORAGE_TYPES, embedding_column, embedding_type, get_embedding_storage, to_vector_literal
+)
+from data.load_data import UnknownBatchError, load_changes
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Все срезы считаются одним проходом по sales через GROUPING SETS, строки идут из серверного
+# курсора в форматтер по мере чтения: память не растет с числом срезов и документов.
+# Срезы *_month документами не становятся, а копятся по одной сущности в документ динамики.
+
+DIMENSIONS = ("product", "category", "region", "pharmacy", "month")
+SLICES = {
+    "product": ("product", "category"),
+    "region": ("region",),
+    "category": ("category",),
+    "pharmacy": ("pharmacy", "region"),
+    "region_month": ("region", "month"),
+    "product_region": ("product", "category", "region"),
+    "product_month": ("product", "month"),
+    "category_month": ("category", "month"),
+}
+# Срез помесячной выручки -> сущность, по которой строится документ динамики
+TREND_SLICES = {"region_month": "region", "product_month": "product", "category_month": "category"}
+# Ключ сущности -> поле load_changes()
+CHANGE_KEYS = {"product": "products", "region": "regions", "category": "categories", "pharmacy": "pharmacies"}
+
+TREND_MONTHS = 12
+EMBEDDING_BATCH = 64
+STREAM_ITERSIZE = 2000
+
+
+def grouping_mask(columns):
+    # GROUPING(product, category, region, pharmacy, month): бит 1 - колонка не входит в набор,
+    # первый аргумент - старший бит
+    return sum(1 << (len(DIMENSIONS) - 1 - i) for i, name in enumerate(DIMENSIONS) if name not in columns)
+
+
+SLICE_BY_MASK = {grouping_mask(columns): name for name, columns in SLICES.items()}
+
+SLICES_SQL = f"""
+    SELECT
+        GROUPING({", ".join(DIMENSIONS)}) AS grouping_mask,
+        {", ".join(DIMENSIONS)},
+        COUNT(*) AS total_sales,
+        SUM(units_sold) AS total_units,
+        SUM(revenue) AS total_revenue,
+        SUM(profit) AS total_profit,
+        AVG(price) AS avg_price,
+        COUNT(DISTINCT pharmacy) AS num_pharmacies,
+        COUNT(DISTINCT product) AS num_products
+    FROM (
+        SELECT *, TO_CHAR(date, 'YYYY-MM') AS month FROM sales {{where}}
+    ) s
+    GROUP BY GROUPING SETS ({", ".join("(" + ", ".join(columns) + ")" for columns in SLICES.values())})
+    ORDER BY grouping_mask, {", ".join(DIMENSIONS)}
+"""
+
+# Инкрементальный режим: все строки затронутых сущностей, чтобы их агрегаты считались целиком
+CHANGED_FILTER = " OR ".join(f"{key} = ANY(%({field})s)" for key, field in CHANGE_KEYS.items())
+
+
+def format_product(row):
+    content = f"""Продукт: {row['product']}
+Категория: {row['category']}
+Всего продаж: {row['total_sales']}
+Продано единиц: {row['total_units']}
+Общая выручка: {row['total_revenue']:.2f} тг
+Средняя цена: {row['avg_price']:.2f} тг"""
+    return content, {
+        "product": row["product"],
+        "category": row["category"],
+        "total_revenue": float(row["total_revenue"])
+    }
+
+
+def format_region(row):
+    content = f"""Регион: {row['region']}
+Количество аптек: {row['num_pharmacies']}
+Всего продаж: {row['total_sales']}
+Общая выручка: {row['total_revenue']:.2f} тг
+Общая прибыль: {row['total_profit']:.2f} тг"""
+    return content, {
+        "region": row["region"],
+        "num_pharmacies": row["num_pharmacies"],
+        "total_revenue": float(row["total_revenue"])
+    }
+
+
+def format_category(row):
+    content = f"""Категория: {row['category']}
+Количество продуктов: {row['num_products']}
+Продано единиц: {row['total_units']}
+Общая выручка: {row['total_revenue']:.2f} тг
+Средняя цена: {row['avg_price']:.2f} тг"""
+    return content, {
+        "category": row["category"],
+        "num_products": row["num_products"],
+        "total_revenue": float(row["total_revenue"])
+    }
+
+
+def format_pharmacy(row):
+    content = f"""Аптека: {row['pharmacy']}
+Регион: {row['region']}
+Всего продаж: {row['total_sales']}
+Общая выручка: {row['total_revenue']:.2f} тг
+Общая прибыль: {row['total_profit']:.2f} тг"""
+    return content, {
+        "pharmacy": row["pharmacy"],
+        "region": row["region"],
+        "total_revenue": float(row["total_revenue"])
+    }
+
+
+def format_region_month(row):
+    content = f"""Регион: {row['region']}
+Месяц: {row['month']}
+Работающих аптек: {row['num_pharmacies']}
+Всего продаж: {row['total_sales']}
+Продано единиц: {row['total_units']}
+Выручка: {row['total_revenue']:.2f} тг
+Прибыль: {row['total_profit']:.2f} тг"""
+    return content, {
+        "region": row["region"],
+        "month": row["month"],
+        "total_revenue": float(row["total_revenue"])
+    }
+
+
+def format_product_region(row):
+    content = f"""Продукт: {row['product']}
+Категория: {row['category']}
+Регион: {row['region']}
+Аптек с продажами: {row['num_pharmacies']}
+Продано единиц: {row['total_units']}
+Выручка: {row['total_revenue']:.2f} тг
+Средняя цена: {row['avg_price']:.2f} тг"""
+    return content, {
+        "product": row["product"],
+        "category": row["category"],
+        "region": row["region"],
+        "total_revenue": float(row["total_revenue"])
+    }
+
+
+FORMATTERS = {
+    "product": format_product,
+    "region": format_region,
+    "category": format_category,
+    "pharmacy": format_pharmacy,
+    "region_month": format_region_month,
+    "product_region": format_product_region,
+}
+
+TREND_TITLES = {"region": "региона", "product": "продукта", "category": "категории"}
+
+
+def format_trend(entity, name, months):
+    # months - [(месяц, выручка)] по возрастанию месяца
+    recent = months[-TREND_MONTHS:]
+    series = "; ".join(f"{month}: {revenue:.2f} тг" for month, revenue in recent)
+    best_month, best_revenue = max(months, key=lambda item: item[1])
+    average = sum(revenue for _, revenue in months) / len(months)
+    last_month, last_revenue = months[-1]
+
+    content = f"""Динамика выручки {TREND_TITLES[entity]}: {name}
+Период: {months[0][0]} - {last_month}
+По месяцам: {series}
+Последний месяц ({last_month}): {last_revenue:.2f} тг"""
+    if len(months) > 1 and months[-2][1]:
+        change = (last_revenue - months[-2][1]) / months[-2][1] * 100
+        content += f", изменение к предыдущему: {change:+.1f}%"
+    content += f"""
+Лучший месяц: {best_month} ({best_revenue:.2f} тг)
+Среднемесячная выручка: {average:.2f} тг"""
+
+    return content, {
+        entity: name,
+        "months": len(months),
+        "last_month": last_month,
+        "last_revenue": last_revenue
+    }
+
+
+def iter_documents(rows):
+    # Строки отсортированы по срезу, затем по сущности и месяцу: динамика копится только
+    # для текущей сущности и выдается, как только сущность сменилась
+    trend_key, trend_months = None, []
+
+    def flush_trend():
+        slice_name, name = trend_key
+        entity = TREND_SLICES[slice_name]
+        content, metadata = format_trend(entity, name, trend_months)
+        return f"{entity}_trend", content, metadata
+
+    for row in rows:
+        slice_name = SLICE_BY_MASK[row["grouping_mask"]]
+
+        if slice_name in FORMATTERS:
+            content, metadata = FORMATTERS[slice_name](row)
+            yield slice_name, content, metadata
+
+        if slice_name in TREND_SLICES:
+            key = (slice_name, row[TREND_SLICES[slice_name]])
+            if key != trend_key and trend_key is not None:
+                yield flush_trend()
+                trend_months = []
+            trend_key = key
+            trend_months.append((row["month"], float(row["total_revenue"])))
+
+    if trend_key is not None:
+        yield flush_trend()
+
+
+def affected(metadata, changes):
+    # Документ пересчитывается, если хотя бы одна его сущность затронута загрузкой
+    return any(metadata.get(key) in changes[field] for key, field in CHANGE_KEYS.items() if key in metadata)
+
+
+def delete_affected(cur, changes):
+    conditions = " OR ".join(f"metadata->>'{key}' = ANY(%({field})s)" for key, field in CHANGE_KEYS.items())
+    cur.execute(f"DELETE FROM knowledge_base WHERE {conditions}", {field: changes[field] for field in CHANGE_KEYS.values()})
+    return cur.rowcount
+
+
+def generate_knowledge_from_sales(storage=None, since_batch=None):
+    # Изменения читаются до открытия соединения: неизвестный batch_id прерывает генерацию сразу
+    changes = load_changes(since_batch) if since_batch else None
+    if changes is not None and changes["full"]:
+        print("После указанной загрузки была полная замена данных, база знаний пересоздается целиком")
+        changes = None
 
-def generate_knowledge_from_sales():
     conn = get_connection()
     cur = conn.cursor()
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # Через общий шлюз: при генерации сотен эмбеддингов лимиты и 429 обрабатываются там
+    llm = get_llm_gateway()
+    storage = storage or get_embedding_storage()
+    print(f"Хранение эмбеддингов: {storage}")
 
     try:
-        print("Очистка таблицы knowledge_base...")
-        cur.execute("TRUNCATE TABLE knowledge_base RESTART IDENTITY;")
-
-        print(" Генерация знаний о продуктах...")
-        cur.execute("""
-            SELECT
-                product,
-                category,
-                COUNT(*) as total_sales,
-                SUM(units_sold) as total_units,
-                SUM(revenue) as total_revenue,
-                AVG(price) as avg_price
-            FROM sales
-            GROUP BY product, category
-            ORDER BY total_revenue DESC
-        """)
-
-        products = cur.fetchall()
-        for product in products:
-            content = f"""Продукт: {product[0]}
-Категория: {product[1]}
-Всего продаж: {product[2]}
-Продано единиц: {product[3]}
-Общая выручка: {product[4]:.2f} тг
-Средняя цена: {product[5]:.2f} тг"""
-
-            metadata = {
-                "type": "product",
-                "product": product[0],
-                "category": product[1],
-                "total_revenue": float(product[4])
-            }
-
-            embedding = create_embedding(client, content)
-
-            cur.execute("""
-                INSERT INTO knowledge_base (content, content_type, metadata, embedding)
-                VALUES (%s, %s, %s, %s)
-            """, (content, "product", json.dumps(metadata), embedding))
-
-        print(f"Добавлено {len(products)} продуктов")
-
-        print("Генерация знаний о регионах...")
-        cur.execute("""
-            SELECT
-                region,
-                COUNT(DISTINCT pharmacy) as num_pharmacies,
-                COUNT(*) as total_sales,
-                SUM(revenue) as total_revenue,
-                SUM(profit) as total_profit
-            FROM sales
-            GROUP BY region
-            ORDER BY total_revenue DESC
-        """)
-
-        regions = cur.fetchall()
-        for region in regions:
-            content = f"""Регион: {region[0]}
-Количество аптек: {region[1]}
-Всего продаж: {region[2]}
-Общая выручка: {region[3]:.2f} тг
-Общая прибыль: {region[4]:.2f} тг"""
-
-            metadata = {
-                "type": "region",
-                "region": region[0],
-                "num_pharmacies": region[1],
-                "total_revenue": float(region[3])
-            }
-
-            embedding = create_embedding(client, content)
-
-            cur.execute("""
-                INSERT INTO knowledge_base (content, content_type, metadata, embedding)
-                VALUES (%s, %s, %s, %s)
-            """, (content, "region", json.dumps(metadata), embedding))
-
-        print(f"Добавлено {len(regions)} регионов")
-
-        print("\nГенерация знаний о категориях...")
-        cur.execute("""
-            SELECT
-                category,
-                COUNT(DISTINCT product) as num_products,
-                SUM(units_sold) as total_units,
-                SUM(revenue) as total_revenue,
-                AVG(price) as avg_price
-            FROM sales
-            GROUP BY category
-            ORDER BY total_revenue DESC
-        """)
-
-        categories = cur.fetchall()
-        for category in categories:
-            content = f"""Категория: {category[0]}
-Количество продуктов: {category[1]}
-Продано единиц: {category[2]}
-Общая выручка: {category[3]:.2f} тг
-Средняя цена: {category[4]:.2f} тг"""
-
-            metadata = {
-                "type": "category",
-                "category": category[0],
-                "num_products": category[1],
-                "total_revenue": float(category[3])
-            }
-
-            embedding = create_embedding(client, content)
-
-            cur.execute("""
-                INSERT INTO knowledge_base (content, content_type, metadata, embedding)
-                VALUES (%s, %s, %s, %s)
-            """, (content, "category", json.dumps(metadata), embedding))
-
-        print(f" Добавлено {len(categories)} категорий")
-
-        cur.execute("""
-            SELECT
-                pharmacy,
-                region,
-                COUNT(*) as total_sales,
-                SUM(revenue) as total_revenue,
-                SUM(profit) as total_profit
-            FROM sales
-            GROUP BY pharmacy, region
-            ORDER BY total_revenue DESC
-        """)
-
-        pharmacies = cur.fetchall()
-        for pharmacy in pharmacies:
-            content = f"""Аптека: {pharmacy[0]}
-Регион: {pharmacy[1]}
-Всего продаж: {pharmacy[2]}
-Общая выручка: {pharmacy[3]:.2f} тг
-Общая прибыль: {pharmacy[4]:.2f} тг"""
-
-            metadata = {
-                "type": "pharmacy",
-                "pharmacy": pharmacy[0],
-                "region": pharmacy[1],
-                "total_revenue": float(pharmacy[3])
-            }
-
-            embedding = create_embedding(client, content)
-
-            cur.execute("""
-                INSERT INTO knowledge_base (content, content_type, metadata, embedding)
-                VALUES (%s, %s, %s, %s)
-            """, (content, "pharmacy", json.dumps(metadata), embedding))
-
-        print(f"Добавлено {len(pharmacies)} аптек")
+        params = {}
+        if changes is None:
+            print("Очистка таблицы knowledge_base...")
+            cur.execute("TRUNCATE TABLE knowledge_base RESTART IDENTITY;")
+            where = ""
+        else:
+            params = {field: changes[field] for field in CHANGE_KEYS.values()}
+            print(f"Пересчет затронутых сущностей после загрузки {since_batch}: "
+                  + ", ".join(f"{field} {len(values)}" for field, values in params.items()))
+            print(f"Удалено устаревших документов: {delete_affected(cur, changes)}")
+            where = f"WHERE {CHANGED_FILTER}"
+
+        print("Расчет всех срезов одним проходом по sales (GROUPING SETS)...")
+        counts = {}
+        batch = []
+        # Именованный курсор - серверный: строки приходят пачками по itersize
+        with conn.cursor(name="knowledge_slices") as stream:
+            stream.itersize = STREAM_ITERSIZE
+            stream.execute(SLICES_SQL.format(where=where), params)
+            for content_type, content, metadata in iter_documents(iter_rows(stream)):
+                metadata = {"type": content_type, **metadata}
+                if changes is not None and not affected(metadata, changes):
+                    continue
+                batch.append((content_type, content, metadata))
+                if len(batch) >= EMBEDDING_BATCH:
+                    insert_batch(cur, llm, batch, storage, counts)
+                    batch = []
+            if batch:
+                insert_batch(cur, llm, batch, storage, counts)
+
+        for content_type, count in counts.items():
+            print(f"Добавлено документов {content_type}: {count}")
 
         conn.commit()
 
@@ -180,6 +292,11 @@ def generate_knowledge_from_sales():
         print(f" База знаний успешно создана!")
         print(f" Всего записей: {total}")
 
+        cur.execute("SELECT batch_id FROM sales_change_batches ORDER BY id DESC LIMIT 1")
+        latest = cur.fetchone()
+        if latest:
+            print(f" Учтены загрузки до {latest[0]} (для следующего запуска: --since-batch {latest[0]})")
+
     except Exception as e:
         conn.rollback()
         print(f" Ошибка: {e}")
@@ -189,14 +306,52 @@ def generate_knowledge_from_sales():
         conn.close()
 
 
-def create_embedding(client, text):
-    response = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
+def iter_rows(stream):
+    columns = None
+    for row in stream:
+        if columns is None:
+            columns = [column[0] for column in stream.description]
+        yield dict(zip(columns, row))
+
+
+def insert_batch(cur, llm, batch, storage, counts):
+    embeddings = create_embeddings(llm, [content for _, content, _ in batch])
+    for (content_type, content, metadata), embedding in zip(batch, embeddings):
+        insert_document(cur, content, content_type, metadata, embedding, storage)
+        counts[content_type] = counts.get(content_type, 0) + 1
+
+
+def insert_document(cur, content, content_type, metadata, embedding, storage):
+    cur.execute(f"""
+        INSERT INTO knowledge_base (content, content_type, metadata, {embedding_column(storage)})
+        VALUES (%s, %s, %s, %s::{embedding_type(storage)})
+    """, (content, content_type, json.dumps(metadata), to_vector_literal(embedding)))
+
+
+def create_embedding(llm, text):
+    return create_embeddings(llm, [text])[0]
+
+
+def create_embeddings(llm, texts):
+    # Один запрос на пачку документов вместо запроса на каждый
+    response = llm.embedding(
+        model=EMBEDDING_MODEL,
+        input=texts
     )
-    return response.data[0].embedding
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Генерация базы знаний для RAG системы")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default=None,
+                        help="формат хранения эмбеддингов (по умолчанию EMBEDDING_STORAGE или vector)")
+    parser.add_argument("--since-batch", default=None,
+                        help="пересчитать только сущности, затронутые загрузками после указанной (batch_id)")
+    args = parser.parse_args()
+
     print("Генерация базы знаний для RAG системы\n")
-    generate_knowledge_from_sales()
+    try:
+        generate_knowledge_from_sales(storage=args.storage, since_batch=args.since_batch)
+    except UnknownBatchError as e:
+        print(f"{e}. Укажите batch_id из вывода data/load_data.py или запустите без --since-batch")
+        sys.exit(1)
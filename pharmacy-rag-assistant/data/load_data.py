@@ -1,45 +1,221 @@
 import sys
 import os
+import io
+import json
+import uuid
+import argparse
 import pandas as pd
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
 
 from database.connection import get_connection
+from tools.analytics_engine import duckdb_available, export_sales_snapshot, snapshot_path
+from tools.approximate import refresh_sales_sample
 
-def load_csv_to_db(csv_path):
-    print(f"Загрузка данных из {csv_path}...")
+CSV_COLUMNS = [
+    "date", "region", "pharmacy", "category", "product",
+    "units_sold", "price", "cost_price", "revenue", "profit"
+]
+# Естественный ключ строки продаж: повторная выгрузка того же дня обновляет, а не дублирует
+NATURAL_KEY = "date, pharmacy, product"
+STAGE_CHUNK_ROWS = 50_000
 
-    df = pd.read_csv(csv_path)
-    print(f"Прочитано {len(df)} строк")
+# Обе загрузки идут через временную таблицу и COPY, а в sales попадают одной транзакцией:
+# читатели (агент, UI) все время видят либо старые, либо новые данные целиком.
+# full        - полная замена содержимого sales (DELETE + INSERT, без TRUNCATE и его эксклюзивной блокировки)
+# incremental - upsert по (date, pharmacy, product); затронутые ключи пишутся в sales_change_batches
+
+MERGE_SQL = f"""
+WITH previous AS (
+    -- Старые регион и категория обновляемых строк: если они поменялись, затронуты и старые значения
+    SELECT s.region, s.category
+    FROM sales s
+    JOIN sales_delta d USING (date, pharmacy, product)
+    WHERE (s.region, s.category) IS DISTINCT FROM (d.region, d.category)
+),
+upserted AS (
+    INSERT INTO sales ({", ".join(CSV_COLUMNS)})
+    SELECT {", ".join(CSV_COLUMNS)} FROM sales_delta
+    ON CONFLICT ({NATURAL_KEY}) DO UPDATE SET
+        region = EXCLUDED.region,
+        category = EXCLUDED.category,
+        units_sold = EXCLUDED.units_sold,
+        price = EXCLUDED.price,
+        cost_price = EXCLUDED.cost_price,
+        revenue = EXCLUDED.revenue,
+        profit = EXCLUDED.profit,
+        created_at = CURRENT_TIMESTAMP
+    WHERE (sales.region, sales.category, sales.units_sold, sales.price, sales.cost_price, sales.revenue, sales.profit)
+        IS DISTINCT FROM
+        (EXCLUDED.region, EXCLUDED.category, EXCLUDED.units_sold, EXCLUDED.price, EXCLUDED.cost_price, EXCLUDED.revenue, EXCLUDED.profit)
+    RETURNING date, region, pharmacy, category, product, (xmax = 0) AS inserted
+)
+SELECT
+    (SELECT COUNT(*) FROM upserted WHERE inserted),
+    (SELECT COUNT(*) FROM upserted WHERE NOT inserted),
+    (SELECT MIN(date) FROM upserted),
+    (SELECT MAX(date) FROM upserted),
+    ARRAY(SELECT DISTINCT TO_CHAR(date, 'YYYY-MM') FROM upserted ORDER BY 1),
+    ARRAY(SELECT region FROM upserted UNION SELECT region FROM previous ORDER BY 1),
+    ARRAY(SELECT DISTINCT pharmacy FROM upserted ORDER BY 1),
+    ARRAY(SELECT category FROM upserted UNION SELECT category FROM previous ORDER BY 1),
+    ARRAY(SELECT DISTINCT product FROM upserted ORDER BY 1)
+"""
+
+
+class DuplicateKeyError(ValueError):
+    pass
+
+
+def stage_csv(cur, csv_path, chunk_size=STAGE_CHUNK_ROWS):
+    # line_no - номер строки данных в файле: по нему определяется, какая из повторяющихся строк последняя
+    cur.execute(f"""
+        CREATE TEMP TABLE sales_stage ON COMMIT DROP AS
+        SELECT {", ".join(CSV_COLUMNS)}, NULL::bigint AS line_no FROM sales WITH NO DATA
+    """)
+
+    staged = 0
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        buffer = io.StringIO()
+        chunk[CSV_COLUMNS].assign(line_no=chunk.index + 1).to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cur.copy_expert(
+            f"COPY sales_stage ({', '.join(CSV_COLUMNS)}, line_no) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        staged += len(chunk)
+        print(f"Загружено во временную таблицу {staged} строк...")
+    return staged
+
+
+def check_unique_stage(cur):
+    # Полная загрузка берет строки как есть: повторы ключа в файле - ошибка, а не молча потерянные продажи
+    cur.execute(f"""
+        SELECT {NATURAL_KEY}, ARRAY_AGG(line_no ORDER BY line_no), COUNT(*) OVER ()
+        FROM sales_stage
+        GROUP BY {NATURAL_KEY}
+        HAVING COUNT(*) > 1
+        ORDER BY MIN(line_no)
+        LIMIT 5
+    """)
+    duplicates = cur.fetchall()
+    if not duplicates:
+        return
+
+    examples = "; ".join(
+        f"{date} / {pharmacy} / {product}: строки {', '.join(map(str, lines))}"
+        for date, pharmacy, product, lines, _ in duplicates
+    )
+    raise DuplicateKeyError(
+        f"В файле {duplicates[0][4]} ключей ({NATURAL_KEY}) встречаются несколько раз, например: {examples}. "
+        f"Сложите такие продажи в одну строку или загрузите файл с --mode incremental, где побеждает последняя строка"
+    )
+
+
+def dedupe_stage(cur):
+    # Инкрементальная загрузка: из повторов ключа внутри файла побеждает строка, стоящая в файле последней
+    cur.execute(f"""
+        CREATE TEMP TABLE sales_delta ON COMMIT DROP AS
+        SELECT DISTINCT ON ({NATURAL_KEY}) {", ".join(CSV_COLUMNS)}
+        FROM sales_stage
+        ORDER BY {NATURAL_KEY}, line_no DESC
+    """)
+    unique = cur.rowcount
+    cur.execute("SELECT COUNT(*) FROM sales_stage")
+    staged = cur.fetchone()[0]
+    if unique < staged:
+        print(f"ВНИМАНИЕ: {staged - unique} строк повторяют ключ ({NATURAL_KEY}) и заменены последней строкой файла")
+    return unique
+
+
+def replace_all(cur):
+    check_unique_stage(cur)
+    cur.execute("DELETE FROM sales")
+    cur.execute(f"INSERT INTO sales ({', '.join(CSV_COLUMNS)}) SELECT {', '.join(CSV_COLUMNS)} FROM sales_stage ORDER BY line_no")
+    return {"inserted": cur.rowcount, "updated": 0, "full": True}
+
+
+def merge_incremental(cur):
+    dedupe_stage(cur)
+    cur.execute(MERGE_SQL)
+    inserted, updated, date_from, date_to, months, regions, pharmacies, categories, products = cur.fetchone()
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "full": False,
+        "date_from": date_from.isoformat() if date_from else None,
+        "date_to": date_to.isoformat() if date_to else None,
+        "months": months,
+        "regions": regions,
+        "pharmacies": pharmacies,
+        "categories": categories,
+        "products": products
+    }
+
+
+def record_changes(cur, batch_id, source, mode, changes):
+    cur.execute("""
+        INSERT INTO sales_change_batches (batch_id, source, mode, inserted, updated, changed_keys)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (batch_id, source, mode, changes["inserted"], changes["updated"], json.dumps(changes, ensure_ascii=False)))
+
+
+class UnknownBatchError(LookupError):
+    pass
+
+
+def load_changes(since_batch=None):
+    # Объединенный набор затронутых ключей по всем загрузкам после since_batch:
+    # по нему витрины и база знаний пересчитываются только для затронутых сущностей
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            if since_batch:
+                # Неизвестный batch_id (опечатка, журнал очищен) дал бы пустой набор изменений,
+                # и инкрементальный пересчет молча ничего бы не обновил
+                cur.execute("SELECT id FROM sales_change_batches WHERE batch_id = %s", (since_batch,))
+                found = cur.fetchone()
+                if found is None:
+                    raise UnknownBatchError(f"Загрузка {since_batch} не найдена в sales_change_batches")
+                cur.execute(
+                    "SELECT changed_keys FROM sales_change_batches WHERE id > %s ORDER BY id", (found[0],)
+                )
+            else:
+                cur.execute("SELECT changed_keys FROM sales_change_batches ORDER BY id")
+            batches = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+    keys = ("months", "regions", "pharmacies", "categories", "products")
+    merged = {key: set() for key in keys}
+    full = False
+    for batch in batches:
+        full = full or batch.get("full", False)
+        for key in keys:
+            merged[key].update(batch.get(key) or [])
+    return {"full": full, **{key: sorted(values) for key, values in merged.items()}}
+
+
+def load_csv_to_db(csv_path, mode="full"):
+    print(f"Загрузка данных из {csv_path}, режим: {mode}...")
 
     conn = get_connection()
     cur = conn.cursor()
+    batch_id = uuid.uuid4().hex
 
     try:
-        print("Очистка таблицы sales...")
-        cur.execute("TRUNCATE TABLE sales RESTART IDENTITY;")
-
-        print("Загрузка данных в таблицу...")
-        inserted = 0
-
-        for idx, row in df.iterrows():
-            cur.execute("""
-                INSERT INTO sales (date, region, pharmacy, category, product,
-                                   units_sold, price, cost_price, revenue, profit)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                row['date'], row['region'], row['pharmacy'], row['category'],
-                row['product'], row['units_sold'], row['price'], row['cost_price'],
-                row['revenue'], row['profit']
-            ))
-            inserted += 1
-
-            if inserted % 1000 == 0:
-                print(f"Загружено {inserted} строк...")
+        stage_csv(cur, csv_path)
+
+        if mode == "incremental":
+            changes = merge_incremental(cur)
+            print(f"Добавлено {changes['inserted']} строк, обновлено {changes['updated']}")
+        else:
+            changes = replace_all(cur)
+            print(f"Успешно загружено {changes['inserted']} строк!")
 
+        record_changes(cur, batch_id, str(csv_path), mode, changes)
         conn.commit()
-        print(f"Успешно загружено {inserted} строк!")
+        print(f"Загрузка {batch_id} зафиксирована")
 
         cur.execute("SELECT COUNT(*) as count FROM sales;")
         count = cur.fetchone()[0]
@@ -61,6 +237,14 @@ def load_csv_to_db(csv_path):
         products = cur.fetchone()[0]
         print(f"Количество продуктов: {products}")
 
+        if not changes["full"]:
+            print(f"Затронуто: месяцев {len(changes['months'])}, регионов {len(changes['regions'])}, "
+                  f"аптек {len(changes['pharmacies'])}, продуктов {len(changes['products'])}")
+
+        if changes["inserted"] or changes["updated"]:
+            refresh_snapshot()
+            refresh_sample()
+
     except Exception as e:
         conn.rollback()
         print(f"Ошибка при загрузке данных: {e}")
@@ -69,11 +253,42 @@ def load_csv_to_db(csv_path):
         cur.close()
         conn.close()
 
+    return batch_id, changes
+
+def refresh_snapshot():
+    if not duckdb_available():
+        return
+
+    print("\nОбновление Parquet снимка для DuckDB...")
+    try:
+        rows = export_sales_snapshot()
+        print(f"Снимок обновлен: {rows} строк")
+    except Exception as e:
+        # Устаревший снимок хуже отсутствующего: без него запросы просто пойдут в Postgres
+        snapshot_path().unlink(missing_ok=True)
+        print(f"Не удалось обновить снимок, он удален: {e}")
+
+
+def refresh_sample():
+    print("\nОбновление выборки sales_sample для приблизительных ответов...")
+    try:
+        rows = refresh_sales_sample()
+        print(f"Выборка обновлена: {rows} строк")
+    except Exception as e:
+        # Без выборки приблизительный режим просто считает точно
+        print(f"Не удалось обновить выборку: {e}")
+
+
 if __name__ == "__main__":
-    csv_file = "/Users/laurashamykhanova/Desktop/Forte/sales_data.csv" #здесь надо будет поменять вам на свой, если будете запускать
+    parser = argparse.ArgumentParser(description="Загрузка продаж из CSV в таблицу sales")
+    parser.add_argument("csv_file", nargs="?",
+                        default="/Users/laurashamykhanova/Desktop/Forte/sales_data.csv") #здесь надо будет поменять вам на свой, если будете запускать
+    parser.add_argument("--mode", choices=["full", "incremental"], default="full",
+                        help="full - заменить все данные, incremental - добавить/обновить строки из файла")
+    args = parser.parse_args()
 
-    if not os.path.exists(csv_file):
-        print(f"Файл {csv_file} не найден!")
+    if not os.path.exists(args.csv_file):
+        print(f"Файл {args.csv_file} не найден!")
         sys.exit(1)
 
-    load_csv_to_db(csv_file)
+    load_csv_to_db(args.csv_file, args.mode)
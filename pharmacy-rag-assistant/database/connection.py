@@ -1,12 +1,26 @@
 import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from utils.cancellation import cancellable, check_deadline
 
 load_dotenv()
 
-def get_connection():
-    return psycopg2.connect(
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _connection_params():
+    return dict(
         host=os.getenv("DB_HOST", "localhost"),
         port=os.getenv("DB_PORT", "5432"),
         database=os.getenv("DB_NAME", "pharmacy_analytics"),
@@ -14,13 +28,79 @@ def get_connection():
         password=os.getenv("DB_PASSWORD", "postgres")
     )
 
-def execute_query(query, params=None, fetch=True):
-    conn = get_connection()
+
+def get_connection():
+    return psycopg2.connect(**_connection_params())
+
+
+# Пул делят воркеры агента, фоновые точные запросы, запись нагрузки, хранилище сессий,
+# векторный индекс и прогрев; ThreadedConnectionPool при исчерпании сразу бросает PoolError,
+# поэтому свободного соединения ждем не дольше DB_POOL_TIMEOUT секунд
+class BlockingConnectionPool(ThreadedConnectionPool):
+
+    def __init__(self, minconn, maxconn, *args, timeout: float = 30.0, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        waited_until = time.monotonic() + self.timeout
+        # Ждем короткими отрезками, чтобы остановка хода или его дедлайн прерывали ожидание
+        while not self._slots.acquire(timeout=0.1):
+            check_deadline()
+            if time.monotonic() >= waited_until:
+                raise PoolError(f"Нет свободного соединения с БД за {self.timeout:g} с (DB_POOL_MAX={self.maxconn})")
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+def get_pool() -> ThreadedConnectionPool:
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BlockingConnectionPool(
+                    int(os.getenv("DB_POOL_MIN", "1")),
+                    int(os.getenv("DB_POOL_MAX", "10")),
+                    timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+                    **_connection_params()
+                )
+    return _pool
+
+
+@contextmanager
+def pooled_connection():
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
     try:
+        yield conn
+        conn.commit()
+    # BaseException: отмена хода (TurnCancelled) тоже должна откатить транзакцию
+    except BaseException:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or conn.closed != 0)
+
+
+def execute_query(query, params=None, fetch=True):
+    # Остановка хода или истекший дедлайн прерывают запрос на сервере через conn.cancel()
+    with pooled_connection() as conn, cancellable(conn.cancel):
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(query, params)
             if fetch:
                 return cur.fetchall()
-            conn.commit()
-    finally:
-        conn.close()
@@ -0,0 +1,31 @@
+import os
+from typing import List
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+
+# vector  - полный float32 (6 КБ на документ)
+# halfvec - float16, вдвое меньше на диске и в HNSW индексе
+# binary  - halfvec + HNSW по binary_quantize() с переранжированием кандидатов
+STORAGE_TYPES = ("vector", "halfvec", "binary")
+
+
+def get_embedding_storage() -> str:
+    storage = os.getenv("EMBEDDING_STORAGE", "vector").lower()
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Неизвестный EMBEDDING_STORAGE: {storage}. Доступные: {', '.join(STORAGE_TYPES)}")
+    return storage
+
+
+def embedding_column(storage: str = None) -> str:
+    storage = storage or get_embedding_storage()
+    return "embedding" if storage == "vector" else "embedding_half"
+
+
+def embedding_type(storage: str = None) -> str:
+    storage = storage or get_embedding_storage()
+    return "vector" if storage == "vector" else "halfvec"
+
+
+def to_vector_literal(embedding: List[float]) -> str:
+    return '[' + ','.join(map(str, embedding)) + ']'
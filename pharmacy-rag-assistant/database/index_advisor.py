@@ -0,0 +1,407 @@
+import re
+import sys
+import json
+import argparse
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import get_connection
+from database.workload import explain, import_log
+
+# Советник индексов по журналу query_workload (см. database/workload.py).
+# 1. Берет самые частые/долгие отпечатки запросов и заново снимает их планы.
+# 2. В каждом Seq Scan разбирает Filter, Group Key и Sort Key: колонки равенства идут в начало
+#    ключа, затем одна колонка диапазона или сортировки; колонки из Output - в INCLUDE (покрывающий
+#    индекс), литерал, одинаковый во всех выполнениях, - в WHERE (частичный индекс).
+# 3. Каждого кандидата проверяет EXPLAIN до и после: гипотетическим индексом HypoPG или
+#    (--method real) настоящим CREATE INDEX внутри транзакции, которая затем откатывается.
+#
+# Запуск: python database/index_advisor.py [--import-log logs/conversational_agent.log logs/sql_agent.log]
+
+TOP_QUERIES = 20
+MIN_CALLS = 1
+MIN_IMPROVEMENT = 0.1
+MAX_INCLUDE_COLUMNS = 4
+# Частичный индекс предлагается, если литерал не менялся хотя бы в стольких выполнениях
+PARTIAL_MIN_CALLS = 3
+CANDIDATE_INDEX_NAME = "index_advisor_candidate"
+
+WORKLOAD_SQL = """
+    SELECT
+        fingerprint,
+        COUNT(*) AS calls,
+        SUM(duration_ms) AS total_ms,
+        AVG(duration_ms) AS avg_ms,
+        COUNT(DISTINCT sql_text || COALESCE(params::text, '')) AS variants,
+        (ARRAY_AGG(sql_text ORDER BY captured_at DESC))[1] AS sql_text,
+        (ARRAY_AGG(params ORDER BY captured_at DESC))[1] AS params
+    FROM query_workload
+    WHERE error IS NULL AND captured_at >= NOW() - make_interval(days => %s)
+    GROUP BY fingerprint
+    HAVING COUNT(*) >= %s
+    ORDER BY COALESCE(SUM(duration_ms), 0) DESC, COUNT(*) DESC
+    LIMIT %s
+"""
+
+EXISTING_INDEXES_SQL = """
+    SELECT
+        c.relname,
+        ARRAY(
+            SELECT a.attname
+            FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+            ORDER BY k.n
+        ) AS columns,
+        i.indnkeyatts,
+        i.indpred IS NOT NULL AS partial
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indrelid
+    WHERE c.relname = %s
+"""
+
+EQUALITY_OPS = ("=", "= ANY")
+RANGE_OPS = (">=", "<=", ">", "<")
+
+
+@dataclass
+class Query:
+    fingerprint: str
+    calls: int
+    total_ms: Optional[float]
+    avg_ms: Optional[float]
+    variants: int
+    sql: str
+    params: Any
+    cost: float = 0.0
+    plan: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Candidate:
+    table: str
+    columns: Tuple[str, ...]
+    include: Tuple[str, ...] = ()
+    where: Optional[str] = None
+    kind: str = "composite"
+    sources: set = field(default_factory=set)
+
+    @property
+    def name(self) -> str:
+        suffix = {"covering": "_incl", "partial": "_part"}.get(self.kind, "")
+        return f"idx_{self.table}_{'_'.join(self.columns)}{suffix}"[:63]
+
+    def ddl(self, name: Optional[str] = None, concurrently: bool = False) -> str:
+        statement = "CREATE INDEX CONCURRENTLY" if concurrently else "CREATE INDEX"
+        sql = f"{statement} {name or self.name} ON {self.table} ({', '.join(self.columns)})"
+        if self.include:
+            sql += f" INCLUDE ({', '.join(self.include)})"
+        if self.where:
+            sql += f" WHERE {self.where}"
+        return sql
+
+
+def load_workload(cur, days: int, min_calls: int, top: int) -> List[Query]:
+    cur.execute(WORKLOAD_SQL, (days, min_calls, top))
+    return [Query(*row) for row in cur.fetchall()]
+
+
+def walk(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from walk(child)
+
+
+def table_columns(cur, table: str, cache: Dict[str, List[str]]) -> List[str]:
+    if table not in cache:
+        cur.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+            (table,)
+        )
+        cache[table] = [row[0] for row in cur.fetchall()]
+    return cache[table]
+
+
+def _column_ref(alias: str, column: str) -> str:
+    # sales.region, (s.region)::text, region
+    return rf"(?<![\w.])\(*(?:{re.escape(alias)}\.)?{re.escape(column)}\)*(?:::[a-z ]+?)?"
+
+
+def parse_predicates(condition: str, alias: str, columns: List[str]) -> List[Tuple[str, str, Optional[str]]]:
+    # (колонка, оператор, литерал) для условий вида "колонка оператор значение";
+    # условия внутри функций (DATE_TRUNC('year', date) = ...) индексом по колонке не ускорить
+    if not condition or " OR " in condition:
+        return []
+
+    predicates = []
+    for column in columns:
+        pattern = _column_ref(alias, column) + r"\s*(= ANY|>=|<=|=|>|<)\s*(?:\(?'((?:[^']|'')*)'::)?"
+        for match in re.finditer(pattern, condition):
+            predicates.append((column, match.group(1), match.group(2)))
+    return predicates
+
+
+def parse_keys(keys: List[str], alias: str, columns: List[str]) -> List[str]:
+    parsed = []
+    for key in keys or []:
+        bare = re.sub(r"\s+(DESC|ASC|NULLS FIRST|NULLS LAST)\b", "", key).strip()
+        bare = re.sub(r"^\(+|\)+(?:::[a-z ]+)?$", "", bare)
+        qualifier, _, column = bare.rpartition(".")
+        if column in columns and qualifier in ("", alias) and column not in parsed:
+            parsed.append(column)
+    return parsed
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def propose(cur, query: Query, column_cache: Dict[str, List[str]]) -> List[Candidate]:
+    root = query.plan["Plan"]
+    group_keys, sort_keys = [], []
+    for node in walk(root):
+        group_keys.extend(node.get("Group Key", []))
+        sort_keys.extend(node.get("Sort Key", []))
+
+    candidates = []
+    for node in walk(root):
+        if node.get("Node Type") != "Seq Scan" or not node.get("Relation Name"):
+            continue
+
+        table = node["Relation Name"]
+        alias = node.get("Alias", table)
+        columns = table_columns(cur, table, column_cache)
+        predicates = parse_predicates(node.get("Filter", ""), alias, columns)
+
+        equality = [column for column, op, _ in predicates if op in EQUALITY_OPS]
+        equality = list(dict.fromkeys(equality))
+        ranges = [column for column, op, _ in predicates if op in RANGE_OPS and column not in equality]
+        groups = [column for column in parse_keys(group_keys, alias, columns) if column not in equality]
+        sorts = [column for column in parse_keys(sort_keys, alias, columns) if column not in equality]
+
+        # Равенства, затем одна колонка диапазона; без диапазона - группировка или сортировка
+        key = equality + (ranges[:1] or sorts[:1] or ([] if equality else groups))
+        if not key:
+            continue
+
+        output = parse_keys(node.get("Output", []), alias, columns)
+        include = [column for column in output if column not in key]
+        if include and len(include) < len(columns) - len(key) and len(include) <= MAX_INCLUDE_COLUMNS:
+            candidates.append(Candidate(table, tuple(key), tuple(include), kind="covering"))
+        candidates.append(Candidate(table, tuple(key)))
+
+        # Один и тот же литерал во всех выполнениях: условие уходит в WHERE частичного индекса
+        if query.calls >= PARTIAL_MIN_CALLS and query.variants == 1:
+            constants = [(column, value) for column, op, value in predicates if op == "=" and value is not None]
+            for column, value in constants:
+                rest = [other for other in key if other != column] or groups or ranges[:1]
+                if rest:
+                    candidates.append(Candidate(
+                        table, tuple(rest), tuple(c for c in include if c not in rest and c != column),
+                        where=f"{column} = {_literal(value)}", kind="partial"
+                    ))
+
+    for candidate in candidates:
+        candidate.sources.add(query.fingerprint)
+    return candidates
+
+
+def existing_indexes(cur, table: str) -> List[Tuple[List[str], List[str], bool]]:
+    cur.execute(EXISTING_INDEXES_SQL, (table,))
+    return [(columns[:nkey], columns[nkey:], partial) for _, columns, nkey, partial in cur.fetchall()]
+
+
+def is_covered(candidate: Candidate, indexes: List[Tuple[List[str], List[str], bool]]) -> bool:
+    # Уже есть индекс без условия, который начинается с тех же колонок и содержит все INCLUDE
+    width = len(candidate.columns)
+    for key, include, partial in indexes:
+        if partial or tuple(key[:width]) != candidate.columns:
+            continue
+        if set(candidate.include) <= set(key) | set(include):
+            return True
+    return False
+
+
+def has_hypopg(cur) -> bool:
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")
+    return cur.fetchone() is not None
+
+
+def plan_metric(plan: Dict[str, Any], analyze: bool) -> float:
+    return plan["Execution Time"] if analyze else plan["Plan"]["Total Cost"]
+
+
+def uses_index(plan: Dict[str, Any], name: str) -> bool:
+    return any(name in (node.get("Index Name") or "") for node in walk(plan["Plan"]))
+
+
+def measure(cur, queries: List[Query], analyze: bool) -> Dict[str, Dict[str, Any]]:
+    plans = {}
+    for query in queries:
+        cur.execute("SAVEPOINT advisor_query")
+        try:
+            plans[query.fingerprint] = explain(cur, query.sql, query.params, analyze=analyze)
+            cur.execute("RELEASE SAVEPOINT advisor_query")
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT advisor_query")
+            print(f"  пропущен {query.fingerprint[:8]}: {str(e).splitlines()[0]}")
+    return plans
+
+
+def evaluate(conn, candidate: Candidate, queries: List[Query], baseline: Dict[str, Dict[str, Any]],
+             method: str) -> Dict[str, Any]:
+    # Индекс может ускорить не только запрос, из которого он выведен: проверяются все запросы к таблице
+    analyze = method == "real"
+    targets = [query for query in queries if query.fingerprint in baseline
+               and any(node.get("Relation Name") == candidate.table for node in walk(query.plan["Plan"]))]
+
+    with conn.cursor() as cur:
+        if method == "hypopg":
+            cur.execute("SELECT indexrelid, indexname FROM hypopg_create_index(%s)", (candidate.ddl(),))
+            index_oid, index_name = cur.fetchone()
+            cur.execute("SELECT hypopg_relation_size(%s)", (index_oid,))
+            size = cur.fetchone()[0]
+            try:
+                after = measure(cur, targets, analyze)
+            finally:
+                cur.execute("SELECT hypopg_drop_index(%s)", (index_oid,))
+            conn.commit()
+        else:
+            # Настоящий индекс в незафиксированной транзакции: на время проверки блокирует запись в таблицу
+            index_name = CANDIDATE_INDEX_NAME
+            try:
+                cur.execute(candidate.ddl(index_name))
+                cur.execute("SELECT pg_relation_size(%s)", (index_name,))
+                size = cur.fetchone()[0]
+                after = measure(cur, targets, analyze)
+            finally:
+                conn.rollback()
+
+    details, benefit = [], 0.0
+    for query in targets:
+        if query.fingerprint not in after:
+            continue
+        before_value = plan_metric(baseline[query.fingerprint], analyze)
+        after_value = plan_metric(after[query.fingerprint], analyze)
+        if not uses_index(after[query.fingerprint], index_name) or after_value >= before_value:
+            continue
+        benefit += (before_value - after_value) * query.calls
+        details.append({
+            "fingerprint": query.fingerprint,
+            "calls": query.calls,
+            "before": round(before_value, 2),
+            "after": round(after_value, 2),
+            "improvement": round(1 - after_value / before_value, 3) if before_value else 0.0
+        })
+
+    return {
+        "ddl": candidate.ddl(concurrently=True) + ";",
+        "kind": candidate.kind,
+        "size_bytes": size,
+        "metric": "execution_ms" if analyze else "plan_cost",
+        "weighted_benefit": round(benefit, 2),
+        "queries": details
+    }
+
+
+def advise(days: int = 30, top: int = TOP_QUERIES, min_calls: int = MIN_CALLS, method: str = "auto",
+           min_improvement: float = MIN_IMPROVEMENT) -> List[Dict[str, Any]]:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            queries = load_workload(cur, days, min_calls, top)
+            print(f"Горячих запросов в журнале: {len(queries)}")
+
+            if method == "auto":
+                method = "hypopg" if has_hypopg(cur) else "none"
+                if method == "none":
+                    print("HypoPG не установлен: кандидаты не проверены. "
+                          "CREATE EXTENSION hypopg или --method real (создает индексы в откатываемой транзакции)")
+
+            baseline = measure(cur, queries, analyze=method == "real")
+            for query in queries:
+                if query.fingerprint in baseline:
+                    query.plan = baseline[query.fingerprint]
+                    query.cost = query.plan["Plan"]["Total Cost"]
+            queries = [query for query in queries if query.plan]
+
+            column_cache: Dict[str, List[str]] = {}
+            candidates: Dict[str, Candidate] = {}
+            for query in queries:
+                for candidate in propose(cur, query, column_cache):
+                    known = candidates.setdefault(candidate.ddl(), candidate)
+                    known.sources |= candidate.sources
+
+            index_cache: Dict[str, list] = {}
+            fresh = []
+            for candidate in candidates.values():
+                if candidate.table not in index_cache:
+                    index_cache[candidate.table] = existing_indexes(cur, candidate.table)
+                if not is_covered(candidate, index_cache[candidate.table]):
+                    fresh.append(candidate)
+        conn.commit()
+
+        print(f"Кандидатов: {len(candidates)}, без аналогов среди существующих индексов: {len(fresh)}")
+        if method == "none":
+            return [{"ddl": candidate.ddl(concurrently=True) + ";", "kind": candidate.kind,
+                     "queries": sorted(candidate.sources)} for candidate in fresh]
+
+        report = []
+        for candidate in fresh:
+            try:
+                result = evaluate(conn, candidate, queries, baseline, method)
+            except Exception as e:
+                conn.rollback()
+                print(f"  не удалось проверить {candidate.ddl()}: {str(e).splitlines()[0]}")
+                continue
+            result["queries"] = [q for q in result["queries"] if q["improvement"] >= min_improvement]
+            if result["queries"]:
+                report.append(result)
+        return sorted(report, key=lambda item: item["weighted_benefit"], reverse=True)
+    finally:
+        conn.close()
+
+
+def print_report(report: List[Dict[str, Any]]):
+    if not report:
+        print("\nПолезных индексов не найдено")
+        return
+
+    print("\nРекомендации (по убыванию выигрыша, взвешенного числом выполнений):")
+    for item in report:
+        print(f"\n{item['ddl']}")
+        if "metric" not in item:
+            print(f"  [{item['kind']}] не проверен, запросы: {', '.join(q[:8] for q in item['queries'])}")
+            continue
+        print(f"  [{item['kind']}] размер ~{item['size_bytes'] / 1024 / 1024:.1f} МБ, "
+              f"выигрыш {item['weighted_benefit']} ({item['metric']})")
+        for query in item["queries"]:
+            print(f"  {query['fingerprint'][:8]} x{query['calls']}: {query['before']} -> {query['after']} "
+                  f"(-{query['improvement']:.0%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Советник индексов по журналу выполненных запросов")
+    parser.add_argument("--days", type=int, default=30, help="глубина журнала в днях")
+    parser.add_argument("--top", type=int, default=TOP_QUERIES, help="сколько самых тяжелых запросов разбирать")
+    parser.add_argument("--min-calls", type=int, default=MIN_CALLS)
+    parser.add_argument("--min-improvement", type=float, default=MIN_IMPROVEMENT,
+                        help="минимальное относительное улучшение запроса, 0.1 = 10%%")
+    parser.add_argument("--method", choices=["auto", "hypopg", "real"], default="auto",
+                        help="hypopg - гипотетические индексы, real - CREATE INDEX в откатываемой транзакции")
+    parser.add_argument("--import-log", nargs="*", default=[],
+                        help="сначала добавить в журнал SQL из логов агентов")
+    parser.add_argument("--output", help="сохранить отчет в JSON")
+    args = parser.parse_args()
+
+    for log_path in args.import_log:
+        print(f"Импортировано запросов из {log_path}: {import_log(Path(log_path))}")
+
+    report = advise(args.days, args.top, args.min_calls, args.method, args.min_improvement)
+    print_report(report)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nОтчет сохранен: {args.output}")
@@ -21,6 +21,7 @@ CREATE TABLE knowledge_base (
     content_type VARCHAR(50),
     metadata JSONB,
     embedding vector(1536),
+    embedding_half halfvec(1536),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -28,4 +29,102 @@ CREATE INDEX idx_sales_date ON sales(date);
 CREATE INDEX idx_sales_region ON sales(region);
 CREATE INDEX idx_sales_pharmacy ON sales(pharmacy);
 CREATE INDEX idx_sales_category ON sales(category);
-CREATE INDEX idx_sales_product ON sales(product);
\ No newline at end of file
+CREATE INDEX idx_sales_product ON sales(product);
+-- Естественный ключ для инкрементальной загрузки (data/load_data.py --mode incremental)
+CREATE UNIQUE INDEX idx_sales_natural_key ON sales(date, pharmacy, product);
+
+-- Журнал загрузок: какие месяцы, регионы, аптеки, категории и продукты затронула каждая
+CREATE TABLE sales_change_batches (
+    id BIGSERIAL PRIMARY KEY,
+    batch_id TEXT NOT NULL UNIQUE,
+    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    source TEXT,
+    mode VARCHAR(20) NOT NULL,
+    inserted INTEGER NOT NULL,
+    updated INTEGER NOT NULL,
+    changed_keys JSONB NOT NULL
+);
+
+-- Журнал выполненных запросов (WORKLOAD_CAPTURE) для советника индексов database/index_advisor.py.
+-- fingerprint - md5 текста без литералов; plan - EXPLAIN (VERBOSE, FORMAT JSON) первого выполнения в процессе.
+CREATE TABLE query_workload (
+    id BIGSERIAL PRIMARY KEY,
+    captured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    fingerprint TEXT NOT NULL,
+    normalized_sql TEXT NOT NULL,
+    sql_text TEXT NOT NULL,
+    params JSONB,
+    engine VARCHAR(20) NOT NULL,
+    duration_ms DOUBLE PRECISION,
+    row_count INTEGER,
+    error TEXT,
+    plan JSONB
+);
+
+CREATE INDEX idx_query_workload_fingerprint ON query_workload(fingerprint, captured_at);
+
+-- Стратифицированная выборка sales (регион x категория x месяц) для приблизительных ответов (APPROX_MODE).
+-- sample_weight - сколько строк sales представляет строка выборки, sample_half - половина для оценки погрешности.
+-- Обновляется tools/approximate.py: refresh_sales_sample() после загрузки данных.
+CREATE TABLE sales_sample (
+    LIKE sales,
+    sample_weight NUMERIC NOT NULL,
+    sample_half SMALLINT NOT NULL
+);
+
+CREATE INDEX idx_sales_sample_date ON sales_sample(date);
+CREATE INDEX idx_sales_sample_half ON sales_sample(sample_half);
+
+-- Квантованное хранение эмбеддингов выбирается через EMBEDDING_STORAGE (vector | halfvec | binary).
+-- halfvec и binary пишут только embedding_half; пустые колонки в HNSW индексы не попадают.
+CREATE INDEX idx_knowledge_embedding_half ON knowledge_base
+    USING hnsw (embedding_half halfvec_cosine_ops);
+CREATE INDEX idx_knowledge_embedding_binary ON knowledge_base
+    USING hnsw ((binary_quantize(embedding_half)::bit(1536)) bit_hamming_ops);
+
+-- Хранилище сессий чата (SESSION_STORE=postgres); сообщения хранятся сжатым JSON
+CREATE TABLE chat_sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at DOUBLE PRECISION NOT NULL,
+    last_active_at DOUBLE PRECISION NOT NULL
+);
+
+CREATE TABLE chat_messages (
+    id BIGSERIAL PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    turn INTEGER NOT NULL,
+    payload BYTEA NOT NULL
+);
+
+CREATE INDEX idx_chat_messages_session ON chat_messages(session_id, kind, turn);
+CREATE INDEX idx_chat_sessions_active ON chat_sessions(last_active_at);
+
+-- Результаты запросов агента для таблиц под ответами (tools/result_store.py). source_sql - запрос
+-- с подставленными параметрами; строки копируются в query_result_rows при первом просмотре,
+-- row_no - порядок строк исходного запроса. Таблицы UNLOGGED: после сбоя сервера результаты
+-- пропадают вместе, и UI просит повторить вопрос.
+CREATE UNLOGGED TABLE query_results (
+    result_id TEXT PRIMARY KEY,
+    source_sql TEXT NOT NULL,
+    columns JSONB,
+    row_count INTEGER,
+    truncated BOOLEAN NOT NULL DEFAULT FALSE,
+    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE UNLOGGED TABLE query_result_rows (
+    result_id TEXT NOT NULL REFERENCES query_results(result_id) ON DELETE CASCADE,
+    row_no BIGINT NOT NULL,
+    data JSONB NOT NULL,
+    PRIMARY KEY (result_id, row_no)
+);
+
+-- Сессии, которым показан результат: через сервис листать и выгружать его могут только они
+CREATE UNLOGGED TABLE query_result_sessions (
+    result_id TEXT NOT NULL REFERENCES query_results(result_id) ON DELETE CASCADE,
+    session_id TEXT NOT NULL,
+    PRIMARY KEY (result_id, session_id)
+);
+
+CREATE INDEX idx_query_results_registered ON query_results(registered_at);
@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from utils.logger import setup_logger
+
+logger = setup_logger('session_store', 'logs/session_store.log')
+
+# kind = 'history'    - сообщения для LLM (user/assistant/tool)
+# kind = 'transcript' - то, что показывает UI (текст + графики в JSON Plotly)
+HISTORY = "history"
+TRANSCRIPT = "transcript"
+
+# Сколько строк результата инструмента сохранять; остальное модели при возобновлении не нужно
+TOOL_ROWS_KEPT = int(os.getenv("SESSION_TOOL_ROWS", "50"))
+
+
+def _compact(message: Dict[str, Any]) -> Dict[str, Any]:
+    if message.get("role") != "tool":
+        return message
+
+    try:
+        payload = json.loads(message["content"])
+    except (TypeError, ValueError):
+        return message
+
+    data = payload.get("data")
+    if isinstance(data, list) and len(data) > TOOL_ROWS_KEPT:
+        payload["data"] = data[:TOOL_ROWS_KEPT]
+        payload["truncated"] = True
+
+    return {**message, "content": json.dumps(payload, ensure_ascii=False, default=str)}
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(_compact(message), ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def _decode(payload) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(bytes(payload)).decode("utf-8"))
+
+
+REFINED_NOTE = "_Цифры в тексте выше получены по выборке, точные данные - на графике и в таблице ниже._"
+
+
+def apply_refinement(message: Dict[str, Any], refinement: Dict[str, Any], exact: Dict[str, Any]):
+    # Точный результат заменяет приблизительный график; шаблонный текст ответа пересчитывается,
+    # а текст, написанный моделью по выборке, помечается, чтобы цифры в нем не принимали за точные
+    figure = exact.get("figure")
+    if figure is not None:
+        index = refinement.get("figure_index")
+        if index is not None and index < len(message["figures"]):
+            message["figures"][index] = figure
+        else:
+            message["figures"].append(figure)
+
+    if exact.get("response"):
+        message["content"] = exact["response"]
+        return
+
+    message.setdefault("exact_data", []).append(exact.get("data", [])[:TOOL_ROWS_KEPT])
+    if REFINED_NOTE not in message["content"]:
+        message["content"] += "\n\n" + REFINED_NOTE
+
+
+def trim_history(history: List[Dict[str, Any]], max_turns: int, max_bytes: int) -> List[Dict[str, Any]]:
+    # Режем только по границе сообщения пользователя, чтобы tool-ответы не остались без своего вызова
+    starts = [i for i, message in enumerate(history) if message.get("role") == "user"]
+    if len(starts) > max_turns:
+        history = history[starts[-max_turns]:]
+        starts = [i for i, message in enumerate(history) if message.get("role") == "user"]
+
+    size = sum(len(json.dumps(m, ensure_ascii=False, default=str)) for m in history)
+    while size > max_bytes and len(starts) > 1:
+        cut = starts[1]
+        size -= sum(len(json.dumps(m, ensure_ascii=False, default=str)) for m in history[:cut])
+        history = history[cut:]
+        starts = [i - cut for i in starts[1:]]
+
+    return history
+
+
+class SessionStore(ABC):
+    placeholder = "%s"
+
+    @abstractmethod
+    def _execute(self, sql: str, params=(), fetch: bool = False):
+        pass
+
+    def _sql(self, sql: str) -> str:
+        return sql.replace("%s", self.placeholder)
+
+    def touch(self, session_id: str):
+        now = time.time()
+        self._execute(
+            "INSERT INTO chat_sessions (session_id, created_at, last_active_at) VALUES (%s, %s, %s) "
+            "ON CONFLICT (session_id) DO UPDATE SET last_active_at = excluded.last_active_at",
+            (session_id, now, now)
+        )
+
+    def last_turn(self, session_id: str) -> int:
+        rows = self._execute(
+            "SELECT COALESCE(MAX(turn), 0) FROM chat_messages WHERE session_id = %s",
+            (session_id,), fetch=True
+        )
+        return rows[0][0] if rows else 0
+
+    def append(self, session_id: str, kind: str, turn: int, messages: List[Dict[str, Any]]):
+        if not messages:
+            return
+        self.touch(session_id)
+        for message in messages:
+            self._execute(
+                "INSERT INTO chat_messages (session_id, kind, turn, payload) VALUES (%s, %s, %s, %s)",
+                (session_id, kind, turn, self._binary(_encode(message)))
+            )
+
+    def load_recent(self, session_id: str, kind: str, max_turns: int) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            "SELECT payload FROM chat_messages "
+            "WHERE session_id = %s AND kind = %s AND turn > ("
+            "    SELECT COALESCE(MAX(turn), 0) - %s FROM chat_messages WHERE session_id = %s"
+            ") ORDER BY id",
+            (session_id, kind, max_turns, session_id), fetch=True
+        )
+        return [_decode(row[0]) for row in rows]
+
+    def replace_last(self, session_id: str, kind: str, turn: int, message: Dict[str, Any]):
+        # Перезаписывает последнее сообщение хода, например ответ, уточненный точным результатом
+        self._execute(
+            "UPDATE chat_messages SET payload = %s WHERE id = ("
+            "    SELECT MAX(id) FROM chat_messages WHERE session_id = %s AND kind = %s AND turn = %s"
+            ")",
+            (self._binary(_encode(message)), session_id, kind, turn)
+        )
+
+    def clear(self, session_id: str):
+        self._execute("DELETE FROM chat_messages WHERE session_id = %s", (session_id,))
+        self._execute("DELETE FROM chat_sessions WHERE session_id = %s", (session_id,))
+
+    def expire_idle(self, idle_seconds: float) -> int:
+        threshold = time.time() - idle_seconds
+        expired = self._execute(
+            "SELECT session_id FROM chat_sessions WHERE last_active_at < %s",
+            (threshold,), fetch=True
+        )
+        for (session_id,) in expired:
+            self.clear(session_id)
+        if expired:
+            logger.info(f"Удалено неактивных сессий: {len(expired)}")
+        return len(expired)
+
+    @staticmethod
+    def _binary(payload: bytes):
+        return payload
+
+
+class SQLiteSessionStore(SessionStore):
+    placeholder = "?"
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._execute_script("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                last_active_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                turn INTEGER NOT NULL,
+                payload BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages(session_id, kind, turn);
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_active ON chat_sessions(last_active_at);
+        """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _execute_script(self, script: str):
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.executescript(script)
+            finally:
+                conn.close()
+
+    def _execute(self, sql: str, params=(), fetch: bool = False):
+        with self._lock:
+            conn = self._connect()
+            try:
+                cur = conn.execute(self._sql(sql), params)
+                rows = cur.fetchall() if fetch else None
+                conn.commit()
+                return rows
+            finally:
+                conn.close()
+
+
+class PostgresSessionStore(SessionStore):
+
+    def _execute(self, sql: str, params=(), fetch: bool = False):
+        from database.connection import pooled_connection
+
+        with pooled_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall() if fetch else None
+
+    @staticmethod
+    def _binary(payload: bytes):
+        import psycopg2
+        return psycopg2.Binary(payload)
+
+
+_store: Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> Optional[SessionStore]:
+    global _store
+
+    backend = os.getenv("SESSION_STORE", "sqlite").lower()
+    if backend == "memory":
+        return None
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if backend == "postgres":
+                    _store = PostgresSessionStore()
+                else:
+                    _store = SQLiteSessionStore(os.getenv("SESSION_DB_PATH", "data/sessions.sqlite3"))
+                logger.info(f"Хранилище сессий: {backend}")
+    return _store
+
+
+def session_limits() -> Dict[str, int]:
+    return {
+        "max_turns": int(os.getenv("SESSION_MAX_TURNS", "20")),
+        "max_bytes": int(os.getenv("SESSION_MAX_BYTES", str(512 * 1024))),
+        "resume_turns": int(os.getenv("SESSION_RESUME_TURNS", "10")),
+        "idle_seconds": int(os.getenv("SESSION_IDLE_SECONDS", str(7 * 24 * 3600))),
+    }
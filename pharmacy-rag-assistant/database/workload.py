@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import json
+import queue
+import random
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from psycopg2.extras import Json, execute_values
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import pooled_connection
+from utils.logger import setup_logger
+
+logger = setup_logger('workload', 'logs/workload.log')
+
+# Журнал выполненных запросов для database/index_advisor.py.
+# execute_sql() кладет запись в очередь и сразу возвращается; фоновый поток пачками пишет
+# в query_workload, а для первого выполнения каждого отпечатка снимает план EXPLAIN (FORMAT JSON).
+# Отпечаток - текст запроса без литералов: "топ по региону X" и "по региону Y" - один запрос.
+
+CAPTURE_ENABLED = os.getenv("WORKLOAD_CAPTURE", "on").lower() in ("1", "true", "on", "yes")
+SAMPLE_RATE = float(os.getenv("WORKLOAD_SAMPLE_RATE", "1.0"))
+QUEUE_SIZE = int(os.getenv("WORKLOAD_QUEUE_SIZE", "10000"))
+BATCH_SIZE = 200
+# Сколько отпечатков с уже снятым планом помнить в процессе
+PLANNED_CACHE_SIZE = 5000
+
+STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+PARAM_RE = re.compile(r"%\(\w+\)s|%s")
+WHITESPACE_RE = re.compile(r"\s+")
+LOG_ENTRY_RE = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} - [\w.]+ - \w+ - ", re.MULTILINE)
+LOG_SQL_MARKERS = ("SQL успешно сгенерирован: ", "Выполнение SQL: ")
+# sql_agent пишет в лог только первые 200 символов запроса
+LOG_SQL_TRUNCATED = 200
+
+INSERT_SQL = """
+    INSERT INTO query_workload (fingerprint, normalized_sql, sql_text, params, engine, duration_ms, row_count, error, plan)
+    VALUES %s
+"""
+
+
+def _dumps(value) -> str:
+    # Даты и Decimal в параметрах запросов сохраняются строками
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def normalize_sql(sql: str) -> str:
+    normalized = STRING_LITERAL_RE.sub("?", sql)
+    normalized = PARAM_RE.sub("?", normalized)
+    normalized = NUMBER_LITERAL_RE.sub("?", normalized)
+    return WHITESPACE_RE.sub(" ", normalized).strip().rstrip(";").strip().lower()
+
+
+def fingerprint(sql: str) -> str:
+    return hashlib.md5(normalize_sql(sql).encode("utf-8")).hexdigest()
+
+
+def explain(cur, sql: str, params=None, analyze: bool = False) -> Dict[str, Any]:
+    # VERBOSE добавляет Output узлов - по нему советник подбирает INCLUDE колонки
+    options = "ANALYZE, BUFFERS, VERBOSE, FORMAT JSON" if analyze else "VERBOSE, FORMAT JSON"
+    cur.execute(f"EXPLAIN ({options}) {sql.strip().rstrip(';')}", params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+class WorkloadRecorder:
+    def __init__(self):
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=QUEUE_SIZE)
+        self._planned: Dict[str, None] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def record(self, sql: str, params=None, engine: str = "postgres", duration_ms: Optional[float] = None,
+               row_count: Optional[int] = None, error: Optional[str] = None):
+        if not CAPTURE_ENABLED or random.random() >= SAMPLE_RATE:
+            return
+
+        entry = {
+            "sql": sql, "params": params, "engine": engine,
+            "duration_ms": duration_ms, "row_count": row_count, "error": error
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            # Журнал не должен тормозить ответы: при переполнении записи теряются
+            self.dropped += 1
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="workload-recorder", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.error(f"Не удалось записать {len(batch)} запросов в query_workload: {str(e)}")
+
+    def _needs_plan(self, key: str) -> bool:
+        if key in self._planned:
+            return False
+        self._planned[key] = None
+        if len(self._planned) > PLANNED_CACHE_SIZE:
+            self._planned.pop(next(iter(self._planned)))
+        return True
+
+    def write(self, entries: List[Dict[str, Any]]):
+        rows = []
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for entry in entries:
+                    normalized = normalize_sql(entry["sql"])
+                    key = hashlib.md5(normalized.encode("utf-8")).hexdigest()
+                    plan = None
+                    if entry["error"] is None and self._needs_plan(key):
+                        try:
+                            cur.execute("SAVEPOINT workload_plan")
+                            plan = explain(cur, entry["sql"], entry["params"])
+                            cur.execute("RELEASE SAVEPOINT workload_plan")
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO SAVEPOINT workload_plan")
+                            logger.info(f"EXPLAIN не выполнен для {key}: {str(e)[:200]}")
+
+                    rows.append((
+                        key, normalized, entry["sql"],
+                        Json(entry["params"], dumps=_dumps) if entry["params"] is not None else None,
+                        entry["engine"], entry["duration_ms"], entry["row_count"], entry["error"],
+                        Json(plan) if plan is not None else None
+                    ))
+                execute_values(cur, INSERT_SQL, rows)
+        logger.info(f"Записано запросов в query_workload: {len(rows)}")
+
+
+_recorder = WorkloadRecorder()
+
+
+def record_statement(sql: str, params=None, engine: str = "postgres", duration_ms: Optional[float] = None,
+                     row_count: Optional[int] = None, error: Optional[str] = None):
+    _recorder.record(sql, params, engine, duration_ms, row_count, error)
+
+
+def iter_logged_sql(log_path: Path) -> Iterator[str]:
+    # Многострочные записи лога: запись продолжается до следующей строки с отметкой времени
+    text = Path(log_path).read_text(encoding="utf-8")
+    starts = [match.end() for match in LOG_ENTRY_RE.finditer(text)]
+    ends = [match.start() for match in LOG_ENTRY_RE.finditer(text)][1:] + [len(text)]
+
+    for start, end in zip(starts, ends):
+        message = text[start:end].rstrip()
+        for marker in LOG_SQL_MARKERS:
+            if not message.startswith(marker):
+                continue
+            sql = message[len(marker):]
+            if marker.startswith("SQL успешно"):
+                sql = sql[:-3] if sql.endswith("...") else sql
+                if len(sql) >= LOG_SQL_TRUNCATED:
+                    # Обрезанный запрос не разобрать и не выполнить
+                    break
+            yield sql.strip()
+            break
+
+
+def import_log(log_path: Path) -> int:
+    # Запросы из старых логов агентов: без времени выполнения, план снимется при записи
+    entries = [
+        {"sql": sql, "params": None, "engine": "log", "duration_ms": None, "row_count": None, "error": None}
+        for sql in iter_logged_sql(log_path)
+    ]
+    if entries:
+        _recorder.write(entries)
+    return len(entries)
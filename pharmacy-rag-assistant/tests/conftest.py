@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Модули проекта импортируются так же, как в скриптах: от корня pharmacy-rag-assistant
+sys.path.append(str(Path(__file__).parent.parent))
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+import database.connection
+import tools.analytics_engine as analytics_engine
+from tools.analytics_engine import _to_duckdb_params, duckdb_unsafe_reason
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT region, SUM(revenue) AS revenue FROM sales GROUP BY region ORDER BY revenue DESC",
+    "SELECT EXTRACT(YEAR FROM date) AS year, COUNT(*) FROM sales GROUP BY 1",
+    "WITH t AS (SELECT region, SUM(profit) AS p FROM sales GROUP BY region) SELECT * FROM t",
+    "SELECT SUM(revenue) FILTER (WHERE units_sold > 0) FROM sales WHERE date >= %(date_from)s",
+    "SELECT * FROM sales WHERE product = 'a/b' -- комментарий с / делением",
+])
+def test_duckdb_safe_queries(sql):
+    assert duckdb_unsafe_reason(sql) is None
+
+
+@pytest.mark.parametrize("sql, reason", [
+    ("SELECT revenue / units_sold FROM sales", "деление"),
+    ("SELECT * FROM sales WHERE date > NOW() - INTERVAL '1 month'", "интервалы"),
+    ("SELECT TO_CHAR(date, 'YYYY-MM') FROM sales", "функция TO_CHAR"),
+    ("SELECT * FROM sales s, knowledge_base k", "перечисление таблиц через запятую"),
+    ("SELECT * FROM knowledge_base", "таблица knowledge_base"),
+    ("SELECT * FROM sales s JOIN sales_sample x ON x.id = s.id", "таблица sales_sample"),
+])
+def test_duckdb_unsafe_queries(sql, reason):
+    assert duckdb_unsafe_reason(sql) == reason
+
+
+def test_named_params_become_duckdb_named_and_unused_dropped():
+    sql, params = _to_duckdb_params(
+        "SELECT * FROM sales WHERE region = %(region)s AND product LIKE '%%а%%'", {"region": "Алматы", "limit": 5}
+    )
+
+    assert sql == "SELECT * FROM sales WHERE region = $region AND product LIKE '%а%'"
+    assert params == {"region": "Алматы"}
+
+
+def test_positional_params_become_question_marks():
+    sql, params = _to_duckdb_params("SELECT * FROM sales WHERE region = %s AND units_sold > %s", ["A", 1])
+
+    assert sql == "SELECT * FROM sales WHERE region = ? AND units_sold > ?"
+    assert params == ["A", 1]
+
+
+def test_without_params_percent_is_untouched():
+    sql = "SELECT * FROM sales WHERE product LIKE '%а%'"
+
+    assert _to_duckdb_params(sql, None) == (sql, None)
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    path = tmp_path / "sales.parquet"
+    monkeypatch.setenv("SALES_SNAPSHOT_PATH", str(path))
+    monkeypatch.setattr(analytics_engine, "_snapshot_check",
+                        {"checked_at": 0.0, "mtime": None, "fresh": False, "checking": False})
+
+    def write(marker):
+        table = pa.table({"id": [1, 2]})
+        if marker is not None:
+            table = table.replace_schema_metadata({analytics_engine.SNAPSHOT_MARKER_KEY: json.dumps(marker)})
+        pq.write_table(table, path)
+
+    return write
+
+
+def test_snapshot_fresh_when_marker_matches(snapshot, monkeypatch):
+    snapshot({"batch_id": 3, "max_id": 2})
+    calls = []
+    monkeypatch.setattr(database.connection, "execute_query",
+                        lambda *args, **kwargs: calls.append(args) or [{"batch_id": 3, "max_id": 2}])
+
+    assert analytics_engine.snapshot_is_fresh()
+    # Повторная проверка в пределах SNAPSHOT_CHECK_INTERVAL в Postgres не ходит
+    assert analytics_engine.snapshot_is_fresh()
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("marker", [{"batch_id": 2, "max_id": 2}, None])
+def test_snapshot_stale_after_new_load_or_without_marker(snapshot, monkeypatch, marker):
+    snapshot(marker)
+    monkeypatch.setattr(database.connection, "execute_query", lambda *args, **kwargs: [{"batch_id": 3, "max_id": 2}])
+
+    assert not analytics_engine.snapshot_is_fresh()
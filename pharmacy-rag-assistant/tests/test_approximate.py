@@ -0,0 +1,82 @@
+import pytest
+
+from tools.approximate import Z_95, _error_bounds, rewrite_for_sample
+
+
+def test_rewrite_scales_aggregates_by_weight():
+    sql = "SELECT region, SUM(revenue) AS rev, COUNT(*) AS n, AVG(price) AS p FROM sales s GROUP BY region"
+    rewritten = rewrite_for_sample(sql)
+
+    assert "SUM((revenue) * __w) AS rev" in rewritten
+    assert "SUM(__w) AS n" in rewritten
+    assert "SUM((price) * __w) / NULLIF(SUM(CASE WHEN (price) IS NOT NULL THEN __w END), 0)" in rewritten
+    assert "FROM (SELECT *, sample_weight * 1 AS __w FROM sales_sample) AS s" in rewritten
+
+
+def test_rewrite_half_sample_doubles_weight():
+    rewritten = rewrite_for_sample("SELECT region, SUM(revenue) FROM sales GROUP BY region;", half=1)
+
+    assert "sample_weight * 2 AS __w FROM sales_sample WHERE sample_half = 1) AS sales" in rewritten
+
+
+def test_rewrite_tablesample_source():
+    rewritten = rewrite_for_sample("SELECT SUM(units_sold) FROM sales", method="tablesample", half=0)
+
+    assert "TABLESAMPLE SYSTEM" in rewritten
+    assert "WHERE MOD(id, 2) = 0" in rewritten
+
+
+def test_rewrite_keeps_min_max_and_window_over_aggregate():
+    rewritten = rewrite_for_sample(
+        "SELECT category, MAX(price), SUM(revenue), SUM(SUM(revenue)) OVER () FROM sales GROUP BY category"
+    )
+
+    assert "MAX(price)" in rewritten
+    assert "SUM(SUM((revenue) * __w)) OVER ()" in rewritten
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM sales LIMIT 5",
+    "SELECT MAX(price) FROM sales",
+    "SELECT COUNT(DISTINCT product) FROM sales",
+    "SELECT SUM(amount) FROM knowledge_base",
+])
+def test_rewrite_returns_none_when_sample_cannot_answer(sql):
+    assert rewrite_for_sample(sql) is None
+
+
+def test_error_bounds_from_half_samples():
+    sql = "SELECT region, SUM(revenue) AS rev FROM sales GROUP BY region"
+    full = [{"region": "A", "rev": 100}, {"region": "B", "rev": 50}]
+    half_a = [{"region": "A", "rev": 90}, {"region": "B", "rev": 50}]
+    half_b = [{"region": "A", "rev": 110}, {"region": "B", "rev": 50}]
+
+    bounds = _error_bounds(sql, full, half_a, half_b)
+
+    assert bounds == {"rev": pytest.approx(Z_95 * 20 / 2 / 100)}
+
+
+def test_error_bounds_keyed_by_select_expressions_not_names():
+    # Ключ группы - неагрегатные выражения, поэтому MAX не считается оцениваемой колонкой
+    sql = "SELECT region, MAX(price) AS top, SUM(revenue) AS rev FROM sales GROUP BY region"
+    full = [{"region": "A", "top": 5, "rev": 100}]
+    half = [{"region": "A", "top": 5, "rev": 100}]
+
+    assert _error_bounds(sql, full, half, half) == {"rev": 0.0}
+
+
+def test_error_bounds_unknown_when_group_missing_in_half():
+    sql = "SELECT region, SUM(revenue) AS rev FROM sales GROUP BY region"
+    full = [{"region": "A", "rev": 100}]
+
+    assert _error_bounds(sql, full, [], [{"region": "A", "rev": 100}]) == {"rev": None}
+
+
+def test_error_bounds_disabled_for_select_star():
+    full = [{"region": "A", "rev": 100}]
+
+    assert _error_bounds("SELECT * FROM sales", full, full, full) == {"region": None, "rev": None}
+
+
+def test_error_bounds_empty_result():
+    assert _error_bounds("SELECT SUM(revenue) FROM sales", [], [], []) == {}
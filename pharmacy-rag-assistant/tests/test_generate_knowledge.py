@@ -0,0 +1,67 @@
+from decimal import Decimal
+
+from data.generate_knowledge import DIMENSIONS, SLICE_BY_MASK, SLICES, grouping_mask, iter_documents
+
+MASK_BY_SLICE = {name: mask for mask, name in SLICE_BY_MASK.items()}
+
+
+def row(slice_name, **values):
+    # Строка GROUPING SETS: колонки вне набора - NULL
+    base = {name: None for name in DIMENSIONS}
+    base.update({
+        "grouping_mask": MASK_BY_SLICE[slice_name], "total_sales": 10, "total_units": 20,
+        "total_revenue": Decimal("1000.00"), "total_profit": Decimal("200.00"), "avg_price": Decimal("50.00"),
+        "num_pharmacies": 3, "num_products": 4,
+    })
+    base.update(values)
+    return base
+
+
+def test_grouping_mask_bits_follow_grouping_arguments():
+    # GROUPING(product, category, region, pharmacy, month): первый аргумент - старший бит
+    assert grouping_mask(DIMENSIONS) == 0
+    assert grouping_mask(()) == 0b11111
+    assert grouping_mask(("product", "category")) == 0b00111
+    assert grouping_mask(("region", "month")) == 0b11010
+
+
+def test_slice_masks_are_unique():
+    assert len(SLICE_BY_MASK) == len(SLICES)
+
+
+def test_iter_documents_formats_slices():
+    documents = list(iter_documents([
+        row("product", product="Аспирин", category="Обезболивающие"),
+        row("region", region="Алматы"),
+    ]))
+
+    assert [kind for kind, _, _ in documents] == ["product", "region"]
+    kind, content, metadata = documents[0]
+    assert "Продукт: Аспирин" in content
+    assert metadata == {"product": "Аспирин", "category": "Обезболивающие", "total_revenue": 1000.0}
+
+
+def test_iter_documents_builds_trend_per_entity():
+    documents = list(iter_documents([
+        row("region_month", region="Алматы", month="2024-01", total_revenue=Decimal("100")),
+        row("region_month", region="Алматы", month="2024-02", total_revenue=Decimal("150")),
+        row("region_month", region="Шымкент", month="2024-01", total_revenue=Decimal("80")),
+        row("category_month", category="Витамины", month="2024-02", total_revenue=Decimal("40")),
+    ]))
+
+    trends = [(kind, metadata) for kind, _, metadata in documents if kind.endswith("_trend")]
+    assert trends == [
+        ("region_trend", {"region": "Алматы", "months": 2, "last_month": "2024-02", "last_revenue": 150.0}),
+        ("region_trend", {"region": "Шымкент", "months": 1, "last_month": "2024-01", "last_revenue": 80.0}),
+        ("category_trend", {"category": "Витамины", "months": 1, "last_month": "2024-02", "last_revenue": 40.0}),
+    ]
+    # Помесячный срез по региону - еще и отдельный документ, по продукту и категории - только динамика
+    assert [kind for kind, _, _ in documents].count("region_month") == 3
+
+    almaty = next(content for kind, content, metadata in documents
+                  if kind == "region_trend" and metadata["region"] == "Алматы")
+    assert "изменение к предыдущему: +50.0%" in almaty
+
+
+def test_iter_documents_empty():
+    assert list(iter_documents([])) == []
@@ -0,0 +1,70 @@
+from database.index_advisor import parse_keys, parse_predicates
+from database.workload import fingerprint, normalize_sql
+
+COLUMNS = ["id", "date", "region", "category", "product"]
+
+
+def test_parse_predicates_equality_and_ranges():
+    condition = (
+        "((s.region)::text = 'Алматы'::text) AND (s.date >= '2024-01-01'::date) "
+        "AND (s.date < '2025-01-01'::date)"
+    )
+
+    assert sorted(parse_predicates(condition, "s", COLUMNS)) == [
+        ("date", "<", "2025-01-01"),
+        ("date", ">=", "2024-01-01"),
+        ("region", "=", "Алматы"),
+    ]
+
+
+def test_parse_predicates_any_array():
+    condition = "((region)::text = ANY ('{A,B}'::text[]))"
+
+    assert parse_predicates(condition, "sales", COLUMNS) == [("region", "= ANY", "{A,B}")]
+
+
+def test_parse_predicates_escaped_quote_in_literal():
+    condition = "((sales.product)::text = 'Д''Артаньян'::text)"
+
+    assert parse_predicates(condition, "sales", COLUMNS) == [("product", "=", "Д''Артаньян")]
+
+
+def test_parse_predicates_skips_functions_and_or():
+    in_function = "(date_trunc('year'::text, (sales.date)::timestamp) = '2024-01-01 00:00:00'::timestamp)"
+    disjunction = "(((region)::text = 'A'::text) OR ((region)::text = 'B'::text))"
+
+    assert parse_predicates(in_function, "sales", COLUMNS) == []
+    assert parse_predicates(disjunction, "sales", COLUMNS) == []
+    assert parse_predicates("", "sales", COLUMNS) == []
+
+
+def test_parse_predicates_ignores_other_alias():
+    condition = "((p.region)::text = 'A'::text)"
+
+    assert parse_predicates(condition, "s", COLUMNS) == []
+
+
+def test_parse_keys_strips_order_and_casts():
+    keys = ["sales.region", "(sales.date) DESC", "sum(sales.revenue)", "sales.region", "other.category"]
+
+    assert parse_keys(keys, "sales", COLUMNS) == ["region", "date"]
+
+
+def test_normalize_sql_replaces_literals_and_params():
+    sql = "SELECT *\n  FROM sales WHERE region = 'Алматы' AND units_sold > 10.5 LIMIT %(limit)s;"
+
+    assert normalize_sql(sql) == "select * from sales where region = ? and units_sold > ? limit ?"
+
+
+def test_normalize_sql_escaped_quotes_and_positional_params():
+    sql = "select product from sales where product = 'Д''Артаньян' and date >= %s"
+
+    assert normalize_sql(sql) == "select product from sales where product = ? and date >= ?"
+
+
+def test_fingerprint_same_for_queries_differing_in_literals():
+    a = "SELECT SUM(revenue) FROM sales WHERE region = 'Алматы' LIMIT 10"
+    b = "select sum(revenue)  from sales where region = 'Шымкент' limit 5;"
+
+    assert fingerprint(a) == fingerprint(b)
+    assert fingerprint(a) != fingerprint("SELECT SUM(profit) FROM sales WHERE region = 'Алматы' LIMIT 10")
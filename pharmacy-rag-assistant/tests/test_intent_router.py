@@ -0,0 +1,111 @@
+import time
+from datetime import date
+
+import pytest
+
+import agents.intent_router as intent_router
+from agents.intent_router import DEFAULT_CATEGORIES, IntentRouter
+
+TODAY = date(2025, 1, 1)
+
+
+@pytest.fixture
+def router():
+    # Справочники заданы заранее: роутер не ходит в базу
+    router = IntentRouter()
+    router._reference = (TODAY, ["Алматы", "Шымкент"], ["Витамины", "Антибиотики"])
+    router._loaded_at = time.monotonic()
+    return router
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("за последние 3 месяца", [(date(2024, 10, 1), date(2025, 1, 1), "последние 3 мес.")]),
+    ("за прошлый месяц", [(date(2024, 12, 1), date(2025, 1, 1), "декабрь 2024")]),
+    ("за последний квартал", [(date(2024, 10, 1), date(2025, 1, 1), "4 квартал 2024")]),
+    ("за прошлый год", [(date(2024, 1, 1), date(2025, 1, 1), "2024 год")]),
+    ("во втором квартале 2024", [(date(2024, 4, 1), date(2024, 7, 1), "2 квартал 2024")]),
+    ("март 2024 и апрель 2024", [
+        (date(2024, 3, 1), date(2024, 4, 1), "март 2024"),
+        (date(2024, 4, 1), date(2024, 5, 1), "апрель 2024"),
+    ]),
+    ("в 2023", [(date(2023, 1, 1), date(2024, 1, 1), "2023 год")]),
+    ("2024 по сравнению с предыдущим годом", [
+        (date(2024, 1, 1), date(2025, 1, 1), "2024 год"),
+        (date(2023, 1, 1), date(2024, 1, 1), "2023 год"),
+    ]),
+])
+def test_parse_periods(router, text, expected):
+    periods = router._parse_periods(text, TODAY)
+
+    assert [(p["from"], p["to"], p["label"]) for p in periods] == expected
+
+
+def test_route_top_n(router):
+    match = router.route("Покажи топ-5 препаратов по выручке за 2024 год")
+
+    assert match["intent"] == "top_n"
+    assert match["dimension"] == "product"
+    assert match["params"] == {"date_from": date(2024, 1, 1), "date_to": date(2025, 1, 1), "limit": 5}
+
+
+def test_route_compare_periods_with_category(router):
+    match = router.route("Сравни выручку витаминов за 1 квартал 2024 с предыдущим")
+
+    assert match["intent"] == "compare_periods"
+    assert match["params"]["category"] == "Витамины"
+    assert (match["params"]["a_label"], match["params"]["b_label"]) == ("4 квартал 2023", "1 квартал 2024")
+
+
+def test_route_revenue_by_region(router):
+    match = router.route("Продажи по регионам за последний месяц")
+
+    assert match["intent"] == "revenue_by_region"
+    assert match["params"] == {"date_from": date(2024, 12, 1), "date_to": date(2025, 1, 1)}
+
+
+def test_route_category_monthly_trend(router):
+    match = router.route("Динамика продаж антибиотиков по месяцам за 2024")
+
+    assert match["intent"] == "category_monthly_trend"
+    assert match["params"]["category"] == "Антибиотики"
+
+
+@pytest.mark.parametrize("question", [
+    "Почему упали продажи?",
+    "Расскажи про аптеки в Шымкенте",
+    "Топ-3 препарата по регионам за 2024",
+])
+def test_route_leaves_other_questions_to_llm(router, question):
+    assert router.route(question) is None
+
+
+@pytest.mark.parametrize("text, values, expected", [
+    ("продажи витаминов в алматы", ["Алматы", "Витамины"], "Алматы"),
+    ("по жаропонижающим", ["Витамины", "Жаропонижающие"], "Жаропонижающие"),
+    ("сухой кашель", ["Ухо"], None),
+    ("мультивитаминные комплексы", ["Витамины"], None),
+])
+def test_find_value_matches_whole_words(text, values, expected):
+    assert IntentRouter._find_value(text, values) == expected
+
+
+def test_reference_falls_back_to_defaults_without_database(monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise RuntimeError("нет соединения")
+
+    monkeypatch.setattr(intent_router, "execute_query", unavailable)
+    today, regions, categories = IntentRouter().refresh()
+
+    assert regions == []
+    assert categories == DEFAULT_CATEGORIES
+    assert today == date.today()
+
+
+def test_stale_reference_served_while_refreshing(router, monkeypatch):
+    refreshed = []
+    monkeypatch.setattr(router, "refresh", lambda: refreshed.append(True))
+    router._loaded_at = time.monotonic() - router.cache_ttl - 1
+
+    assert router._load_reference() == (TODAY, ["Алматы", "Шымкент"], ["Витамины", "Антибиотики"])
+    router._refresh_thread.join(timeout=1)
+    assert refreshed == [True]
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from agents.llm_gateway import DEFAULT_TPM, LLMGateway, TokenBucket, _parse_limits
+from utils.cancellation import DeadlineExceeded, TurnContext, turn_scope
+
+
+def test_bucket_starts_full():
+    bucket = TokenBucket(600)
+
+    assert bucket.acquire(600) < 0.05
+    assert bucket.tokens < 1
+
+
+def test_bucket_waits_for_refill():
+    bucket = TokenBucket(6000)  # 100 в секунду
+    bucket.acquire(6000)
+
+    waited = bucket.acquire(10)
+
+    assert 0.05 < waited < 0.5
+
+
+def test_bucket_request_above_capacity_passes_when_full():
+    bucket = TokenBucket(60)
+
+    assert bucket.acquire(1_000) < 0.05
+
+
+def test_bucket_adjust_returns_and_charges_tokens():
+    bucket = TokenBucket(600)
+    bucket.acquire(500)
+
+    bucket.adjust(-300)
+    assert bucket.tokens == pytest.approx(400, abs=1)
+
+    bucket.adjust(1_000)
+    assert bucket.tokens < 0
+
+
+def test_parse_limits():
+    assert _parse_limits("gpt-4o=500:30000, text-embedding-3-small=3000") == {
+        "gpt-4o": (500, 30000),
+        "text-embedding-3-small": (3000, DEFAULT_TPM),
+    }
+
+
+class _Response:
+    usage = None
+
+
+def test_coalesced_request_outlives_first_callers_deadline():
+    calls = []
+
+    def send(**params):
+        calls.append(params)
+        time.sleep(0.4)
+        return _Response()
+
+    gateway = LLMGateway(client=object())
+    outcome = {}
+
+    def short_turn():
+        with turn_scope(TurnContext(0.2)):
+            try:
+                gateway._call("chat", {"model": "m"}, send)
+            except DeadlineExceeded:
+                outcome["short"] = "deadline"
+
+    def long_turn():
+        time.sleep(0.05)
+        with turn_scope(TurnContext(5)):
+            outcome["long"] = gateway._call("chat", {"model": "m"}, send)
+
+    threads = [threading.Thread(target=short_turn), threading.Thread(target=long_turn)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Один запрос на двоих: первый ход перестал ждать по своему дедлайну, второй получил ответ
+    assert len(calls) == 1
+    assert outcome["short"] == "deadline"
+    assert isinstance(outcome["long"], _Response)
+    assert gateway.metrics()["m"]["coalesced"] == 1
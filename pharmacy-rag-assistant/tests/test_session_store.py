@@ -0,0 +1,67 @@
+import json
+
+from database.session_store import HISTORY, TOOL_ROWS_KEPT, TRANSCRIPT, SQLiteSessionStore, trim_history
+
+
+def turn(n, tool_rows=0):
+    messages = [{"role": "user", "content": f"вопрос {n}"}]
+    if tool_rows:
+        messages.append({"role": "assistant", "content": None, "tool_calls": [{"id": f"call_{n}"}]})
+        messages.append({
+            "role": "tool", "tool_call_id": f"call_{n}",
+            "content": json.dumps({"data": [{"value": i} for i in range(tool_rows)]})
+        })
+    messages.append({"role": "assistant", "content": f"ответ {n}"})
+    return messages
+
+
+def test_trim_history_keeps_last_turns():
+    history = turn(1) + turn(2, tool_rows=3) + turn(3)
+
+    trimmed = trim_history(history, max_turns=2, max_bytes=10_000)
+
+    assert trimmed == turn(2, tool_rows=3) + turn(3)
+
+
+def test_trim_history_by_size_cuts_at_user_messages():
+    history = turn(1, tool_rows=200) + turn(2) + turn(3)
+    limit = sum(len(json.dumps(m, ensure_ascii=False)) for m in turn(2) + turn(3))
+
+    trimmed = trim_history(history, max_turns=10, max_bytes=limit)
+
+    # Вызов инструмента и его ответ уходят вместе со своим ходом
+    assert trimmed == turn(2) + turn(3)
+    assert trimmed[0]["role"] == "user"
+
+
+def test_trim_history_keeps_last_turn_even_over_size():
+    history = turn(1) + turn(2, tool_rows=500)
+
+    assert trim_history(history, max_turns=10, max_bytes=10) == turn(2, tool_rows=500)
+
+
+def test_trim_history_without_limits_hit():
+    history = turn(1) + turn(2)
+
+    assert trim_history(history, max_turns=5, max_bytes=100_000) == history
+
+
+def test_sqlite_store_round_trip(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    for n in (1, 2, 3):
+        store.append("s1", HISTORY, n, turn(n, tool_rows=TOOL_ROWS_KEPT + 10 if n == 3 else 0))
+    store.append("s1", TRANSCRIPT, 3, [{"role": "assistant", "content": "черновик"}])
+
+    assert store.last_turn("s1") == 3
+    recent = store.load_recent("s1", HISTORY, 2)
+    assert [m["content"] for m in recent if m["role"] == "user"] == ["вопрос 2", "вопрос 3"]
+    # Ответы инструментов хранятся урезанными до TOOL_ROWS_KEPT строк
+    tool = json.loads(next(m for m in recent if m["role"] == "tool")["content"])
+    assert len(tool["data"]) == TOOL_ROWS_KEPT and tool["truncated"]
+
+    store.replace_last("s1", TRANSCRIPT, 3, {"role": "assistant", "content": "уточнено"})
+    assert store.load_recent("s1", TRANSCRIPT, 1) == [{"role": "assistant", "content": "уточнено"}]
+
+    store.clear("s1")
+    assert store.last_turn("s1") == 0
+    assert store.load_recent("s1", HISTORY, 5) == []
@@ -0,0 +1,270 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from functools import lru_cache
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from utils.cancellation import cancellable
+from utils.logger import setup_logger
+
+logger = setup_logger('analytics_engine', 'logs/analytics_engine.log')
+
+# Колоночный снимок sales в Parquet + встроенный DuckDB для агрегаций (ANALYTICS_ENGINE=duckdb).
+# Postgres остается источником истины: снимок обновляет data/load_data.py, в DuckDB идут только
+# запросы к sales из конструкций, которые оба движка считают одинаково, и только пока метка изменений,
+# записанная в снимок при выгрузке, совпадает с текущей в Postgres. Все остальное выполняет Postgres.
+
+SNAPSHOT_BATCH_SIZE = 200_000
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "60"))
+# Метка изменений sales: последняя загрузка из журнала sales_change_batches и максимальный id строки.
+# Оба значения читаются по первичным ключам, без прохода по таблице
+CHANGE_MARKER_SQL = """
+SELECT (SELECT MAX(id) FROM sales_change_batches) AS batch_id, (SELECT MAX(id) FROM sales) AS max_id
+"""
+SNAPSHOT_MARKER_KEY = b"sales_change_marker"
+
+# Функции с одинаковым результатом в DuckDB и Postgres; TO_CHAR, AGE, NOW() и прочие уходят в Postgres
+DUCKDB_SAFE_FUNCTIONS = {
+    "SUM", "COUNT", "AVG", "MIN", "MAX", "ROUND", "COALESCE", "NULLIF", "ABS", "LOWER", "UPPER",
+    "DATE_TRUNC", "EXTRACT", "CAST", "ROW_NUMBER", "RANK", "DENSE_RANK", "LAG", "LEAD",
+}
+# Ключевые слова, после которых тоже стоит "(": подзапросы, списки IN, OVER (...), FILTER (...)
+SQL_KEYWORDS = {
+    "SELECT", "FROM", "JOIN", "ON", "WHERE", "AND", "OR", "NOT", "IN", "EXISTS", "AS", "WITH",
+    "BY", "HAVING", "OVER", "FILTER", "WHEN", "THEN", "ELSE", "ANY", "DISTINCT", "UNION", "ALL",
+}
+
+SALES_COLUMNS = [
+    "id", "date", "region", "pharmacy", "category", "product",
+    "units_sold", "price", "cost_price", "revenue", "profit", "created_at"
+]
+
+_db = None
+_db_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def duckdb_available() -> bool:
+    # Сам duckdb импортируется только при первом запросе: проверка наличия не стоит времени старта
+    return find_spec("duckdb") is not None
+
+
+_snapshot_check = {"checked_at": 0.0, "mtime": None, "fresh": False, "checking": False}
+_snapshot_lock = threading.Lock()
+
+
+def snapshot_path() -> Path:
+    return Path(os.getenv("SALES_SNAPSHOT_PATH", "data/snapshots/sales.parquet"))
+
+
+def is_duckdb_enabled() -> bool:
+    if not duckdb_available() or os.getenv("ANALYTICS_ENGINE", "postgres").lower() != "duckdb":
+        return False
+    return snapshot_path().exists()
+
+
+def duckdb_unsafe_reason(sql_query: str) -> Optional[str]:
+    # Почему запрос нельзя отдать DuckDB (None - можно): различия диалектов меняют
+    # результат молча, поэтому маршрутизируем только заведомо одинаковые конструкции
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql_query)
+    sql = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.DOTALL)
+    sql = re.sub(r"%\(\w+\)s|%s", "?", sql).upper()
+
+    if "/" in sql:
+        # 7 / 2 в Postgres дает 3, в DuckDB 3.5
+        return "деление"
+    if re.search(r"\bINTERVAL\b", sql):
+        return "интервалы"
+
+    for name in re.findall(r"\b([A-Z_][A-Z0-9_]*)\s*\(", sql):
+        if name not in DUCKDB_SAFE_FUNCTIONS and name not in SQL_KEYWORDS:
+            return f"функция {name}"
+
+    ctes = set(re.findall(r"\b([A-Z_][A-Z0-9_]*)\s+AS\s*\(", sql))
+    # FROM внутри EXTRACT(... FROM date) - не таблица
+    sql = re.sub(r"\bEXTRACT\s*\(\s*\w+\s+FROM\b", "EXTRACT(", sql)
+    if re.search(r"\bFROM\s+[A-Z_][A-Z0-9_.]*(?:\s+(?:AS\s+)?[A-Z_][A-Z0-9_]*)?\s*,", sql):
+        return "перечисление таблиц через запятую"
+    for table in re.findall(r"\b(?:FROM|JOIN)\s+([A-Z_][A-Z0-9_.]*)", sql):
+        if table != "SALES" and table not in ctes:
+            return f"таблица {table.lower()}"
+    return None
+
+
+def is_engine_limitation(error: Exception) -> bool:
+    # Снимок недоступен или DuckDB не поддерживает конструкцию - такой запрос стоит повторить в Postgres.
+    # Ошибки в самом запросе (колонка, тип) Postgres тоже не выполнит, повтор только удвоит время
+    import duckdb
+
+    return isinstance(error, (duckdb.IOException, duckdb.NotImplementedException, duckdb.ParserException))
+
+
+def _snapshot_marker(path: Path) -> Optional[Dict[str, Any]]:
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(path).metadata or {}
+    if SNAPSHOT_MARKER_KEY not in metadata:
+        return None
+    return json.loads(metadata[SNAPSHOT_MARKER_KEY])
+
+
+def _check_snapshot(path: Path) -> bool:
+    from database.connection import execute_query
+
+    try:
+        snapshot = _snapshot_marker(path)
+        if snapshot is None:
+            logger.warning("В снимке нет метки изменений (выгружен старой версией), запросы идут в Postgres до его обновления")
+            return False
+        current = execute_query(CHANGE_MARKER_SQL)[0]
+        fresh = (current["batch_id"], current["max_id"]) == (snapshot["batch_id"], snapshot["max_id"])
+        if not fresh:
+            logger.warning(
+                f"Снимок устарел (Postgres: загрузка {current['batch_id']}, max id {current['max_id']}; "
+                f"снимок: {snapshot['batch_id']}, {snapshot['max_id']}), запросы идут в Postgres"
+            )
+        return fresh
+    except Exception as e:
+        logger.warning(f"Не удалось сверить снимок с Postgres: {str(e)}")
+        return False
+
+
+def snapshot_is_fresh() -> bool:
+    # Снимок обновляет только data/load_data.py: если после выгрузки была новая загрузка или в sales
+    # появились строки другим путем, DuckDB ответил бы по старым данным. Сверка метки с Postgres не чаще
+    # раза в SNAPSHOT_CHECK_INTERVAL секунд и сразу после подмены файла. Сверяет один поток и без блокировки:
+    # остальные тем временем получают прошлый результат, а непроверенный новый снимок считается устаревшим
+    path = snapshot_path()
+    mtime = path.stat().st_mtime
+    with _snapshot_lock:
+        state = _snapshot_check
+        current = state["mtime"] == mtime
+        if state["checking"] or (current and time.monotonic() - state["checked_at"] < SNAPSHOT_CHECK_INTERVAL):
+            return current and state["fresh"]
+        state["checking"] = True
+
+    fresh = None
+    try:
+        fresh = _check_snapshot(path)
+    finally:
+        with _snapshot_lock:
+            state["checking"] = False
+            # Прерванная ходом сверка (дедлайн, отмена) не запоминается
+            if fresh is not None:
+                state.update(checked_at=time.monotonic(), mtime=mtime, fresh=fresh)
+    return fresh
+
+
+def _get_db():
+    global _db
+
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                import duckdb
+
+                threads = int(os.getenv("DUCKDB_THREADS", str(os.cpu_count() or 4)))
+                db = duckdb.connect(database=":memory:", config={"threads": threads})
+                # Представление читает файл при каждом запросе, поэтому подмена снимка видна сразу
+                path = str(snapshot_path().resolve()).replace("'", "''")
+                db.execute(f"CREATE OR REPLACE VIEW sales AS SELECT * FROM read_parquet('{path}')")
+                _db = db
+                logger.info(f"DuckDB инициализирован, потоков: {threads}, снимок: {path}")
+    return _db
+
+
+def _to_duckdb_params(sql_query: str, params):
+    # psycopg2: %(name)s / %s / %%  ->  DuckDB: $name / ? / %
+    if isinstance(params, dict):
+        sql_query = re.sub(r"%\((\w+)\)s", r"$\1", sql_query)
+        # DuckDB не принимает лишние именованные параметры
+        used = set(re.findall(r"\$(\w+)", sql_query))
+        params = {key: value for key, value in params.items() if key in used}
+    elif params:
+        sql_query = re.sub(r"(?<!%)%s", "?", sql_query)
+    else:
+        # Без параметров psycopg2 не трогает %, значит и здесь нечего заменять
+        return sql_query, params
+    return sql_query.replace("%%", "%"), params
+
+
+def execute_duckdb(sql_query: str, params=None) -> List[Dict[str, Any]]:
+    sql_query, params = _to_duckdb_params(sql_query, params)
+
+    cur = _get_db().cursor()
+    try:
+        # Остановка хода прерывает запрос DuckDB через interrupt()
+        with cancellable(cur.interrupt):
+            if params:
+                cur.execute(sql_query, params)
+            else:
+                cur.execute(sql_query)
+            columns = [d[0] for d in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+
+def export_sales_snapshot(path: Optional[Path] = None, batch_size: int = SNAPSHOT_BATCH_SIZE) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from database.connection import get_connection
+
+    path = Path(path or snapshot_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".parquet.tmp")
+
+    schema = pa.schema([
+        ("id", pa.int32()),
+        ("date", pa.date32()),
+        ("region", pa.string()),
+        ("pharmacy", pa.string()),
+        ("category", pa.string()),
+        ("product", pa.string()),
+        ("units_sold", pa.int32()),
+        ("price", pa.decimal128(10, 2)),
+        ("cost_price", pa.decimal128(10, 2)),
+        ("revenue", pa.decimal128(10, 2)),
+        ("profit", pa.decimal128(10, 2)),
+        ("created_at", pa.timestamp("us")),
+    ])
+
+    conn = get_connection()
+    total = 0
+    try:
+        # Метка и строки читаются в одном снимке транзакции: метка описывает ровно выгруженные данные
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cur:
+            cur.execute(CHANGE_MARKER_SQL)
+            batch_id, max_id = cur.fetchone()
+        schema = schema.with_metadata({SNAPSHOT_MARKER_KEY: json.dumps({"batch_id": batch_id, "max_id": max_id})})
+
+        # Серверный курсор: в памяти одновременно не больше одной пачки строк
+        with conn.cursor(name="sales_snapshot") as cur, pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+            cur.itersize = batch_size
+            cur.execute(f"SELECT {', '.join(SALES_COLUMNS)} FROM sales ORDER BY date, id")
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                total += len(rows)
+        conn.rollback()
+    finally:
+        conn.close()
+
+    # Атомарная подмена: читатели видят либо старый, либо новый снимок целиком
+    os.replace(tmp_path, path)
+    logger.info(f"Снимок sales обновлен: {total} строк, загрузка {batch_id}, {path}")
+    return total
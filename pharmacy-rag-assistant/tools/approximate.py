@@ -0,0 +1,357 @@
+import os
+import re
+import sys
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import execute_query, get_connection
+from database.session_store import apply_refinement
+from tools.sql_executor import execute_safe_sql, validate_sql
+from tools.visualizer import figure_to_dict
+from utils.logger import setup_logger
+
+logger = setup_logger('approximate', 'logs/approximate.log')
+
+# Приблизительное исполнение агрегатов: запрос переписывается на стратифицированную
+# выборку sales_sample (или TABLESAMPLE), суммы и счетчики масштабируются весами строк.
+# Погрешность оценивается по двум независимым половинам выборки:
+# Var(полная оценка) ~ (A - B)^2 / 4, граница 95% = 1.96 * |A - B| / 2.
+
+Z_95 = 1.96
+
+AGGREGATE_RE = re.compile(r"\b(SUM|COUNT|AVG|MIN|MAX)\s*\(", re.IGNORECASE)
+SOURCE_RE = re.compile(
+    r"\b(FROM|JOIN)\s+sales\b(?!\s*\()"
+    r"(?:\s+(?:AS\s+)?(?!(?:WHERE|GROUP|ORDER|LIMIT|JOIN|LEFT|RIGHT|INNER|FULL|CROSS|ON|UNION|HAVING|WINDOW|OFFSET)\b)([a-zA-Z_]\w*))?",
+    re.IGNORECASE
+)
+
+SAMPLE_REFRESH_SQL = """
+INSERT INTO sales_sample
+SELECT
+    id, date, region, pharmacy, category, product,
+    units_sold, price, cost_price, revenue, profit, created_at,
+    stratum_rows::numeric / LEAST(stratum_rows, GREATEST(CEIL(stratum_rows * %(fraction)s), %(min_rows)s)) AS sample_weight,
+    (rn %% 2)::smallint AS sample_half
+FROM (
+    SELECT
+        s.*,
+        ROW_NUMBER() OVER (PARTITION BY region, category, DATE_TRUNC('month', date) ORDER BY random()) AS rn,
+        COUNT(*) OVER (PARTITION BY region, category, DATE_TRUNC('month', date)) AS stratum_rows
+    FROM sales s
+) ranked
+WHERE rn <= GREATEST(CEIL(stratum_rows * %(fraction)s), %(min_rows)s)
+"""
+
+
+def is_approximate_enabled() -> bool:
+    return os.getenv("APPROX_MODE", "off").lower() in ("1", "on", "true", "yes")
+
+
+def refresh_sales_sample(fraction: Optional[float] = None, min_rows: Optional[int] = None) -> int:
+    fraction = fraction or float(os.getenv("APPROX_SAMPLE_FRACTION", "0.02"))
+    min_rows = min_rows or int(os.getenv("APPROX_MIN_PER_STRATUM", "30"))
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            # DELETE вместо TRUNCATE: читатели видят старую выборку до коммита
+            cur.execute("DELETE FROM sales_sample")
+            cur.execute(SAMPLE_REFRESH_SQL, {"fraction": fraction, "min_rows": min_rows})
+            inserted = cur.rowcount
+        conn.commit()
+
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE sales_sample")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    logger.info(f"Выборка sales_sample обновлена: {inserted} строк, доля {fraction}, минимум на страту {min_rows}")
+    return inserted
+
+
+# --- переписывание запроса -------------------------------------------------
+
+def _find_closing(sql: str, start: int) -> int:
+    depth = 0
+    quote = None
+    for i in range(start, len(sql)):
+        ch = sql[i]
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Несбалансированные скобки в SQL")
+
+
+def _rewrite_aggregates(sql: str) -> Optional[str]:
+    out = []
+    pos = 0
+
+    while True:
+        match = AGGREGATE_RE.search(sql, pos)
+        if not match:
+            break
+
+        name = match.group(1).upper()
+        open_paren = match.end() - 1
+        close_paren = _find_closing(sql, open_paren)
+        inner = _rewrite_aggregates(sql[open_paren + 1:close_paren])
+        if inner is None:
+            return None
+        inner = inner.strip()
+
+        out.append(sql[pos:match.start()])
+        pos = close_paren + 1
+
+        # Оконная функция поверх агрегатов (SUM(SUM(x)) OVER ()) и MIN/MAX не масштабируются:
+        # переписываем только внутреннюю часть
+        if name in ("MIN", "MAX") or re.match(r"\s*OVER\b", sql[pos:], re.IGNORECASE):
+            out.append(f"{match.group(1)}({inner})")
+            continue
+
+        # COUNT(DISTINCT ...) по выборке не оценить умножением на вес - такой запрос идет точным
+        if re.match(r"DISTINCT\b", inner, re.IGNORECASE):
+            return None
+        if name == "SUM":
+            out.append(f"SUM(({inner}) * __w)")
+        elif name == "COUNT":
+            out.append("SUM(__w)" if inner == "*" else f"SUM(CASE WHEN ({inner}) IS NOT NULL THEN __w END)")
+        else:
+            out.append(f"(SUM(({inner}) * __w) / NULLIF(SUM(CASE WHEN ({inner}) IS NOT NULL THEN __w END), 0))")
+
+    out.append(sql[pos:])
+    return "".join(out)
+
+
+def _sample_source(method: str, half: Optional[int]) -> str:
+    if method == "tablesample":
+        percent = float(os.getenv("APPROX_TABLESAMPLE_PERCENT", "2"))
+        sampling = os.getenv("APPROX_TABLESAMPLE_METHOD", "SYSTEM").upper()
+        weight = 100.0 / percent * (2 if half is not None else 1)
+        where = f" WHERE MOD(id, 2) = {half}" if half is not None else ""
+        return f"SELECT *, {weight}::numeric AS __w FROM sales TABLESAMPLE {sampling} ({percent}) REPEATABLE (42){where}"
+
+    scale = 2 if half is not None else 1
+    where = f" WHERE sample_half = {half}" if half is not None else ""
+    return f"SELECT *, sample_weight * {scale} AS __w FROM sales_sample{where}"
+
+
+def rewrite_for_sample(sql: str, method: str = "sample_table", half: Optional[int] = None) -> Optional[str]:
+    sql = sql.strip().rstrip(";")
+    if not SOURCE_RE.search(sql) or not AGGREGATE_RE.search(sql):
+        return None
+
+    rewritten = _rewrite_aggregates(sql)
+    if rewritten is None or "__w" not in rewritten:
+        return None
+
+    source = _sample_source(method, half)
+    return SOURCE_RE.sub(lambda m: f"{m.group(1)} ({source}) AS {m.group(2) or 'sales'}", rewritten)
+
+
+# --- исполнение ------------------------------------------------------------
+
+KEYWORD_RE = re.compile(r"\b(SELECT|FROM)\b", re.IGNORECASE)
+
+
+def _top_level_select_items(sql: str) -> Optional[List[str]]:
+    # Выражения внешнего SELECT: подзапросы и CTE в скобках пропускаются; None - не разобрали
+    depth = 0
+    quote = None
+    start = None
+    items = []
+    for i, ch in enumerate(sql):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif depth == 0 and ch == "," and start is not None:
+            items.append(sql[start:i])
+            start = i + 1
+        elif depth == 0 and ch.isalpha() and (i == 0 or not (sql[i - 1].isalnum() or sql[i - 1] == "_")):
+            keyword = KEYWORD_RE.match(sql, i)
+            if keyword is None:
+                continue
+            if keyword.group(1).upper() == "SELECT" and start is None:
+                start = keyword.end()
+            elif keyword.group(1).upper() == "FROM" and start is not None:
+                items.append(sql[start:i])
+                return [item.strip() for item in items]
+    return None
+
+
+def _split_columns(sql: str, columns: List[str]):
+    # Ключ группы - неагрегатные выражения SELECT, оцениваемые колонки - масштабируемые агрегаты
+    # (те, что _rewrite_aggregates переписал через вес __w). Колонки сопоставляются по позиции,
+    # поэтому SELECT * или совпадающие имена колонок оценку погрешности отключают
+    items = _top_level_select_items(sql)
+    if items is None or len(items) != len(columns):
+        return None
+
+    keys, measures = [], []
+    for item, column in zip(items, columns):
+        if not AGGREGATE_RE.search(item):
+            keys.append(column)
+        elif "__w" in (_rewrite_aggregates(item) or ""):
+            measures.append(column)
+    return keys, measures
+
+
+def _row_key(row: Dict[str, Any], key_columns: List[str]):
+    return tuple(row[c] for c in key_columns)
+
+
+def _error_bounds(sql: str, full: List[Dict], half_a: List[Dict], half_b: List[Dict]) -> Dict[str, Optional[float]]:
+    if not full:
+        return {}
+
+    columns = _split_columns(sql, list(full[0].keys()))
+    if columns is None:
+        return {column: None for column in full[0]}
+    keys, measures = columns
+
+    index_a = {_row_key(r, keys): r for r in half_a}
+    index_b = {_row_key(r, keys): r for r in half_b}
+
+    bounds: Dict[str, Optional[float]] = {}
+    for column in measures:
+        worst = 0.0
+        for row in full:
+            a = index_a.get(_row_key(row, keys))
+            b = index_b.get(_row_key(row, keys))
+            value = row[column]
+            if a is None or b is None or a[column] is None or b[column] is None or value is None:
+                worst = None
+                break
+            if float(value) == 0:
+                continue
+            worst = max(worst, Z_95 * abs(float(a[column]) - float(b[column])) / 2 / abs(float(value)))
+        bounds[column] = worst
+    return bounds
+
+
+def execute_approximate(sql: str, params=None) -> Optional[Dict[str, Any]]:
+    if not validate_sql(sql):
+        raise Exception("Запрос содержит запрещенные операции. Разрешены только SELECT запросы.")
+
+    method = os.getenv("APPROX_SOURCE", "sample_table")
+    full_sql = rewrite_for_sample(sql, method)
+    if full_sql is None:
+        return None
+
+    full = [dict(r) for r in execute_query(full_sql, params)]
+    half_a = [dict(r) for r in execute_query(rewrite_for_sample(sql, method, half=0), params)]
+    half_b = [dict(r) for r in execute_query(rewrite_for_sample(sql, method, half=1), params)]
+
+    bounds = _error_bounds(sql, full, half_a, half_b)
+    known = [b for b in bounds.values() if b is not None]
+    relative_error = max(known) if known and len(known) == len(bounds) else None
+
+    logger.info(f"Приблизительный ответ ({method}): {len(full)} строк, погрешность: {relative_error}")
+    return {
+        "data": full,
+        "approximate": True,
+        "relative_error": relative_error,
+        "error_bounds": bounds,
+        "sample_source": method
+    }
+
+
+# --- фоновое точное исполнение ----------------------------------------------
+
+MAX_REFINEMENTS = 500
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("APPROX_EXACT_WORKERS", "2")), thread_name_prefix="exact")
+_refinements: "OrderedDict[str, Any]" = OrderedDict()
+_refinements_lock = threading.Lock()
+
+
+def _run_exact(sql: str, params, render: Optional[Callable[[List[Dict]], Dict[str, Any]]]) -> Dict[str, Any]:
+    rows = execute_safe_sql(sql, params)
+    result = {"data": rows}
+    if render is not None:
+        result.update(render(rows))
+    logger.info(f"Точный запрос выполнен: {len(rows)} строк")
+    return result
+
+
+def submit_exact(sql: str, params=None, render: Optional[Callable[[List[Dict]], Dict[str, Any]]] = None) -> str:
+    # render получает точные строки и возвращает то, чем UI заменит приблизительный ответ (figure, response)
+    refinement_id = uuid.uuid4().hex
+    future = _executor.submit(_run_exact, sql, params, render)
+    with _refinements_lock:
+        _refinements[refinement_id] = future
+        while len(_refinements) > MAX_REFINEMENTS:
+            _refinements.popitem(last=False)
+    return refinement_id
+
+
+def get_refinement(refinement_id: str) -> Dict[str, Any]:
+    with _refinements_lock:
+        future = _refinements.get(refinement_id)
+
+    if future is None:
+        return {"status": "unknown"}
+    if not future.done():
+        return {"status": "pending"}
+    if future.exception() is not None:
+        return {"status": "error", "error": str(future.exception())}
+    return {"status": "done", **future.result()}
+
+
+def on_refined(refinement_id: str, callback: Callable[[Dict[str, Any]], None]):
+    # callback(get_refinement(...)) вызывается в потоке точных запросов, когда запрос завершится
+    with _refinements_lock:
+        future = _refinements.get(refinement_id)
+    if future is None:
+        return
+
+    def done(_):
+        try:
+            callback(get_refinement(refinement_id))
+        except Exception as e:
+            logger.error(f"Не удалось применить точный результат {refinement_id}: {str(e)}", exc_info=True)
+
+    future.add_done_callback(done)
+
+
+def persist_refinements(refinements: List[Dict[str, Any]], message: Dict[str, Any], save: Callable[[Dict[str, Any]], None]):
+    # Сохраненный ответ (транскрипт) уточняется точными результатами, даже если UI уже закрыт;
+    # message - словарь сообщения транскрипта с графиками в JSON, save перезаписывает его в хранилище
+    lock = threading.Lock()
+
+    def apply(refinement: Dict[str, Any], exact: Dict[str, Any]):
+        if exact["status"] != "done":
+            return
+        if exact.get("figure") is not None:
+            exact = {**exact, "figure": figure_to_dict(exact["figure"])}
+        with lock:
+            apply_refinement(message, refinement, exact)
+            save(message)
+
+    for refinement in refinements:
+        on_refined(refinement["id"], partial(apply, refinement))
@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import queue
+import threading
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator, Optional
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from psycopg2.extensions import encodings
+
+from database.connection import get_connection
+from tools.sql_executor import validate_sql
+from utils.logger import setup_logger
+
+logger = setup_logger('export', 'logs/export.log')
+
+# Выгрузка полного результата запроса в CSV или Parquet без сборки строк в памяти Python:
+# CSV отдает сам Postgres через COPY (...) TO STDOUT, Parquet пишется из серверного курсора
+# пачками по EXPORT_BATCH_ROWS. Запрос выполняется заново в Postgres (источник истины),
+# на отдельном соединении: выгрузка миллионов строк не занимает пул агентов.
+
+EXPORT_FORMATS = ("csv", "parquet")
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "parquet": "application/vnd.apache.parquet"}
+BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50000"))
+EXPORT_DIR = Path(os.getenv("EXPORT_DIR", "data/exports"))
+EXPORT_TTL_SECONDS = int(os.getenv("EXPORT_TTL_SECONDS", "3600"))
+# Сколько кусков может ждать медленного клиента: остальное ждет в Postgres, а не в памяти
+QUEUE_CHUNKS = 64
+
+# OID типов Postgres -> тип колонки Parquet; все остальное пишется строкой
+PARQUET_TYPES = {
+    16: "bool",
+    20: "int64", 21: "int64", 23: "int64",
+    700: "float64", 701: "float64",
+    # numeric агрегатов не имеет фиксированной точности, поэтому float64
+    1700: "float64",
+    1082: "date32",
+    1114: "timestamp",
+    1184: "timestamptz",
+}
+
+
+def _prepare(cur, sql_query: str, params=None) -> str:
+    if not validate_sql(sql_query):
+        raise ValueError("Запрос содержит запрещенные операции. Разрешены только SELECT запросы.")
+    # COPY не принимает параметры запроса, поэтому они подставляются на клиенте через mogrify
+    sql_query = sql_query.strip().rstrip(";")
+    if params:
+        sql_query = cur.mogrify(sql_query, params).decode(encodings[cur.connection.encoding])
+    return sql_query
+
+
+def _write_csv(conn, sql_query: str, params, out: BinaryIO):
+    with conn.cursor() as cur:
+        sql_query = _prepare(cur, sql_query, params)
+        cur.copy_expert(f"COPY ({sql_query}) TO STDOUT WITH (FORMAT csv, HEADER true)", out)
+
+
+def _arrow_type(pa, type_code: int):
+    name = PARQUET_TYPES.get(type_code)
+    if name == "timestamp":
+        return pa.timestamp("us")
+    if name == "timestamptz":
+        return pa.timestamp("us", tz="UTC")
+    return getattr(pa, name)() if name else pa.string()
+
+
+def _write_parquet(conn, sql_query: str, params, out: BinaryIO):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with conn.cursor() as prepare_cur:
+        sql_query = _prepare(prepare_cur, sql_query, params)
+
+    # Именованный курсор - серверный: в памяти одна пачка строк
+    with conn.cursor(name="export_rows") as cur:
+        cur.itersize = BATCH_ROWS
+        cur.execute(sql_query)
+        rows = cur.fetchmany(BATCH_ROWS)
+
+        schema = pa.schema([
+            (column.name, _arrow_type(pa, column.type_code)) for column in cur.description
+        ])
+        # Decimal в float64 и все нестандартное (interval, json, массивы) в строку pyarrow сам не приводит
+        converters = {}
+        for i, (column, field) in enumerate(zip(cur.description, schema)):
+            if field.type == pa.string():
+                converters[i] = str
+            elif column.type_code == 1700:
+                converters[i] = float
+
+        with pq.ParquetWriter(out, schema, compression="zstd") as writer:
+            while rows:
+                columns = [list(values) for values in zip(*rows)]
+                for i, convert in converters.items():
+                    columns[i] = [None if value is None else convert(value) for value in columns[i]]
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                rows = cur.fetchmany(BATCH_ROWS)
+
+
+def write_export(sql_query: str, params=None, fmt: str = "csv", out: Optional[BinaryIO] = None, conn=None) -> None:
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}. Доступные: {', '.join(EXPORT_FORMATS)}")
+
+    own_connection = conn is None
+    conn = conn or get_connection()
+    started = time.perf_counter()
+    try:
+        if fmt == "csv":
+            _write_csv(conn, sql_query, params, out)
+        else:
+            _write_parquet(conn, sql_query, params, out)
+        conn.rollback()
+    finally:
+        if own_connection:
+            conn.close()
+    logger.info(f"Выгрузка {fmt} завершена за {time.perf_counter() - started:.1f} с")
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    # Файлоподобный приемник для COPY и ParquetWriter: куски уходят потребителю через ограниченную очередь
+    def __init__(self, chunks: "queue.Queue", stopped: threading.Event):
+        self.chunks = chunks
+        self.stopped = stopped
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        data = bytes(data)
+        while True:
+            if self.stopped.is_set():
+                raise ExportCancelled("Клиент прервал выгрузку")
+            try:
+                self.chunks.put(data, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+_DONE = object()
+
+
+def iter_export(sql_query: str, params=None, fmt: str = "csv") -> Iterator[bytes]:
+    # Генератор кусков файла для потоковой отдачи (StreamingResponse): выгрузку пишет
+    # отдельный поток, а медленный клиент притормаживает его через заполненную очередь
+    chunks: "queue.Queue" = queue.Queue(maxsize=QUEUE_CHUNKS)
+    stopped = threading.Event()
+    conn = get_connection()
+
+    def produce():
+        try:
+            write_export(sql_query, params, fmt, _QueueWriter(chunks, stopped), conn=conn)
+            result: Any = _DONE
+        except Exception as e:
+            result = e
+        # Финальный маркер кладется, даже если потребитель уже ушел
+        while not stopped.is_set():
+            try:
+                chunks.put(result, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+
+    producer = threading.Thread(target=produce, name="export", daemon=True)
+    producer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stopped.set()
+        if producer.is_alive():
+            # Клиент отключился: прерываем запрос на сервере, поток увидит отмену на следующей записи
+            conn.cancel()
+            producer.join(timeout=5)
+        conn.close()
+
+
+def _cleanup_exports():
+    cutoff = time.time() - EXPORT_TTL_SECONDS
+    for path in EXPORT_DIR.glob("*.*"):
+        if path.stat().st_mtime < cutoff:
+            path.unlink(missing_ok=True)
+
+
+def export_to_file(sql_query: str, params=None, fmt: str = "csv", name: str = "result") -> Path:
+    # Выгрузка на диск для UI без отдельного сервиса; старые файлы удаляются через EXPORT_TTL_SECONDS
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    _cleanup_exports()
+
+    path = EXPORT_DIR / f"{name}.{fmt}"
+    tmp_path = path.with_suffix(f".{fmt}.tmp")
+    try:
+        with open(tmp_path, "wb") as out:
+            write_export(sql_query, params, fmt, out)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return path
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from psycopg2 import sql as pg_sql
+from psycopg2.extensions import encodings
+from psycopg2.extras import RealDictCursor
+
+from database.connection import pooled_connection
+from tools.sql_executor import validate_sql
+from utils.logger import setup_logger
+
+logger = setup_logger('result_store', 'logs/result_store.log')
+
+# Результаты запросов хранятся в Postgres, а не в памяти процесса, поэтому их видит любой процесс сервиса.
+# При регистрации в query_results пишется только SQL с подставленными параметрами. Строки материализуются
+# один раз, при первом запросе страницы: в query_result_rows с номером строки в порядке исходного запроса.
+# Дальше страницы, фильтр и сортировка читают эту копию: порядок строк между страницами не меняется,
+# агрегат и COUNT(*) не пересчитываются на каждый клик, а число строк не "плывет" при новых загрузках.
+# Без фильтра и сортировки страница - диапазон номеров по первичному ключу (keyset).
+
+MAX_RESULTS = int(os.getenv("RESULT_STORE_SIZE", "10000"))
+# Сколько строк результата копируется для просмотра; полный результат доступен через выгрузку
+MAX_STORED_ROWS = int(os.getenv("RESULT_STORE_MAX_ROWS", "100000"))
+MAX_PAGE_SIZE = 500
+# Как часто (в регистрациях) удалять результаты сверх RESULT_STORE_SIZE
+CLEANUP_EVERY = 100
+
+
+class ResultStore:
+    def __init__(self, max_results: int = MAX_RESULTS, max_rows: int = MAX_STORED_ROWS):
+        self.max_results = max_results
+        self.max_rows = max_rows
+        self._registered = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def result_id(sql: str, params=None) -> str:
+        payload = json.dumps([sql, params], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    @staticmethod
+    def _inline(cur, sql_query: str, params=None) -> str:
+        # Параметры подставляются через mogrify: дальше запрос хранится и выполняется как готовый текст
+        sql_query = sql_query.strip().rstrip(";")
+        if not validate_sql(sql_query):
+            raise ValueError("Запрос содержит запрещенные операции. Разрешены только SELECT запросы.")
+        if params:
+            sql_query = cur.mogrify(sql_query, params).decode(encodings[cur.connection.encoding])
+        return sql_query
+
+    def register(
+        self, sql: str, params=None, rows: Optional[List[Dict[str, Any]]] = None, session_id: Optional[str] = None
+    ) -> Optional[str]:
+        # rows, если уже посчитаны, нужны только для имен колонок. Без хранилища таблица под ответом
+        # просто не показывается: ход из-за этого не падает. session_id - сессия, которой результат
+        # показан: только она может листать и выгружать его через сервис
+        result_id = self.result_id(sql, params)
+        columns = list(rows[0].keys()) if rows else None
+        try:
+            with pooled_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO query_results (result_id, source_sql, columns) VALUES (%s, %s, %s)
+                    ON CONFLICT (result_id) DO UPDATE
+                    SET registered_at = NOW(), columns = COALESCE(query_results.columns, EXCLUDED.columns)
+                """, (result_id, self._inline(cur, sql, params), json.dumps(columns) if columns else None))
+                if session_id:
+                    cur.execute("""
+                        INSERT INTO query_result_sessions (result_id, session_id) VALUES (%s, %s)
+                        ON CONFLICT DO NOTHING
+                    """, (result_id, session_id))
+        except Exception as e:
+            logger.error(f"Не удалось сохранить результат {result_id}: {str(e)}")
+            return None
+
+        with self._lock:
+            self._registered += 1
+            cleanup = self._registered % CLEANUP_EVERY == 0
+        if cleanup:
+            self._cleanup()
+        return result_id
+
+    def _cleanup(self):
+        # Строки удаляются вместе с результатом (ON DELETE CASCADE)
+        try:
+            with pooled_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM query_results WHERE result_id IN (
+                        SELECT result_id FROM query_results ORDER BY registered_at DESC OFFSET %s
+                    )
+                """, (self.max_results,))
+                if cur.rowcount:
+                    logger.info(f"Удалено старых результатов: {cur.rowcount}")
+        except Exception as e:
+            logger.error(f"Не удалось удалить старые результаты: {str(e)}")
+
+    @staticmethod
+    def owns(result_id: str, session_id: Optional[str]) -> bool:
+        # id результата - хэш SQL и параметров, его можно вычислить для известного запроса,
+        # поэтому сервис отдает результат только сессии, которой он был показан
+        if not session_id:
+            return False
+        with pooled_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM query_result_sessions WHERE result_id = %s AND session_id = %s", (result_id, session_id)
+            )
+            return cur.fetchone() is not None
+
+    @staticmethod
+    def _entry(cur, result_id: str) -> Dict[str, Any]:
+        cur.execute(
+            "SELECT source_sql, columns, row_count, truncated FROM query_results WHERE result_id = %s", (result_id,)
+        )
+        entry = cur.fetchone()
+        if entry is None:
+            raise KeyError(result_id)
+        return dict(entry)
+
+    def query(self, result_id: str) -> Dict[str, Any]:
+        # SQL результата - для выгрузки, которая выполняет запрос заново целиком
+        with pooled_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            entry = self._entry(cur, result_id)
+        return {"sql": entry["source_sql"], "params": None}
+
+    def _materialize(self, cur, result_id: str) -> Dict[str, Any]:
+        # Копию строит один процесс: остальные ждут блокировку и получают уже готовую
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (result_id,))
+        entry = self._entry(cur, result_id)
+        if entry["row_count"] is not None:
+            return entry
+
+        # Без параметров psycopg2 не трогает %, а в обертке со своими параметрами их нужно экранировать
+        cur.execute(f"SELECT * FROM ({entry['source_sql']}) AS result LIMIT 0")
+        columns = [column.name for column in cur.description]
+        source = pg_sql.SQL(entry["source_sql"].replace("%", "%%"))
+
+        # ROW_NUMBER() фиксирует порядок строк исходного запроса один раз, при копировании
+        cur.execute(
+            pg_sql.SQL("""
+                INSERT INTO query_result_rows (result_id, row_no, data)
+                SELECT %(result_id)s, ROW_NUMBER() OVER (), to_jsonb(result)
+                FROM (SELECT * FROM ({}) AS result LIMIT %(limit)s) AS result
+            """).format(source),
+            {"result_id": result_id, "limit": self.max_rows + 1}
+        )
+        row_count, truncated = cur.rowcount, cur.rowcount > self.max_rows
+        if truncated:
+            cur.execute(
+                "DELETE FROM query_result_rows WHERE result_id = %s AND row_no > %s", (result_id, self.max_rows)
+            )
+            row_count = self.max_rows
+
+        cur.execute(
+            "UPDATE query_results SET columns = %s, row_count = %s, truncated = %s WHERE result_id = %s",
+            (json.dumps(columns), row_count, truncated, result_id)
+        )
+        logger.info(f"Результат {result_id}: сохранено {row_count} строк" + (" (обрезано)" if truncated else ""))
+        return {**entry, "columns": columns, "row_count": row_count, "truncated": truncated}
+
+    def page(
+        self,
+        result_id: str,
+        offset: int = 0,
+        limit: int = 50,
+        sort_by: Optional[str] = None,
+        descending: bool = False,
+        query: Optional[str] = None
+    ) -> Dict[str, Any]:
+        params: Dict[str, Any] = {
+            "result_id": result_id, "limit": max(1, min(limit, MAX_PAGE_SIZE)), "offset": max(0, offset)
+        }
+
+        with pooled_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            entry = self._entry(cur, result_id)
+            if entry["row_count"] is None:
+                entry = self._materialize(cur, result_id)
+                # Копия фиксируется сразу: параллельные запросы страниц ждут ее на блокировке
+                conn.commit()
+            columns = entry["columns"] or []
+
+            if not query and sort_by not in columns:
+                # Порядок исходного запроса: диапазон номеров строк по первичному ключу, без OFFSET
+                cur.execute("""
+                    SELECT data FROM query_result_rows
+                    WHERE result_id = %(result_id)s AND row_no > %(offset)s
+                    ORDER BY row_no LIMIT %(limit)s
+                """, params)
+                total = entry["row_count"]
+            else:
+                where = "result_id = %(result_id)s"
+                if query:
+                    # Подстрока в любой колонке без учета регистра; % и _ из запроса пользователя - обычные символы
+                    params["needle"] = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                    where += " AND EXISTS (SELECT 1 FROM jsonb_each_text(data) AS field WHERE field.value ILIKE %(needle)s)"
+
+                order = "row_no"
+                if sort_by in columns:
+                    # Пустые значения всегда в конце, независимо от направления; row_no делает порядок полным
+                    params["sort_by"] = sort_by
+                    order = f"NULLIF(data -> %(sort_by)s, 'null'::jsonb) {'DESC' if descending else 'ASC'} NULLS LAST, row_no"
+
+                if query:
+                    cur.execute(f"SELECT COUNT(*) AS total FROM query_result_rows WHERE {where}", params)
+                    total = cur.fetchone()["total"]
+                else:
+                    total = entry["row_count"]
+                cur.execute(
+                    f"SELECT data FROM query_result_rows WHERE {where} ORDER BY {order} LIMIT %(limit)s OFFSET %(offset)s",
+                    params
+                )
+
+            # jsonb не хранит порядок ключей: колонки возвращаются в порядке исходного запроса
+            rows = [{column: record["data"].get(column) for column in columns} for record in cur.fetchall()]
+
+        return {
+            "columns": columns,
+            "rows": rows,
+            "total": total,
+            "truncated": entry["truncated"],
+            "offset": params["offset"],
+            "limit": params["limit"]
+        }
+
+
+_store: Optional[ResultStore] = None
+_store_lock = threading.Lock()
+
+
+def get_result_store() -> ResultStore:
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultStore()
+    return _store
@@ -1,19 +1,51 @@
 import sys
+import time
 from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent))
 
 from database.connection import execute_query
+from database.workload import record_statement
+from tools.analytics_engine import (
+    duckdb_unsafe_reason, execute_duckdb, is_duckdb_enabled, is_engine_limitation, snapshot_is_fresh
+)
+from utils.logger import setup_logger
 
+logger = setup_logger('sql_executor', 'logs/sql_executor.log')
+
+
+def _use_duckdb(sql_query: str) -> bool:
+    if not is_duckdb_enabled():
+        return False
+    reason = duckdb_unsafe_reason(sql_query)
+    if reason:
+        logger.info(f"Запрос выполняется в Postgres, в DuckDB результат может отличаться: {reason}")
+        return False
+    return snapshot_is_fresh()
 
-def execute_sql(sql_query: str) -> list:
-    try:
-        results = execute_query(sql_query, fetch=True)
 
-        if results:
-            return [dict(row) for row in results]
-        return []
+def execute_sql(sql_query: str, params=None) -> list:
+    # При ANALYTICS_ENGINE=duckdb совместимые агрегации по sales идут в DuckDB поверх свежего снимка
+    if _use_duckdb(sql_query):
+        started = time.perf_counter()
+        try:
+            rows = execute_duckdb(sql_query, params)
+            record_statement(sql_query, params, "duckdb", (time.perf_counter() - started) * 1000, len(rows))
+            return rows
+        except Exception as e:
+            record_statement(sql_query, params, "duckdb", (time.perf_counter() - started) * 1000, error=str(e)[:500])
+            if not is_engine_limitation(e):
+                raise Exception(f"Ошибка выполнения SQL: {str(e)}")
+            logger.warning(f"DuckDB не поддерживает запрос, выполняем в Postgres: {str(e)[:200]}")
+
+    started = time.perf_counter()
+    try:
+        results = execute_query(sql_query, params, fetch=True)
+        rows = [dict(row) for row in results] if results else []
+        record_statement(sql_query, params, "postgres", (time.perf_counter() - started) * 1000, len(rows))
+        return rows
 
     except Exception as e:
+        record_statement(sql_query, params, "postgres", (time.perf_counter() - started) * 1000, error=str(e)[:500])
         raise Exception(f"Ошибка выполнения SQL: {str(e)}")
 
 
@@ -31,8 +63,8 @@ def validate_sql(sql_query: str) -> bool:
 
     return True
 
-def execute_safe_sql(sql_query: str) -> list:
+def execute_safe_sql(sql_query: str, params=None) -> list:
     if not validate_sql(sql_query):
         raise Exception("Запрос содержит запрещенные операции. Разрешены только SELECT запросы.")
 
-    return execute_sql(sql_query)
+    return execute_sql(sql_query, params)
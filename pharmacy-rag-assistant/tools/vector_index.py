@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from database.connection import pooled_connection
+from database.embeddings import embedding_column
+from utils.logger import setup_logger
+
+logger = setup_logger('vector_index', 'logs/vector_index.log')
+
+
+def _parse_vector(value) -> np.ndarray:
+    # psycopg2 без регистрации pgvector отдает вектор строкой вида "[0.1,0.2,...]"
+    if isinstance(value, str):
+        return np.array(value.strip("[]").split(","), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+# Копия knowledge_base в памяти процесса: top-k считается одним умножением матрицы на вектор.
+# Postgres остается источником истины, индекс перечитывается, когда меняется
+# количество строк, максимальный id/created_at или максимальный xmin в knowledge_base.
+class InMemoryVectorIndex:
+
+    def __init__(self, dtype: str = "float32", check_interval: float = 30.0):
+        self.column = embedding_column()
+        self.dtype = np.float16 if dtype == "float16" else np.float32
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        # (матрица, тексты, типы) подменяются одним присваиванием, чтобы поиск не видел половину обновления
+        self._state: Tuple[Optional[np.ndarray], List[str], List[str]] = (None, [], [])
+        self._version: Optional[Tuple] = None
+        self._last_check = 0.0
+
+    def _fetch_version(self, cur) -> Tuple:
+        # xmin - номер транзакции, записавшей версию строки: UPDATE текста или эмбеддинга
+        # на месте не меняет ни COUNT, ни MAX(id), но дает строке новый xmin
+        cur.execute(f"""
+            SELECT COUNT(*), MAX(id), MAX(created_at), MAX(xmin::text::bigint)
+            FROM knowledge_base
+            WHERE {self.column} IS NOT NULL
+        """)
+        return tuple(cur.fetchone())
+
+    def _load(self, cur, version: Tuple):
+        cur.execute(f"""
+            SELECT content, content_type, {self.column}
+            FROM knowledge_base
+            WHERE {self.column} IS NOT NULL
+            ORDER BY id
+        """)
+        rows = cur.fetchall()
+
+        if rows:
+            matrix = np.vstack([_parse_vector(row[2]) for row in rows])
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix = np.ascontiguousarray(matrix / norms, dtype=self.dtype)
+        else:
+            matrix = None
+
+        self._state = (matrix, [row[0] for row in rows], [row[1] for row in rows])
+        self._version = version
+
+        size_kb = matrix.nbytes / 1024 if matrix is not None else 0
+        logger.info(f"Векторный индекс загружен: {len(rows)} векторов, {size_kb:.1f} КБ, версия {version}")
+
+    def refresh(self, force: bool = False):
+        now = time.monotonic()
+        if not force and self._version is not None and now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            if not force and self._version is not None and now - self._last_check < self.check_interval:
+                return
+
+            with pooled_connection() as conn, conn.cursor() as cur:
+                version = self._fetch_version(cur)
+                if force or version != self._version:
+                    self._load(cur, version)
+
+            self._last_check = time.monotonic()
+
+    def search(self, query_embedding: List[float], top_k: int = 3) -> List[Tuple[str, str, float]]:
+        self.refresh()
+
+        matrix, contents, content_types = self._state
+        if matrix is None or top_k <= 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        scores = matrix @ query.astype(matrix.dtype)
+
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(contents[i], content_types[i], float(scores[i])) for i in top]
+
+    def __len__(self):
+        matrix = self._state[0]
+        return 0 if matrix is None else matrix.shape[0]
+
+
+_shared_index: Optional[InMemoryVectorIndex] = None
+_shared_lock = threading.Lock()
+
+
+def is_vector_index_enabled() -> bool:
+    return os.getenv("VECTOR_INDEX_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+def get_vector_index() -> InMemoryVectorIndex:
+    global _shared_index
+
+    if _shared_index is None:
+        with _shared_lock:
+            if _shared_index is None:
+                _shared_index = InMemoryVectorIndex(
+                    dtype=os.getenv("VECTOR_INDEX_DTYPE", "float32"),
+                    check_interval=float(os.getenv("VECTOR_INDEX_CHECK_INTERVAL", "30"))
+                )
+
+    return _shared_index
@@ -1,6 +1,25 @@
-import plotly.graph_objects as go
-import plotly.express as px
-from typing import List, Dict, Any, Optional
+import json
+from decimal import Decimal
+from typing import TYPE_CHECKING, List, Dict, Any, Optional
+
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
+
+# plotly.express импортируется больше 100 мс, поэтому модуль грузится при первом графике
+# (или заранее в фоне, см. agents/warmup.py), а не при старте UI и сервиса
+
+
+def _px():
+    import plotly.express as px
+    return px
+
+
+def _normalize_data(data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Decimal из psycopg2 plotly воспринимает как категории, а не как числа
+    return [
+        {key: float(value) if isinstance(value, Decimal) else value for key, value in row.items()}
+        for row in data
+    ]
 
 
 def create_visualization(
@@ -10,10 +29,13 @@ def create_visualization(
     x_column: str,
     y_column: str,
     color_column: Optional[str] = None
-) -> go.Figure:
+) -> "go.Figure":
     if not data:
         raise ValueError("Нету данных")
 
+    data = _normalize_data(data)
+    px = _px()
+
     if chart_type == "bar":
         fig = px.bar(
             data,
@@ -72,7 +94,8 @@ def create_grouped_bar_chart(
     x_column: str,
     y_column: str,
     group_column: str
-) -> go.Figure:
+) -> "go.Figure":
+    px = _px()
     fig = px.bar(
         data,
         x=x_column,
@@ -99,7 +122,8 @@ def create_multi_line_chart(
     x_column: str,
     y_column: str,
     group_column: str
-) -> go.Figure:
+) -> "go.Figure":
+    px = _px()
     fig = px.line(
         data,
         x=x_column,
@@ -118,3 +142,12 @@ def create_multi_line_chart(
     )
 
     return fig
+
+
+def figure_to_dict(fig: "go.Figure") -> Dict[str, Any]:
+    return json.loads(fig.to_json())
+
+
+def figure_from_dict(data: Dict[str, Any]) -> "go.Figure":
+    import plotly.io as pio
+    return pio.from_json(json.dumps(data))
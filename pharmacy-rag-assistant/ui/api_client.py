@@ -0,0 +1,93 @@
+import json
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+
+from tools.visualizer import figure_from_dict
+
+# Все запросы сессии несут ее id в заголовке: балансировщик перед несколькими процессами сервиса
+# направляет сессию всегда в один процесс (ходы, отмена и уточнения живут в его памяти)
+SESSION_HEADER = "X-Session-Id"
+
+
+# Тонкий клиент к api/server.py: Streamlit не держит у себя агента, только id сессии
+class AgentAPIClient:
+    def __init__(self, base_url: str, timeout: float = 300.0):
+        self.base_url = base_url.rstrip("/")
+        self.http = httpx.Client(base_url=self.base_url, timeout=timeout)
+
+    def create_session(self) -> str:
+        response = self.http.post("/sessions")
+        response.raise_for_status()
+        return response.json()["session_id"]
+
+    @staticmethod
+    def _headers(session_id: Optional[str]) -> Dict[str, str]:
+        return {SESSION_HEADER: session_id} if session_id else {}
+
+    @staticmethod
+    def _load_figures(figures: List[Dict[str, Any]]) -> list:
+        return [figure_from_dict(fig) for fig in figures]
+
+    def chat(self, session_id: str, message: str, approximate: Optional[bool] = None) -> Dict[str, Any]:
+        response = self.http.post(
+            f"/sessions/{session_id}/chat", json={"message": message, "approximate": approximate},
+            headers=self._headers(session_id)
+        )
+        response.raise_for_status()
+        result = response.json()
+        result["figures"] = self._load_figures(result.get("figures", []))
+        return result
+
+    def chat_stream(self, session_id: str, message: str, approximate: Optional[bool] = None) -> Iterator[Dict[str, Any]]:
+        payload = {"message": message, "approximate": approximate}
+        with self.http.stream("POST", f"/sessions/{session_id}/chat/stream", json=payload,
+                              headers=self._headers(session_id)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                if event["type"] == "result":
+                    event["figures"] = self._load_figures(event.get("figures", []))
+                yield event
+
+    def cancel(self, session_id: str):
+        self.http.post(f"/sessions/{session_id}/cancel", headers=self._headers(session_id)).raise_for_status()
+
+    def refinement(self, refinement_id: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+        response = self.http.get(f"/refinements/{refinement_id}", headers=self._headers(session_id))
+        response.raise_for_status()
+        result = response.json()
+        if result.get("figure") is not None:
+            result["figure"] = figure_from_dict(result["figure"])
+        return result
+
+    def result_page(self, result_id: str, offset: int, limit: int, sort_by=None, descending=False, query=None,
+                    session_id: Optional[str] = None) -> Dict[str, Any]:
+        params = {"offset": offset, "limit": limit, "sort": sort_by or "", "desc": descending, "q": query or ""}
+        response = self.http.get(f"/results/{result_id}", params=params, headers=self._headers(session_id))
+        if response.status_code == 404:
+            raise KeyError(result_id)
+        response.raise_for_status()
+        return response.json()
+
+    def export_url(self, result_id: str, fmt: str, public_url: Optional[str] = None, session_id: Optional[str] = None) -> str:
+        # Ссылку открывает браузер, поэтому адрес сервиса может отличаться от внутреннего base_url,
+        # а id сессии передается параметром: заголовок браузер не добавит
+        url = f"{(public_url or self.base_url).rstrip('/')}/results/{result_id}/export?format={fmt}"
+        return f"{url}&session_id={session_id}" if session_id else url
+
+    def history(self, session_id: str) -> List[Dict[str, Any]]:
+        response = self.http.get(f"/sessions/{session_id}/history", headers=self._headers(session_id))
+        if response.status_code == 404:
+            return []
+        response.raise_for_status()
+        messages = response.json()["messages"]
+        for message in messages:
+            if "figures" in message:
+                message["figures"] = self._load_figures(message["figures"])
+        return messages
+
+    def clear(self, session_id: str):
+        self.http.delete(f"/sessions/{session_id}", headers=self._headers(session_id)).raise_for_status()
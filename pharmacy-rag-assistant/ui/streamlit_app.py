@@ -1,10 +1,33 @@
+import os
 import sys
+import uuid
+import queue
+import threading
 from pathlib import Path
 import streamlit as st
+from dotenv import load_dotenv
 
 sys.path.append(str(Path(__file__).parent.parent))
 
-from agents.conversational_agent import ConversationalAgent
+load_dotenv()
+
+from database.session_store import TRANSCRIPT, apply_refinement, get_session_store, session_limits
+from tools.visualizer import figure_from_dict, figure_to_dict
+
+# Если задан AGENT_API_URL, UI работает тонким клиентом к api/server.py,
+# иначе агент живет прямо в процессе Streamlit
+AGENT_API_URL = os.getenv("AGENT_API_URL")
+# Как часто проверять, досчитался ли точный запрос для приблизительного ответа
+REFINEMENT_POLL_SECONDS = float(os.getenv("REFINEMENT_POLL_SECONDS", "2"))
+# Таблица результата показывается, начиная с этого числа строк; меньшие видны в ответе и на графике
+TABLE_MIN_ROWS = int(os.getenv("TABLE_MIN_ROWS", "10"))
+PAGE_SIZES = [25, 50, 100, 250]
+# Адрес сервиса агента, доступный из браузера, для ссылок на выгрузку (по умолчанию AGENT_API_URL)
+EXPORT_PUBLIC_URL = os.getenv("EXPORT_PUBLIC_URL")
+EXPORT_MIME = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+# Без сервиса готовый файл целиком попадает в память Streamlit, поэтому его размер ограничен
+LOCAL_EXPORT_MAX_BYTES = int(float(os.getenv("LOCAL_EXPORT_MAX_MB", "50")) * 1024 * 1024)
+TURN_POLL_SECONDS = 0.25
 
 st.set_page_config(
     page_title="Аналитик",
@@ -39,25 +62,338 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 
-if "agent" not in st.session_state:
-    st.session_state.agent = ConversationalAgent()
+@st.cache_resource
+def start_warmup():
+    # Один раз на процесс Streamlit: пока пользователь открывает страницу, в фоне
+    # создаются агенты и клиенты, открываются соединения и загружается векторный индекс
+    from agents.warmup import start_background_warmup
+    return start_background_warmup()
+
+
+@st.cache_resource
+def get_api_client():
+    from ui.api_client import AgentAPIClient
+    return AgentAPIClient(AGENT_API_URL)
+
+
+def turn_worker(user_input: str, session_id: str, agent, approximate: bool, events: queue.Queue) -> dict:
+    # Выполняется в отдельном потоке, поэтому здесь нет обращений к st.*
+    if agent is not None:
+        result = agent.chat(user_input, on_event=events.put, approximate=approximate)
+        store = get_session_store()
+        if store is not None:
+            turn = agent.turn
+            answer = {"role": "assistant", "content": result["response"],
+                      "figures": [figure_to_dict(fig) for fig in result.get("figures", [])],
+                      "tables": result.get("tables", [])}
+            store.append(session_id, TRANSCRIPT, turn, [{"role": "user", "content": user_input}, answer])
+            if result.get("refinements"):
+                from tools.approximate import persist_refinements
+                persist_refinements(
+                    result["refinements"], answer,
+                    lambda message: store.replace_last(session_id, TRANSCRIPT, turn, message)
+                )
+        return result
+
+    for event in get_api_client().chat_stream(session_id, user_input, approximate):
+        if event["type"] == "result":
+            return event
+        elif event["type"] == "error":
+            raise Exception(event["error"])
+        events.put(event)
+    raise Exception("Сервис агента не вернул результат")
+
+
+def cancel_turn(session_id: str, agent):
+    if agent is not None:
+        agent.cancel()
+        return
+    try:
+        get_api_client().cancel(session_id)
+    except Exception:
+        pass
+
+
+def turn_in_progress() -> bool:
+    # Поток прошлого хода может пережить отмену (например, ждет ответа LLM, который не прерывается):
+    # пока он жив, новый ход на том же агенте и с той же историей не начинается
+    worker = st.session_state.get("turn_worker")
+    return worker is not None and worker.is_alive()
+
+
+def run_turn(user_input: str, status) -> dict:
+    if turn_in_progress():
+        raise Exception("Предыдущий ход еще завершается, повторите вопрос через несколько секунд")
+
+    session_id = st.session_state.session_id
+    agent = None if AGENT_API_URL else st.session_state.agent
+    approximate = st.session_state.approximate
+    events: queue.Queue = queue.Queue()
+    outcome = {}
+
+    def work():
+        try:
+            outcome["result"] = turn_worker(user_input, session_id, agent, approximate, events)
+        except Exception as e:
+            outcome["error"] = e
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    st.session_state.turn_worker = worker
+
+    # Ход идет в фоне, а скрипт опрашивает его и обновляет статус. Нажатие «Остановить»
+    # перезапускает скрипт: Streamlit прерывает его на ближайшем вызове st.*, и в finally
+    # ход отменяется - SQL в Postgres/DuckDB и ожидание ответа LLM обрываются сразу
+    finished = False
+    caption = "Выполняется..."
+    try:
+        while worker.is_alive():
+            worker.join(TURN_POLL_SECONDS)
+            while not events.empty():
+                event = events.get_nowait()
+                if event["type"] == "tool_start":
+                    caption = f"Инструмент: {event['tool']}..."
+            status.caption(caption)
+        finished = True
+    finally:
+        if not finished:
+            cancel_turn(session_id, agent)
+            worker.join(timeout=5)
+            st.session_state.messages.append({"role": "assistant", "content": "Ход остановлен.", "figures": []})
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def fetch_refinement(refinement_id: str) -> dict:
+    if AGENT_API_URL:
+        return get_api_client().refinement(refinement_id, st.session_state.session_id)
+    from tools.approximate import get_refinement
+    return get_refinement(refinement_id)
+
+
+@st.fragment(run_every=1)
+def wait_for_previous_turn():
+    if not turn_in_progress():
+        st.rerun()
+    st.caption("Остановленный ход еще завершается, новый вопрос можно будет задать через несколько секунд...")
+
+
+@st.fragment(run_every=REFINEMENT_POLL_SECONDS)
+def watch_refinements():
+    changed = False
+    for message in st.session_state.messages:
+        for refinement in list(message.get("refinements", [])):
+            try:
+                exact = fetch_refinement(refinement["id"])
+            except Exception as e:
+                exact = {"status": "error", "error": str(e)}
+            if exact["status"] == "pending":
+                continue
+
+            message["refinements"].remove(refinement)
+            if exact["status"] == "done":
+                apply_refinement(message, refinement, exact)
+            changed = True
+
+    if changed:
+        st.rerun()
+    st.caption("Уточняем приблизительные цифры точным запросом...")
+
+
+def fetch_page(result_id: str, offset: int, limit: int, sort_by, descending: bool, query) -> dict:
+    if AGENT_API_URL:
+        return get_api_client().result_page(
+            result_id, offset, limit, sort_by, descending, query, session_id=st.session_state.session_id
+        )
+    from tools.result_store import get_result_store
+    return get_result_store().page(result_id, offset, limit, sort_by, descending, query)
+
+
+@st.fragment
+def render_result_table(table: dict, key: str):
+    # Фрагмент: листание, сортировка и фильтр перерисовывают только таблицу, без LLM и остального чата
+    state = st.session_state.setdefault(f"{key}_state", {"page": 0, "columns": []})
+
+    filter_col, sort_col, order_col, size_col = st.columns([3, 2, 1, 1])
+    query = filter_col.text_input("Фильтр", key=f"{key}_q", placeholder="Поиск по всем колонкам")
+    sort_by = sort_col.selectbox("Сортировка", [None] + state["columns"], key=f"{key}_sort",
+                                 format_func=lambda c: "как в запросе" if c is None else c)
+    descending = order_col.toggle("По убыванию", key=f"{key}_desc")
+    limit = size_col.selectbox("Строк", PAGE_SIZES, index=1, key=f"{key}_limit")
+
+    # При смене фильтра, сортировки или размера страницы возвращаемся на первую страницу
+    view = (query, sort_by, descending, limit)
+    if state.get("view") != view:
+        state["view"] = view
+        state["page"] = 0
+
+    try:
+        page = fetch_page(table["result_id"], state["page"] * limit, limit, sort_by, descending, query)
+    except KeyError:
+        st.caption("Результат больше не хранится на сервере, повторите вопрос.")
+        return
+    except Exception as e:
+        st.error(f"Не удалось загрузить таблицу: {str(e)}")
+        return
+
+    if page["columns"] != state["columns"]:
+        state["columns"] = page["columns"]
+        st.rerun(scope="fragment")
+
+    st.dataframe(page["rows"], use_container_width=True, hide_index=True)
+
+    pages = max(1, -(-page["total"] // limit))
+    prev_col, info_col, next_col = st.columns([1, 4, 1])
+    if prev_col.button("←", key=f"{key}_prev", disabled=state["page"] == 0):
+        state["page"] -= 1
+        st.rerun(scope="fragment")
+    if next_col.button("→", key=f"{key}_next", disabled=state["page"] >= pages - 1):
+        state["page"] += 1
+        st.rerun(scope="fragment")
+    first = page["offset"] + 1 if page["total"] else 0
+    info_col.caption(f"Строки {first}–{page['offset'] + len(page['rows'])} из {page['total']}, "
+                     f"страница {state['page'] + 1} из {pages}")
+    if page.get("truncated"):
+        st.caption("В таблице только первые строки результата, все строки есть в выгрузке.")
+
+    render_export(table, key)
+
+
+@st.fragment
+def render_export_fragment(table: dict, key: str):
+    render_export(table, key)
+
+
+def render_export(table: dict, key: str):
+    # Выгрузка всего результата, а не страницы: запрос заново выполняется в Postgres потоком
+    format_col, action_col = st.columns([1, 3])
+    fmt = format_col.selectbox("Формат", list(EXPORT_MIME), key=f"{key}_format", label_visibility="collapsed")
+    file_name = f"result_{table['result_id'][:8]}.{fmt}"
+
+    if AGENT_API_URL:
+        # Браузер скачивает файл прямо у сервиса, который стримит его из Postgres
+        action_col.link_button("Скачать все строки", get_api_client().export_url(
+            table["result_id"], fmt, EXPORT_PUBLIC_URL, st.session_state.session_id
+        ))
+        return
+
+    # Без сервиса файл готовится только по нажатию и отдается кнопкой в этом же прогоне скрипта:
+    # download_button держит содержимое в памяти, поэтому файл читается один раз и сразу удаляется,
+    # а следующие перезапуски (листание таблицы, другие вопросы) его не перечитывают
+    if not action_col.button("Подготовить выгрузку", key=f"{key}_export"):
+        return
+
+    from tools.export import export_to_file
+    from tools.result_store import get_result_store
+
+    try:
+        query = get_result_store().query(table["result_id"])
+        with st.spinner("Выгрузка..."):
+            # Строки идут из Postgres в файл на диске пачками, минуя память процесса
+            path = export_to_file(query["sql"], query["params"], fmt, f"{table['result_id'][:8]}_{uuid.uuid4().hex[:8]}")
+        try:
+            size = path.stat().st_size
+            data = path.read_bytes() if size <= LOCAL_EXPORT_MAX_BYTES else None
+        finally:
+            path.unlink(missing_ok=True)
+    except KeyError:
+        st.caption("Результат больше не хранится на сервере, повторите вопрос.")
+        return
+    except Exception as e:
+        st.error(f"Не удалось выгрузить результат: {str(e)}")
+        return
+
+    if data is None:
+        st.error(f"Выгрузка занимает {size / 1024 / 1024:.0f} МБ, без сервиса агента доступно до "
+                 f"{LOCAL_EXPORT_MAX_BYTES / 1024 / 1024:.0f} МБ (LOCAL_EXPORT_MAX_MB). Для полной выгрузки "
+                 "запустите сервис (AGENT_API_URL) или сузьте запрос.")
+        return
+
+    action_col.download_button("Скачать все строки", data, file_name=file_name, mime=EXPORT_MIME[fmt], key=f"{key}_download")
+    st.caption("Файл готов. После скачивания или любого действия на странице кнопка исчезнет, для новой выгрузки подготовьте ее снова.")
+
+
+def render_assistant_message(message: dict, index: int):
+    st.markdown(f'<div class="chat-message assistant-message"><strong>Ассистент:</strong><br>{message["content"]}</div>',
+               unsafe_allow_html=True)
+
+    for fig in message.get("figures", []):
+        st.plotly_chart(fig, use_container_width=True)
+
+    for rows in message.get("exact_data", []):
+        st.caption("Точные данные:")
+        st.dataframe(rows, use_container_width=True)
+
+    for n, table in enumerate(message.get("tables", [])):
+        key = f"table_{index}_{n}_{table['result_id']}"
+        if table["row_count"] >= TABLE_MIN_ROWS:
+            with st.expander(f"Таблица результата: {table['row_count']} строк"):
+                render_result_table(table, key=key)
+        elif table["row_count"]:
+            with st.expander("Выгрузка результата"):
+                render_export_fragment(table, key)
+
+
+def load_transcript(session_id: str) -> list:
+    if AGENT_API_URL:
+        return get_api_client().history(session_id)
+
+    store = get_session_store()
+    if store is None:
+        return []
+    messages = store.load_recent(session_id, TRANSCRIPT, session_limits()["resume_turns"])
+    for message in messages:
+        if "figures" in message:
+            message["figures"] = [figure_from_dict(fig) for fig in message["figures"]]
+    return messages
+
+
+# id сессии живет в URL, поэтому после перезапуска или перезагрузки страницы диалог продолжается
+if "session_id" not in st.session_state:
+    session_id = st.query_params.get("session")
+    if not session_id:
+        session_id = get_api_client().create_session() if AGENT_API_URL else uuid.uuid4().hex
+        st.query_params["session"] = session_id
+    st.session_state.session_id = session_id
+
+if not AGENT_API_URL:
+    start_warmup()
+
+if not AGENT_API_URL and "agent" not in st.session_state:
+    from agents.conversational_agent import ConversationalAgent
+    st.session_state.agent = ConversationalAgent(session_id=st.session_state.session_id, store=get_session_store())
+
+if "approximate" not in st.session_state:
+    from tools.approximate import is_approximate_enabled
+    st.session_state.approximate = is_approximate_enabled()
 
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = load_transcript(st.session_state.session_id)
 
 st.markdown('<h1 class="main-header">Аналитический Ассистент</h1>', unsafe_allow_html=True)
 
 with st.sidebar:
     st.divider()
 
-    if st.button("Очистить историю", use_container_width=True):
+    st.toggle(
+        "Быстрые приблизительные ответы",
+        key="approximate",
+        help="Сначала ответ по выборке с оценкой погрешности, затем точные цифры"
+    )
+
+    if st.button("Очистить историю", use_container_width=True, disabled=turn_in_progress()):
         st.session_state.messages = []
-        st.session_state.agent.clear_history()
+        if AGENT_API_URL:
+            get_api_client().clear(st.session_state.session_id)
+        else:
+            st.session_state.agent.clear_history()
         st.rerun()
 
     st.divider()
 
-for message in st.session_state.messages:
+for index, message in enumerate(st.session_state.messages):
     role = message["role"]
     content = message["content"]
 
@@ -65,15 +401,13 @@ for message in st.session_state.messages:
         st.markdown(f'<div class="chat-message user-message"><strong>Вы:</strong><br>{content}</div>',
                    unsafe_allow_html=True)
     else:
-        st.markdown(f'<div class="chat-message assistant-message"><strong>Ассистент:</strong><br>{content}</div>',
-                   unsafe_allow_html=True)
+        render_assistant_message(message, index)
 
-        if "figures" in message:
-            for fig in message["figures"]:
-                st.plotly_chart(fig, use_container_width=True)
 
-
-user_input = st.chat_input("Ваш вопрос please...")
+busy = turn_in_progress()
+user_input = st.chat_input("Ваш вопрос please...", disabled=busy)
+if busy:
+    wait_for_previous_turn()
 
 if user_input:
     st.session_state.messages.append({"role": "user", "content": user_input})
@@ -81,25 +415,31 @@ if user_input:
     st.markdown(f'<div class="chat-message user-message"><strong>Вы:</strong><br>{user_input}</div>',
                unsafe_allow_html=True)
 
+    st.button("Остановить", key="stop_turn", help="Прервать запрос к базе и ожидание ответа модели")
+
     with st.spinner("Думаю, думаю, ничего не придумаю ..."):
         try:
-            result = st.session_state.agent.chat(user_input)
-            st.session_state.messages.append({
+            result = run_turn(user_input, st.empty())
+            message = {
                 "role": "assistant",
                 "content": result["response"],
-                "figures": result.get("figures", [])
-            })
+                "figures": list(result.get("figures", [])),
+                "refinements": result.get("refinements", []),
+                "tables": result.get("tables", [])
+            }
+            st.session_state.messages.append(message)
+            # В памяти сессии Streamlit держим только последние ходы, полная история в хранилище
+            st.session_state.messages = st.session_state.messages[-2 * session_limits()["max_turns"]:]
 
-            st.markdown(f'<div class="chat-message assistant-message"><strong>Ассистент:</strong><br>{result["response"]}</div>',
-                       unsafe_allow_html=True)
-
-            for fig in result.get("figures", []):
-                st.plotly_chart(fig, use_container_width=True)
+            render_assistant_message(message, len(st.session_state.messages) - 1)
 
         except Exception as e:
             st.error(f"Произошла ошибка: {str(e)}")
 
 
+if any(message.get("refinements") for message in st.session_state.messages):
+    watch_refinements()
+
 if not st.session_state.messages:
     st.info("""
     Для старта можете написать это:
@@ -0,0 +1,148 @@
+import time
+import threading
+import contextvars
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# Дедлайн и отмена хода агента. Контекст хода живет в contextvar потока агента:
+# SQL, поиск по базе знаний и вызовы LLM берут из него остаток времени
+# и регистрируют, как прервать себя (conn.cancel, interrupt DuckDB), пока выполняются.
+
+
+class TurnCancelled(BaseException):
+    # Наследуется от BaseException, как asyncio.CancelledError: многочисленные
+    # "except Exception" в инструментах не должны превращать отмену в обычную ошибку
+    pass
+
+
+class DeadlineExceeded(TurnCancelled):
+    pass
+
+
+_current: contextvars.ContextVar[Optional["TurnContext"]] = contextvars.ContextVar("turn_context", default=None)
+
+
+class TurnContext:
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self._reason: Optional[type] = None
+        self._callbacks: Dict[int, Callable[[], None]] = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._stop, args=(DeadlineExceeded,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def stopped(self) -> bool:
+        return self._reason is not None
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def _error(self) -> TurnCancelled:
+        if self._reason is DeadlineExceeded:
+            return DeadlineExceeded(f"Превышено время на ход ({self.timeout:g} с)")
+        return TurnCancelled("Ход остановлен пользователем")
+
+    def _stop(self, reason: type):
+        # Колбэки вызываются под блокировкой: discard() дождется их, прежде чем
+        # соединение вернется в пул и достанется чужому запросу
+        with self._lock:
+            if self._reason is not None:
+                return
+            self._reason = reason
+            for callback in self._callbacks.values():
+                try:
+                    callback()
+                except Exception:
+                    pass
+
+    def cancel(self):
+        self._stop(TurnCancelled)
+
+    def check(self):
+        if self._reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self._stop(DeadlineExceeded)
+        if self._reason is not None:
+            raise self._error()
+
+    def on_cancel(self, callback: Callable[[], None]) -> int:
+        with self._lock:
+            self._next_token += 1
+            self._callbacks[self._next_token] = callback
+            return self._next_token
+
+    def discard(self, token: int):
+        with self._lock:
+            self._callbacks.pop(token, None)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+def current_turn() -> Optional[TurnContext]:
+    return _current.get()
+
+
+@contextmanager
+def turn_scope(turn: TurnContext):
+    token = _current.set(turn)
+    try:
+        yield turn
+    finally:
+        _current.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    turn = current_turn()
+    return turn.remaining() if turn is not None else None
+
+
+def check_deadline():
+    turn = current_turn()
+    if turn is not None:
+        turn.check()
+
+
+@contextmanager
+def cancellable(cancel: Callable[[], None]):
+    # Пока блок выполняется, отмена или истечение дедлайна вызывают cancel();
+    # ошибка, вызванная прерыванием, превращается в TurnCancelled / DeadlineExceeded
+    turn = current_turn()
+    if turn is None:
+        yield
+        return
+
+    turn.check()
+    token = turn.on_cancel(cancel)
+    try:
+        yield
+    except Exception as e:
+        if turn.stopped:
+            raise turn._error() from e
+        raise
+    finally:
+        turn.discard(token)
+
+
+def wait_future(future: Future, poll_seconds: float = 0.1):
+    # Ожидание результата из другого потока, которое можно прервать отменой хода
+    turn = current_turn()
+    if turn is None:
+        return future.result()
+
+    while True:
+        turn.check()
+        try:
+            return future.result(timeout=poll_seconds)
+        except FutureTimeoutError:
+            continue